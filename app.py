@@ -1,45 +1,161 @@
-from flask import Flask, request, render_template, jsonify, redirect, url_for, session
+from flask import Flask, request, render_template, jsonify, redirect, url_for, session, Response, stream_with_context, g
+import atexit
 import base64
-import os
 import csv
-import sys
+import io
+import os
+import tempfile
+import threading
 from datetime import datetime
 import json
+import logging
+import time
+from match_cache import MatchCache, MATCH_CACHE_SIZE, MATCH_CACHE_TTL
+from matcher import IdentificationEngine, get_matcher, MATCH_THRESHOLD, SGI_MATCH_URL
+from template_index import TemplateIndex, DEFAULT_SHORTLIST_SIZE
+from template_store import TemplateStore
+from storage import get_storage, VOTE_FIELDS
+from voter_registry import VOTER_FIELDS, VoterRegistry
+from blob_store import BlobStore, is_legacy_voters_csv, migrate_voters_csv
+from digest_index import DigestIndex, template_digest
+from vote_window import VoteWindow
+from vote_journal import VoteJournal
+from vote_tally import VoteTally
+from vote_snapshot import write_snapshot
+from results_feed import ResultsFeed, RESULTS_FEED_INTERVAL
+from warm_state import WarmState
+from candidate_catalogue import CandidateCatalogue
+from candidate_import import import_candidates
+from bulk_enrol import BulkEnroller, read_enrolment_csv
+from scan_sessions import ScanSessionStore, SCAN_SESSION_TTL, SCAN_SESSION_MAX
+from telemetry import setup_logging, metrics
 
 app = Flask(__name__)
 LIC_STR = '' 
-app.secret_key = 'your_secret_key_change_in_production'
+# Shared by every shard and the shard router, so sessions are valid on all of them
+app.secret_key = os.environ.get('SECRET_KEY', 'your_secret_key_change_in_production')
+
+# JSON lines to Logs/vms-<pid>.log (one per process, rotated) and stderr via a background thread
+# (LOG_LEVEL, LOG_DIR, LOG_CONSOLE=0)
+setup_logging()
+logger = logging.getLogger(__name__)
+# Name of this process in a sharded deployment (see sharding.py); empty
+# when it runs alone
+SHARD_NAME = os.environ.get('SHARD_NAME', '')
+
+# Bearer token that lets a scraper read /metrics without an admin session
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 # Data storage for biometric workflows
-registration_data = {}
-login_scan_data = {}
-voting_data = {}
+# Scans in progress, one entry per booth flow (token kept in the Flask session)
+SCAN_SESSION_DIR = 'scan_sessions'
+scan_sessions = ScanSessionStore(SCAN_SESSION_DIR,
+                                 ttl=int(os.environ.get('SCAN_SESSION_TTL', str(SCAN_SESSION_TTL))),
+                                 max_sessions=int(os.environ.get('SCAN_SESSION_MAX', str(SCAN_SESSION_MAX))))
 
 # CSV file paths
 VOTERS_CSV = 'voters.csv'
 VOTES_CSV = 'votes.csv'
 CANDIDATES_CSV = 'candidates.csv'
 DAILY_VOTES_CSV = 'daily_votes.csv'
+# Fingerprint images, stored outside voters.csv and keyed by content hash
+BLOB_DIR = 'fingerprint_images'
+blob_store = BlobStore(BLOB_DIR)
+# Persisted digests of enrolled templates for O(1) duplicate checks
+TEMPLATE_DIGESTS_CSV = 'template_digests.csv'
+digest_index = DigestIndex(TEMPLATE_DIGESTS_CSV)
+
+# Storage backend (STORAGE_BACKEND=csv|sqlite); the CSV backend caches
+# voters.csv in memory and reloads it only when the file changes
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'csv').lower()
+SQLITE_DB = os.environ.get('SQLITE_DB', 'vms.sqlite3')
+storage = get_storage(STORAGE_BACKEND, sqlite_path=SQLITE_DB, voters_csv=VOTERS_CSV, votes_csv=VOTES_CSV,
+                      daily_votes_csv=DAILY_VOTES_CSV, candidates_csv=CANDIDATES_CSV)
+voter_registry = storage.voters
+# voter_id -> time of last vote within the 75-hour window, fed from daily votes
+vote_window = VoteWindow(storage.daily_votes)
+# Write-ahead journal: cast_vote commits vote + voted marker atomically, in batches
+VOTES_JOURNAL = 'votes.journal'
+vote_journal = VoteJournal(VOTES_JOURNAL, storage, vote_window)
+
+# Running vote counts, checkpointed so a restart only reads new votes
+VOTE_TALLY_CHECKPOINT = f'vote_tally_{STORAGE_BACKEND}.json'
+vote_tally = VoteTally(storage.votes, VOTE_TALLY_CHECKPOINT)
+# Live results for /admin/results/stream; changes are pushed at most once
+# per RESULTS_FEED_INTERVAL seconds
+results_feed = ResultsFeed(vote_tally, lambda: results_snapshot(),
+                           interval=float(os.environ.get('RESULTS_FEED_INTERVAL', str(RESULTS_FEED_INTERVAL))))
+
+# Candidates grouped by state and constituency, served from pre-built JSON
+candidate_catalogue = CandidateCatalogue(storage.candidates)
+
+# Decoded templates in a memory-mapped file, so matching does not decode
+# base64 for every comparison
+TEMPLATE_STORE = f'voter_templates_{STORAGE_BACKEND}.bin'
+template_store = TemplateStore(TEMPLATE_STORE)
+
+# Scores of template pairs already compared (MATCH_CACHE_SIZE=0 disables)
+match_cache_size = int(os.environ.get('MATCH_CACHE_SIZE', str(MATCH_CACHE_SIZE)))
+match_cache = MatchCache(match_cache_size,
+                         ttl=int(os.environ.get('MATCH_CACHE_TTL', str(MATCH_CACHE_TTL)))) if match_cache_size > 0 else None
+
+# Server-side 1:N matching (MATCHER_BACKEND=secugen|local; SGI_MATCH_URL
+# points the secugen backend at another service, e.g. fake_sgibiosrv.py;
+# MATCH_MAX_IN_FLIGHT and MATCH_RETRIES tune its connection pool and retries)
+identification_engine = IdentificationEngine(
+    get_matcher(os.environ.get('MATCHER_BACKEND'), licstr=LIC_STR,
+                url=os.environ.get('SGI_MATCH_URL', SGI_MATCH_URL),
+                max_in_flight=int(os.environ.get('MATCH_MAX_IN_FLIGHT', '8')),
+                retries=int(os.environ.get('MATCH_RETRIES', '2'))),
+    workers=int(os.environ.get('MATCHER_WORKERS', '8')),
+    templates=template_store,
+    cache=match_cache
+)
 
-# Initialize CSV files if they don't exist
-def init_csv_files():
-    # Voters CSV: voter_id, name, template_base64, bmp_base64, registration_date
-    if not os.path.exists(VOTERS_CSV):
-        with open(VOTERS_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['voter_id', 'name', 'template_base64', 'bmp_base64', 'registration_date'])
-    
-    # Votes CSV: date, voter_id, name, state, constituency, candidate_name, party, timestamp
-    if not os.path.exists(VOTES_CSV):
-        with open(VOTES_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['date', 'voter_id', 'name', 'state', 'constituency', 'candidate_name', 'party', 'timestamp'])
-    
-    # Daily votes CSV: date, voter_id, voted, timestamp (to track voting within 75 hours)
-    if not os.path.exists(DAILY_VOTES_CSV):
-        with open(DAILY_VOTES_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['date', 'voter_id', 'voted', 'timestamp'])
+# Minutiae-triplet index used to shortlist candidates before full scoring
+# (SHORTLIST_SIZE=0 disables it; SHORTLIST_FALLBACK=0 skips the full search
+# when no shortlisted voter matches)
+template_index = TemplateIndex()
+# (registry generation, number of its voters) the index covers
+template_index_source = None
+template_index_lock = threading.Lock()
+SHORTLIST_SIZE = int(os.environ.get('SHORTLIST_SIZE', str(DEFAULT_SHORTLIST_SIZE)))
+SHORTLIST_FALLBACK = os.environ.get('SHORTLIST_FALLBACK', '1') != '0'
+
+# Duplicate-biometric check at registration: 'exact' (digest lookup only) or
+# 'fuzzy' (also scores the shortlisted voters to catch re-scans of an
+# enrolled finger)
+DUPLICATE_CHECK_MODE = os.environ.get('DUPLICATE_CHECK_MODE', 'exact').lower()
+DUPLICATE_MATCH_THRESHOLD = int(os.environ.get('DUPLICATE_MATCH_THRESHOLD', '60'))
+
+# Snapshot of the voter roll, template index and 75-hour map, restored at
+# startup instead of re-reading the CSV files (WARM_STATE=0 disables). The
+# remaining indexes are built by a background thread after startup
+# (WARM_UP=0 leaves them to the first request that needs them).
+WARM_STATE = os.environ.get('WARM_STATE', f'warm_state_{STORAGE_BACKEND}.bin')
+WARM_UP = os.environ.get('WARM_UP', '1') != '0'
+warm_state = WarmState(WARM_STATE,
+                       registry=voter_registry if isinstance(voter_registry, VoterRegistry) else None,
+                       template_index=template_index,
+                       vote_window=vote_window) if WARM_STATE != '0' else None
+
+# Admin voter list / vote log pages
+ADMIN_PAGE_SIZE = 100
+ADMIN_PAGE_MAX = 500
+EXPORT_BATCH_SIZE = 1000
+# Exported voter columns; templates stay out of the admin views
+VOTER_EXPORT_FIELDS = [field for field in VOTER_FIELDS if field != 'template_base64']
+
+# Initialize storage (CSV files with headers, or the SQLite schema)
+def init_storage():
+    if STORAGE_BACKEND == 'csv' and is_legacy_voters_csv(VOTERS_CSV):
+        # One-shot move of inline bmp_base64 images into the blob store
+        try:
+            moved = migrate_voters_csv(VOTERS_CSV, blob_store)
+            logger.info("Migrated %d fingerprint images from %s to %s", moved, VOTERS_CSV, BLOB_DIR)
+        except Exception:
+            logger.exception("Error migrating voters CSV images")
+    storage.init()
 
 def TranslateErrorNumber(ErrorNumber):
     match ErrorNumber:
@@ -85,184 +201,231 @@ def get_int_form_value(form, key, default=0):
 
 # Save voter to CSV
 def save_voter(voter_id, name, template_base64, bmp_base64):
-    with open(VOTERS_CSV, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([voter_id, name, template_base64, bmp_base64, datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
+    bmp_hash = ''
+    if bmp_base64:
+        try:
+            bmp_hash = blob_store.put_base64(bmp_base64)
+        except ValueError as e:
+            logger.warning("Could not store fingerprint image for %s: %s", voter_id, e)
+    voter_registry.append({
+        'voter_id': voter_id,
+        'name': name,
+        'template_base64': template_base64,
+        'bmp_hash': bmp_hash,
+        'registration_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    })
+    template_index.add(voter_id, template_base64)
+    digest_index.add(voter_id, template_base64)
+    template_store.add(voter_id, template_base64)
 
-# Get all voters from CSV
+# Get all voters (served from the registry cache)
 def get_all_voters():
-    voters = []
-    if os.path.exists(VOTERS_CSV):
-        try:
-            # Increase field size limit for CSV with large base64 strings
-            original_limit = csv.field_size_limit()
-            try:
-                csv.field_size_limit(min(2**31-1, sys.maxsize))
-            except:
-                pass
-            
-            with open(VOTERS_CSV, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                row_count = 0
-                for row in reader:
-                    row_count += 1
-                    try:
-                        voter_id = (row.get('voter_id') or '').strip()
-                        template = (row.get('template_base64') or '').strip()
-                        name = (row.get('name') or '').strip()
-                        bmp = (row.get('bmp_base64') or '').strip()
-                        reg_date = (row.get('registration_date') or '').strip()
-                        
-                        # Check if row has required fields and template_base64 is not empty
-                        if voter_id and template and len(template) > 10:
-                            voters.append({
-                                'voter_id': voter_id,
-                                'name': name,
-                                'template_base64': template,
-                                'bmp_base64': bmp,
-                                'registration_date': reg_date
-                            })
-                            print(f"✓ Loaded voter {row_count}: ID={voter_id}, Name={name}, Template length={len(template)}")
-                        else:
-                            print(f"✗ Skipped row {row_count}: voter_id={bool(voter_id)}, template_len={len(template) if template else 0}")
-                    except Exception as row_error:
-                        print(f"✗ Error processing row {row_count}: {row_error}")
-                        continue
-                
-                print(f"CSV reading complete: {row_count} rows processed, {len(voters)} valid voters loaded")
-            
-            # Restore original limit
-            try:
-                csv.field_size_limit(original_limit)
-            except:
-                pass
-                
-        except Exception as e:
-            print(f"ERROR reading voters CSV: {e}")
-            import traceback
-            traceback.print_exc()
-    else:
-        print(f"WARNING: VOTERS_CSV file does not exist: {VOTERS_CSV}")
-    
-    print(f"get_all_voters returning {len(voters)} voters")
+    voters = voter_registry.voters()
+    logger.debug("get_all_voters returning %d voters", len(voters))
     return voters
 
 # Check if voter ID exists
 def voter_id_exists(voter_id):
-    voters = get_all_voters()
-    return any(v['voter_id'].upper() == voter_id.upper() for v in voters)
+    return voter_registry.get(voter_id) is not None
 
 # Check if voter has already voted within the last 75 hours
 def has_voted_today(voter_id):
-    current_time = datetime.now()
-    if os.path.exists(DAILY_VOTES_CSV):
-        try:
-            with open(DAILY_VOTES_CSV, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row.get('voter_id', '').upper() == voter_id.upper():
-                        # Check if timestamp exists (new format) or use date (old format for backward compatibility)
-                        timestamp_str = row.get('timestamp', '')
-                        if timestamp_str:
-                            try:
-                                vote_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                                time_diff = current_time - vote_time
-                                # Check if voted within last 75 hours (75 * 3600 = 270,000 seconds)
-                                if time_diff.total_seconds() < (75 * 3600):  # 75 hours in seconds
-                                    return True
-                            except ValueError:
-                                # If timestamp parsing fails, fall back to date check
-                                pass
-                        else:
-                            # Backward compatibility: check by date if no timestamp
-                            vote_date = row.get('date', '')
-                            if vote_date:
-                                try:
-                                    vote_datetime = datetime.strptime(vote_date, '%Y-%m-%d')
-                                    time_diff = current_time - vote_datetime
-                                    # If old format, assume vote was at start of day, check if within 75 hours
-                                    if time_diff.total_seconds() < (75 * 3600):
-                                        return True
-                                except ValueError:
-                                    pass
-        except Exception as e:
-            print(f"Error checking daily votes: {e}")
-    return False
-
-# Mark voter as voted (with timestamp for 75-hour tracking)
-def mark_voted_today(voter_id):
-    today = datetime.now().strftime('%Y-%m-%d')
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(DAILY_VOTES_CSV, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([today, voter_id, 'yes', timestamp])
-
-# Save vote to CSV
-def save_vote(voter_id, name, state, constituency, candidate_name, party):
-    today = datetime.now().strftime('%Y-%m-%d')
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(VOTES_CSV, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([today, voter_id, name, state, constituency, candidate_name, party, timestamp])
+    try:
+        # Picks up votes recorded since the last check, including other workers'
+        vote_window.refresh()
+    except Exception as e:
+        logger.error("Error checking daily votes: %s", e)
+    return vote_window.has_voted(voter_id)
+
+# Daily votes row marking a voter as voted (with timestamp for 75-hour tracking)
+def voted_marker(voter_id, now):
+    return {
+        'date': now.strftime('%Y-%m-%d'),
+        'voter_id': voter_id,
+        'voted': 'yes',
+        'timestamp': now.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+# Votes row for a cast vote
+def vote_record(voter_id, name, state, constituency, candidate_name, party, now):
+    today = now.strftime('%Y-%m-%d')
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    return dict(zip(VOTE_FIELDS, [today, voter_id, name, state, constituency, candidate_name, party, timestamp]))
+
+# Record a vote and mark the voter as voted in one journaled commit.
+# Returns False if the voter already voted within the last 75 hours.
+def commit_vote(voter_id, name, state, constituency, candidate_name, party):
+    now = datetime.now()
+    with metrics.timer('vote_commit'):
+        accepted = vote_journal.commit(vote_record(voter_id, name, state, constituency, candidate_name, party, now),
+                                       voted_marker(voter_id, now))
+    if accepted:
+        vote_tally.refresh()
+    return accepted
 
 # Get votes for results
 def get_votes():
-    votes = {}
-    if os.path.exists(VOTES_CSV):
-        try:
-            with open(VOTES_CSV, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row.get('constituency') and row.get('candidate_name'):
-                        constituency = row['constituency']
-                        candidate = f"{row['candidate_name']} ({row['party']})"
-                        if constituency not in votes:
-                            votes[constituency] = {}
-                        if candidate not in votes[constituency]:
-                            votes[constituency][candidate] = 0
-                        votes[constituency][candidate] += 1
-        except Exception as e:
-            print(f"Error reading votes CSV: {e}")
-    return votes
-
-# Get vote log
-def get_vote_log():
-    log = []
-    if os.path.exists(VOTES_CSV):
-        try:
-            with open(VOTES_CSV, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row.get('voter_id'):  # Skip empty rows
-                        log.append(row)
-        except Exception as e:
-            print(f"Error reading vote log: {e}")
-    return log
+    try:
+        vote_tally.refresh()
+        return vote_tally.votes()
+    except Exception as e:
+        logger.error("Error reading votes: %s", e)
+        return {}
 
 # Get voter by ID
 def get_voter_by_id(voter_id):
-    voters = get_all_voters()
-    for v in voters:
-        if v['voter_id'].upper() == voter_id.upper():
-            return v
-    return None
+    return voter_registry.get(voter_id)
+
+# Start a fresh scan session for this booth, replacing any unfinished one
+def start_scan(data):
+    scan_sessions.discard(session.get('scan_token'))
+    session['scan_token'] = scan_sessions.create(data)
+
+# Data of this booth's scan session ({} if none or expired)
+def current_scan():
+    return scan_sessions.get(session.get('scan_token')) or {}
+
+def update_scan(**values):
+    return scan_sessions.update(session.get('scan_token'), **values)
+
+def end_scan():
+    scan_sessions.discard(session.pop('scan_token', None))
+
+# Cursor and page size from the query string; ValueError if the cursor is
+# not a non-negative integer
+def page_args():
+    cursor = int(request.args.get('cursor')) if request.args.get('cursor') else None
+    if cursor is not None and cursor < 0:
+        raise ValueError('Invalid cursor')
+    limit = int(request.args.get('limit') or ADMIN_PAGE_SIZE)
+    return cursor, min(max(limit, 1), ADMIN_PAGE_MAX)
+
+# Filters from the query string, e.g. query_filters('date', 'constituency')
+def query_filters(*names):
+    return {name: (request.args.get(name) or '').strip() or None for name in names}
+
+# Walk every page of a repository's page() so exports never hold more than one batch
+def iter_pages(fetch, **filters):
+    cursor = None
+    while True:
+        rows, cursor = fetch(cursor=cursor, limit=EXPORT_BATCH_SIZE, **filters)
+        yield from rows
+        if cursor is None:
+            return
+
+# Yield CSV text for rows, a batch at a time
+def csv_chunks(fields, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    count = 0
+    for row in rows:
+        writer.writerow([row.get(field, '') for field in fields])
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# Serve a pre-built catalogue body: 304 if the booth already has it,
+# gzipped when the client accepts it
+def cached_json(cached):
+    if cached is None:
+        return jsonify({'error': 'Not found'}), 404
+    if cached.etag in request.if_none_match:
+        response = Response(status=304)
+    elif cached.gzip_body is not None and 'gzip' in request.accept_encodings:
+        response = Response(cached.gzip_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(cached.body, mimetype='application/json')
+    response.set_etag(cached.etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Booths may keep the catalogue but must revalidate it on every use
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def csv_download(filename, fields, rows):
+    return Response(stream_with_context(csv_chunks(fields, rows)), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+# render_template, timed as the template_render stage
+def render(template_name, **context):
+    with metrics.timer('template_render'):
+        return render_template(template_name, **context)
+
+# Add voters appended to the roll to the template index, or rebuild it if
+# the roll was reloaded
+def sync_template_index(voters=None):
+    global template_index_source
+    with template_index_lock:
+        added = None
+        if template_index_source is not None:
+            generation, added = voter_registry.changes_since(*template_index_source)
+        if added is not None:
+            for voter in added:
+                template_index.add(voter['voter_id'], voter['template_base64'])
+            template_index_source = (generation, template_index_source[1] + len(added))
+        else:
+            if voters is None:
+                voters = voter_registry.voters()
+            template_index.build(voters)
+            template_index_source = (voter_registry.generation, len(voters))
+    template_store.sync(voter_registry)
+
+# Voters most likely to match a probe, or None if the index cannot help
+def shortlist_voters(template_base64, voters=None):
+    if not SHORTLIST_SIZE:
+        return None
+    sync_template_index(voters)
+    shortlist = template_index.shortlist(template_base64, SHORTLIST_SIZE)
+    if shortlist is None:
+        return None
+    return [voter for voter in map(voter_registry.get, shortlist) if voter is not None]
 
 # Check if biometric template already exists (prevent duplicate registration)
-def biometric_exists(template_base64):
+def biometric_exists(template_base64, fuzzy=None):
+    digest_index.sync(voter_registry)
+    if digest_index.lookup(template_base64):
+        return True
+    
+    if fuzzy is None:
+        fuzzy = DUPLICATE_CHECK_MODE == 'fuzzy'
+    return fuzzy and similar_voter(template_base64) is not None
+
+# Voter ID of an enrolled voter whose fingerprint matches this template
+# closely enough to be the same finger, or None
+def similar_voter(template_base64):
+    candidates = shortlist_voters(template_base64)
+    if candidates:
+        with metrics.timer('match'):
+            result = identification_engine.identify(template_base64, candidates)
+        if result['matched'] and result['score'] >= DUPLICATE_MATCH_THRESHOLD:
+            logger.info("Near-duplicate biometric of voter %s (score %d)", result['voter_id'], result['score'])
+            return result['voter_id']
+    return None
+
+# Identify the registered voter matching a probe template (1:N search)
+def identify_voter(probe_template):
     voters = get_all_voters()
-    for voter in voters:
-        if voter['template_base64'] == template_base64:
-            return True
-    return False
+    template_store.sync(voter_registry)
+    candidates = shortlist_voters(probe_template, voters)
+    with metrics.timer('match'):
+        if candidates is not None:
+            result = identification_engine.identify(probe_template, candidates)
+            if result['matched'] or not SHORTLIST_FALLBACK:
+                return result
+        return identification_engine.identify(probe_template, voters)
 
 # ========== DELETE FUNCTIONS ==========
 
 # Delete all daily votes data (keep header)
 def delete_daily_votes():
     try:
-        with open(DAILY_VOTES_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['date', 'voter_id', 'voted', 'timestamp'])
+        with vote_journal.exclusive():
+            storage.daily_votes.clear()
+            vote_window.clear()
         return True, "Daily votes data deleted successfully"
     except Exception as e:
         return False, f"Error deleting daily votes: {str(e)}"
@@ -270,9 +433,13 @@ def delete_daily_votes():
 # Delete all voters data (keep header)
 def delete_voters():
     try:
-        with open(VOTERS_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['voter_id', 'name', 'template_base64', 'bmp_base64', 'registration_date'])
+        storage.voters.clear()
+        template_index.clear()
+        blob_store.clear()
+        digest_index.clear()
+        template_store.clear()
+        if match_cache is not None:
+            match_cache.clear()
         return True, "Voters data deleted successfully"
     except Exception as e:
         return False, f"Error deleting voters: {str(e)}"
@@ -280,9 +447,9 @@ def delete_voters():
 # Delete all votes data (keep header)
 def delete_votes():
     try:
-        with open(VOTES_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['date', 'voter_id', 'name', 'state', 'constituency', 'candidate_name', 'party', 'timestamp'])
+        with vote_journal.exclusive():
+            storage.votes.clear()
+            vote_tally.clear()
         return True, "Votes data deleted successfully"
     except Exception as e:
         return False, f"Error deleting votes: {str(e)}"
@@ -290,18 +457,31 @@ def delete_votes():
 # Delete all candidates data (keep header)
 def delete_candidates():
     try:
-        with open(CANDIDATES_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['_id', 'State', 'Constituency', 'Party', 'Candidate Name'])
+        storage.candidates.clear()
+        candidate_catalogue.invalidate()
         return True, "Candidates data deleted successfully"
     except Exception as e:
         return False, f"Error deleting candidates: {str(e)}"
 
 # ========== ROUTES ==========
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.observe('vms_request_seconds', 'endpoint', request.endpoint or 'unknown',
+                        time.perf_counter() - started)
+    if SHARD_NAME:
+        response.headers['X-VMS-Shard'] = SHARD_NAME
+    return response
+
 @app.route('/')
 def home():
-    return render_template('home.html')
+    return render('home.html')
 
 # ========== REGISTRATION FLOW ==========
 
@@ -314,44 +494,77 @@ def register():
         'TemplateFormat': 'ISO',
         'ImageWSQRate': '0.75'
     }
-    return render_template('register.html', user_input=input_data)
+    return render('register.html', user_input=input_data)
 
 @app.route('/register_scan', methods=['POST'])
 def register_scan():
     ErrorNumber = get_int_form_value(request.form, 'ErrorCode', 0)
     if ErrorNumber > 0:
-        return render_template('error.html', error=ErrorNumber, errordescription=TranslateErrorNumber(ErrorNumber))
+        return render('error.html', error=ErrorNumber, errordescription=TranslateErrorNumber(ErrorNumber))
     
-    registration_data['template'] = request.form.get('TemplateBase64')
-    registration_data['BMPBase64'] = request.form.get('BMPBase64')
-    registration_data['Manufacturer'] = request.form.get('Manufacturer')
-    registration_data['Model'] = request.form.get('Model')
-    registration_data['SerialNumber'] = request.form.get('SerialNumber')
+    registration_data = {
+        'template': request.form.get('TemplateBase64'),
+        'BMPBase64': request.form.get('BMPBase64'),
+        'Manufacturer': request.form.get('Manufacturer'),
+        'Model': request.form.get('Model'),
+        'SerialNumber': request.form.get('SerialNumber')
+    }
+    start_scan(registration_data)
     
-    return render_template('register_form.html', metadata=registration_data)
+    return render('register_form.html', metadata=registration_data)
 
 @app.route('/save_registration', methods=['POST'])
 def save_registration():
     voter_id = request.form.get('voter_id', '').strip().upper()
     name = request.form.get('name', '').strip()
-    template_base64 = registration_data.get('template', '')
-    bmp_base64 = registration_data.get('BMPBase64', '')
+    registration_data = current_scan()
+    template_base64 = registration_data.get('template') or ''
+    bmp_base64 = registration_data.get('BMPBase64') or ''
     
     if not voter_id or not name or not template_base64:
-        return render_template('error.html', error=400, errordescription="Missing required information")
+        return render('error.html', error=400, errordescription="Missing required information")
     
     # Check if voter ID already exists
     if voter_id_exists(voter_id):
-        return render_template('error.html', error=409, errordescription=f"Voter ID {voter_id} is already registered")
+        return render('error.html', error=409, errordescription=f"Voter ID {voter_id} is already registered")
     
     # Check if biometric already exists
     if biometric_exists(template_base64):
-        return render_template('error.html', error=409, errordescription="This biometric is already registered with another voter ID")
+        return render('error.html', error=409, errordescription="This biometric is already registered with another voter ID")
     
     # Save voter
     save_voter(voter_id, name, template_base64, bmp_base64)
+    end_scan()
     
-    return render_template('registration_success.html', voter_id=voter_id, name=name)
+    return render('registration_success.html', voter_id=voter_id, name=name)
+
+# Duplicate check for a sharded deployment: the shard router asks every shard
+# before it forwards /save_registration, since each shard only knows its own
+# roll. Without a digest, the template of this booth's registration scan is used.
+# A JSON body {"records": [{"voter_id": ..., "digest": ...}]} checks a batch
+# of a bulk enrolment instead.
+@app.route('/enrolment_check', methods=['POST'])
+def enrolment_check():
+    digest_index.sync(voter_registry)
+    if request.is_json:
+        records = (request.get_json(silent=True) or {}).get('records') or []
+        return jsonify({'records': [
+            enrolment_status(str(record.get('voter_id') or '').strip().upper(), str(record.get('digest') or '').strip())
+            for record in records
+        ]})
+    voter_id = request.form.get('voter_id', '').strip().upper()
+    digest = request.form.get('digest', '').strip()
+    if not digest:
+        template_base64 = current_scan().get('template') or ''
+        digest = template_digest(template_base64) if template_base64 else ''
+    return jsonify(enrolment_status(voter_id, digest))
+
+def enrolment_status(voter_id, digest):
+    return {
+        'voter_id_exists': bool(voter_id) and voter_id_exists(voter_id),
+        'digest': digest or None,
+        'biometric_exists': bool(digest) and digest_index.lookup_digest(digest) is not None
+    }
 
 # ========== LOGIN FLOW ==========
 
@@ -364,21 +577,24 @@ def login():
         'TemplateFormat': 'ISO',
         'ImageWSQRate': '0.75'
     }
-    return render_template('login.html', user_input=input_data)
+    return render('login.html', user_input=input_data)
 
 @app.route('/login_scan1', methods=['POST'])
 def login_scan1():
     ErrorNumber = get_int_form_value(request.form, 'ErrorCode', 0)
     if ErrorNumber > 0:
-        return render_template('error.html', error=ErrorNumber, errordescription=TranslateErrorNumber(ErrorNumber))
+        return render('error.html', error=ErrorNumber, errordescription=TranslateErrorNumber(ErrorNumber))
     
-    login_scan_data['template1'] = request.form.get('TemplateBase64', '').strip()
-    login_scan_data['BMPBase64_1'] = request.form.get('BMPBase64', '').strip()
+    login_scan_data = {
+        'template1': request.form.get('TemplateBase64', '').strip(),
+        'BMPBase64_1': request.form.get('BMPBase64', '').strip()
+    }
     
-    print(f"Login scan1: Template1 length={len(login_scan_data.get('template1', ''))}, BMP1 length={len(login_scan_data.get('BMPBase64_1', ''))}")
+    logger.debug("Login scan1: template1 length=%d, BMP1 length=%d",
+                 len(login_scan_data['template1']), len(login_scan_data['BMPBase64_1']))
     
     if not login_scan_data['template1']:
-        return render_template('error.html', error=400, errordescription="Fingerprint template not captured. Please try again.")
+        return render('error.html', error=400, errordescription="Fingerprint template not captured. Please try again.")
     
     input_data = {
         'SecuGen_Lic': LIC_STR,
@@ -387,56 +603,88 @@ def login_scan1():
         'TemplateFormat': 'ISO',
         'ImageWSQRate': '0.75'
     }
-    return render_template('login_scan2.html', user_input=input_data, metadata1={'BMPBase64': login_scan_data['BMPBase64_1']})
+    start_scan(login_scan_data)
+    return render('login_scan2.html', user_input=input_data, metadata1={'BMPBase64': login_scan_data['BMPBase64_1']})
 
 @app.route('/login_scan2', methods=['POST'])
 def login_scan2():
     ErrorNumber = get_int_form_value(request.form, 'ErrorCode', 0)
     if ErrorNumber > 0:
-        return render_template('error.html', error=ErrorNumber, errordescription=TranslateErrorNumber(ErrorNumber))
+        return render('error.html', error=ErrorNumber, errordescription=TranslateErrorNumber(ErrorNumber))
     
+    login_scan_data = current_scan()
     login_scan_data['template2'] = request.form.get('TemplateBase64', '').strip()
     login_scan_data['BMPBase64_2'] = request.form.get('BMPBase64', '').strip()
+    login_scan_data.pop('identified', None)
     
-    print(f"Login scan2: Template2 length={len(login_scan_data.get('template2', ''))}, BMP2 length={len(login_scan_data.get('BMPBase64_2', ''))}")
-    print(f"Template1 from scan1 length={len(login_scan_data.get('template1', ''))}")
+    logger.debug("Login scan2: template1 length=%d, template2 length=%d, BMP2 length=%d",
+                 len(login_scan_data.get('template1', '')), len(login_scan_data['template2']),
+                 len(login_scan_data['BMPBase64_2']))
     
     # Validate templates exist
     if not login_scan_data.get('template1') or not login_scan_data.get('template2'):
-        return render_template('error.html', error=400, errordescription="Fingerprint templates missing. Please start login process again.")
+        return render('error.html', error=400, errordescription="Fingerprint templates missing. Please start login process again.")
+    update_scan(template2=login_scan_data['template2'], BMPBase64_2=login_scan_data['BMPBase64_2'], identified=None)
     
     # Ensure templates are passed correctly
     template1 = login_scan_data.get('template1', '')
     template2 = login_scan_data.get('template2', '')
     
-    return render_template('login_compare.html', 
+    return render('login_compare.html', 
                           template1=template1,
                           template2=template2,
                           metadata1={'BMPBase64': login_scan_data.get('BMPBase64_1', '')},
                           metadata2={'BMPBase64': login_scan_data.get('BMPBase64_2', '')},
                           user_input={'TemplateFormat': 'ISO', 'SecuGen_Lic': LIC_STR})
 
+@app.route('/identify', methods=['POST'])
+def identify():
+    """Match the probe captured by /login_scan2 against all voters"""
+    probe = current_scan().get('template2', '')
+    if not probe:
+        return jsonify({'error': 'No probe template. Please start login process again.'}), 400
+    
+    result = identify_voter(probe)
+    # Remember the server-side result so /login_verify does not trust client-supplied scores
+    update_scan(identified=result)
+    return jsonify(result)
+
 @app.route('/login_verify', methods=['POST'])
 def login_verify():
-    matched_voter_id = request.form.get('matched_voter_id', '').strip()
-    matching_score = get_int_form_value(request.form, 'MatchingScore', 0)
     error_code = get_int_form_value(request.form, 'ErrorCode', 0)
     
-    print(f"Login verify: voter_id={matched_voter_id}, score={matching_score}, error={error_code}")
-    
     if error_code > 0:
-        return render_template('error.html', error=error_code, errordescription=TranslateErrorNumber(error_code))
+        return render('error.html', error=error_code, errordescription=TranslateErrorNumber(error_code))
+    
+    login_scan_data = current_scan()
+    end_scan()
+    result = login_scan_data.get('identified')
+    if result is None:
+        probe = login_scan_data.get('template2', '')
+        if not probe:
+            return render('error.html', error=400, errordescription="Fingerprint templates missing. Please start login process again.")
+        result = identify_voter(probe)
+    
+    matched_voter_id = result['voter_id']
+    matching_score = result['score']
+    logger.info("Login verify: voter_id=%s, score=%d, checked=%d", matched_voter_id, matching_score, result['checked'],
+                extra={'voter_id': matched_voter_id, 'score': matching_score, 'checked': result['checked']})
     
-    # Lower threshold to 20 as requested by user
-    if not matched_voter_id or matching_score < 20:
-        return render_template('error.html', error=401, errordescription=f"Biometric verification failed. Matching score: {matching_score} (minimum required: 20). Please try again.")
+    if result['error_code'] > 0:
+        return render('error.html', error=result['error_code'], errordescription=TranslateErrorNumber(result['error_code']))
+    
+    if not result['matched'] or matching_score < MATCH_THRESHOLD:
+        return render('error.html', error=401, errordescription=f"Biometric verification failed. Matching score: {matching_score} (minimum required: {MATCH_THRESHOLD}). Please try again.")
     
     # Check if already voted within last 75 hours
     if has_voted_today(matched_voter_id):
-        return render_template('error.html', error=403, errordescription="You have already voted recently. You can only vote once every 75 hours.")
+        return render('error.html', error=403, errordescription="You have already voted recently. You can only vote once every 75 hours.")
     
-    # Store in session for voting flow
+    # Store in session for voting flow; the shard router sends /cast_vote to
+    # the shard that verified the voter
     session['voter_id'] = matched_voter_id
+    if SHARD_NAME:
+        session['shard'] = SHARD_NAME
     voter = get_voter_by_id(matched_voter_id)
     if voter:
         session['voter_name'] = voter['name']
@@ -451,50 +699,63 @@ def voting_system():
     if 'voter_id' not in session:
         return redirect(url_for('login'))
     
-    return render_template('voting_system.html', voter_id=session.get('voter_id'), voter_name=session.get('voter_name', ''))
+    return render('voting_system.html', voter_id=session.get('voter_id'), voter_name=session.get('voter_name', ''))
 
 @app.route('/get_candidates_json', methods=['GET'])
 def get_candidates_json():
-    candidates = []
-    if os.path.exists(CANDIDATES_CSV):
-        try:
-            with open(CANDIDATES_CSV, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row.get('State') or row.get('Candidate Name'):  # Skip empty rows
-                        candidates.append(row)
-        except Exception as e:
-            print(f"Error reading candidates CSV: {e}")
-    return jsonify(candidates)
+    try:
+        return cached_json(candidate_catalogue.all())
+    except Exception as e:
+        logger.error("Error reading candidates: %s", e)
+        return jsonify([])
+
+# State -> constituencies index used to fill the booth dropdowns
+@app.route('/candidates', methods=['GET'])
+def candidates_index():
+    return cached_json(candidate_catalogue.index())
+
+@app.route('/candidates/<state>', methods=['GET'])
+def candidates_for_state(state):
+    return cached_json(candidate_catalogue.state(state))
+
+@app.route('/candidates/<state>/<constituency>', methods=['GET'])
+def candidates_for_constituency(state, constituency):
+    return cached_json(candidate_catalogue.constituency(state, constituency))
 
 @app.route('/cast_vote', methods=['POST'])
 def cast_vote():
     if 'voter_id' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     
-    voter_id = session['voter_id']
-    voter_name = session.get('voter_name', '')
-    
+    payload, status = record_cast_vote(session['voter_id'], session.get('voter_name', ''), request.json)
+    if status == 200:
+        # Clear session
+        session.clear()
+    return jsonify(payload), status
+
+# Body of /cast_vote for a logged-in voter (shared with asgi.py); returns
+# (JSON payload, HTTP status)
+def record_cast_vote(voter_id, voter_name, data):
     # Check if already voted within last 75 hours
     if has_voted_today(voter_id):
-        return jsonify({'error': 'Already voted within the last 75 hours'}), 403
+        return {'error': 'Already voted within the last 75 hours'}, 403
     
-    data = request.json
+    data = data or {}
     state = data.get('state', '')
     constituency = data.get('constituency', '')
     candidate_name = data.get('candidate_name', '')
     party = data.get('party', '')
     
-    # Save vote
-    save_vote(voter_id, voter_name, state, constituency, candidate_name, party)
-    
-    # Mark as voted (within 75-hour window)
-    mark_voted_today(voter_id)
-    
-    # Clear session
-    session.clear()
-    
-    return jsonify({'success': True, 'message': 'Vote recorded successfully'})
+    # Save vote and mark as voted in a single commit; the 75-hour check is
+    # repeated inside it so concurrent requests cannot both succeed
+    try:
+        accepted = commit_vote(voter_id, voter_name, state, constituency, candidate_name, party)
+    except Exception as e:
+        logger.exception("Error recording vote: %s", e)
+        return {'error': 'Could not record vote. Please try again.'}, 500
+    if not accepted:
+        return {'error': 'Already voted within the last 75 hours'}, 403
+    return {'success': True, 'message': 'Vote recorded successfully'}, 200
 
 # ========== ADMIN PANEL ==========
 
@@ -506,19 +767,19 @@ def admin_login():
             session['admin'] = True
             return redirect(url_for('admin_panel'))
         else:
-            return render_template('admin_login.html', error='Invalid password')
-    return render_template('admin_login.html')
+            return render('admin_login.html', error='Invalid password')
+    return render('admin_login.html')
 
 @app.route('/admin_panel', methods=['GET'])
 def admin_panel():
     if not session.get('admin'):
         return redirect(url_for('admin_login'))
     
-    voters = get_all_voters()
     votes = get_votes()
-    vote_log = get_vote_log()
     
-    return render_template('admin_panel.html', voters=voters, votes=votes, vote_log=vote_log)
+    # Voter list and vote log are fetched page by page from /admin/voters and /admin/votes
+    return render('admin_panel.html', voter_count=len(get_all_voters()), votes=votes,
+                           page_size=ADMIN_PAGE_SIZE)
 
 @app.route('/admin/logout', methods=['POST'])
 def admin_logout():
@@ -538,12 +799,50 @@ def upload_candidates():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and file.filename.endswith('.csv'):
-        # Save uploaded CSV
-        file.save(CANDIDATES_CSV)
-        return jsonify({'success': True, 'message': 'Candidates uploaded successfully'})
+        # Validate while streaming the rows in; the old list stays unless every row is valid
+        report = import_candidates(file.stream, storage.candidates)
+        if not report.ok:
+            return jsonify({
+                'error': f'{report.error_count} problem(s) found; candidate list not changed',
+                'report': report.as_dict()
+            }), 400
+        # Rebuild the booth catalogue now rather than on the first booth request
+        candidate_catalogue.invalidate()
+        candidate_catalogue.refresh()
+        return jsonify({
+            'success': True,
+            'message': f'{report.imported} candidates uploaded successfully',
+            'report': report.as_dict()
+        })
     
     return jsonify({'error': 'Invalid file format'}), 400
 
+@app.route('/admin/bulk_enrol', methods=['POST'])
+def admin_bulk_enrol():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    file = request.files.get('file')
+    if not file or not file.filename.endswith('.csv'):
+        return jsonify({'error': 'Please upload a CSV file'}), 400
+    
+    digest_index.sync(voter_registry)
+    sync_template_index()
+    fuzzy = DUPLICATE_CHECK_MODE == 'fuzzy'
+    enroller = BulkEnroller(voter_registry, blob_store, digest_index, template_index,
+                            find_similar=similar_voter if fuzzy else None, engine=identification_engine,
+                            duplicate_threshold=DUPLICATE_MATCH_THRESHOLD, template_store=template_store)
+    text = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+    try:
+        report = enroller.enrol(read_enrolment_csv(text))
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': f'Could not read file: {e}'}), 400
+    finally:
+        text.detach()
+    template_store.flush()
+    logger.info("Bulk enrolment finished", extra=report.summary())
+    return jsonify({'success': True, 'summary': report.summary(), 'rejected': report.rejected()})
+
 @app.route('/admin/delete_daily_votes', methods=['POST'])
 def admin_delete_daily_votes():
     if not session.get('admin'):
@@ -588,51 +887,225 @@ def admin_delete_candidates():
     else:
         return jsonify({'error': message}), 500
 
+@app.route('/admin/voter_image/<voter_id>', methods=['GET'])
+def admin_voter_image(voter_id):
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    voter = get_voter_by_id(voter_id)
+    image = blob_store.get(voter['bmp_hash']) if voter else None
+    if image is None:
+        return jsonify({'error': 'Image not found'}), 404
+    return Response(image, mimetype='image/bmp')
+
+@app.route('/admin/cache_stats', methods=['GET'])
+def admin_cache_stats():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify({
+        'shard': SHARD_NAME or None,
+        'voter_registry': voter_registry.stats(),
+        'template_index': template_index.stats(),
+        'template_store': template_store.stats(),
+        'warm_state': warm_state.stats() if warm_state is not None else None,
+        'vote_tally': vote_tally.stats(),
+        'results_feed': results_feed.stats(),
+        'candidate_catalogue': candidate_catalogue.stats(),
+        'scan_sessions': scan_sessions.stats(),
+        'match_service': identification_engine.matcher.stats()
+            if hasattr(identification_engine.matcher, 'stats') else None,
+        'match_cache': match_cache.stats() if match_cache is not None else None,
+        'timings': metrics.snapshot()
+    })
+
+# Latency histograms in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    authorized = session.get('admin') or \
+        (METRICS_TOKEN and request.headers.get('Authorization', '') == f'Bearer {METRICS_TOKEN}')
+    if not authorized:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/results', methods=['GET'])
+def admin_results():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return Response(results_json(), mimetype='application/json')
+
+# Server-Sent Events: the full results, then the changed constituencies
+# as votes are committed (see results_feed.py)
+@app.route('/admin/results/stream', methods=['GET'])
+def admin_results_stream():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return Response(results_feed.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/admin/voters', methods=['GET'])
+def admin_voters_page():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        cursor, limit = page_args()
+        voters, next_cursor = voter_registry.page(cursor, limit, **query_filters('voter_id', 'date'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor or limit'}), 400
+    return jsonify({
+        'voters': [{field: voter.get(field, '') for field in VOTER_EXPORT_FIELDS} for voter in voters],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/admin/votes', methods=['GET'])
+def admin_votes_page():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        cursor, limit = page_args()
+        votes, next_cursor = storage.votes.page(cursor, limit, **query_filters('date', 'constituency', 'voter_id'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor or limit'}), 400
+    return jsonify({'votes': votes, 'next_cursor': next_cursor})
+
+@app.route('/admin/voters.csv', methods=['GET'])
+def admin_export_voters():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    voters = iter_pages(voter_registry.page, **query_filters('voter_id', 'date'))
+    return csv_download('voters.csv', VOTER_EXPORT_FIELDS, voters)
+
+@app.route('/admin/votes.csv', methods=['GET'])
+def admin_export_votes():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    votes = iter_pages(storage.votes.page, **query_filters('date', 'constituency', 'voter_id'))
+    return csv_download('votes.csv', VOTE_FIELDS, votes)
+
+# All votes as a compressed columnar snapshot (see vote_snapshot.py) for
+# archiving and audit tools
+@app.route('/admin/votes.snapshot', methods=['GET'])
+def admin_export_vote_snapshot():
+    if not session.get('admin'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    fd, path = tempfile.mkstemp(prefix='.votes-', suffix='.snapshot', dir='.')
+    os.close(fd)
+    try:
+        write_snapshot(path, storage.votes.log())
+        with open(path, 'rb') as f:
+            data = f.read()
+    finally:
+        os.remove(path)
+    return Response(data, mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename=votes.snapshot'})
+
 @app.route('/get_voters_json', methods=['GET'])
 def get_voters_json():
     """API endpoint for frontend to get all voters for biometric comparison"""
     try:
-        voters = get_all_voters()
-        print(f"get_voters_json: Total voters from CSV: {len(voters)}")
-        
-        if not voters or len(voters) == 0:
-            print("WARNING: No voters found in CSV file!")
-            return jsonify([])
-        
-        # Filter and validate voters with templates
-        valid_voters = []
-        for voter in voters:
-            template = voter.get('template_base64', '')
-            voter_id = voter.get('voter_id', '')
-            
-            if voter_id and template and len(template.strip()) > 10:
-                valid_voters.append({
-                    'voter_id': voter_id,
-                    'name': voter.get('name', ''),
-                    'template_base64': template.strip(),
-                    'bmp_base64': voter.get('bmp_base64', ''),
-                    'registration_date': voter.get('registration_date', '')
-                })
-        
-        print(f"get_voters_json: Valid voters with templates: {len(valid_voters)}")
-        
-        # Log first few voters for debugging
-        for i, voter in enumerate(valid_voters[:3]):
-            template_len = len(voter.get('template_base64', ''))
-            print(f"Voter {i+1}: ID={voter.get('voter_id')}, Name={voter.get('name')}, Template length={template_len}")
-        
-        if len(valid_voters) == 0:
-            print("WARNING: No valid voters with templates found!")
-        
-        return jsonify(valid_voters)
+        return Response(voters_json(), mimetype='application/json')
     except Exception as e:
-        print(f"ERROR in get_voters_json: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_voters_json")
         return jsonify({'error': str(e), 'voters': []}), 500
 
-# Initialize CSV files on startup
-init_csv_files()
+# JSON bodies of /get_voters_json and /admin/results, encoded once per
+# change of the roll or the tally (shared with asgi.py)
+_voters_json = (None, b'')
+_results_json = (None, b'')
+
+def voters_json():
+    global _voters_json
+    voters = get_all_voters()
+    key = (voter_registry.generation, len(voters))
+    if _voters_json[0] == key:
+        return _voters_json[1]
+    if not voters:
+        logger.warning("get_voters_json: no voters registered")
+    
+    # Filter and validate voters with templates
+    valid_voters = []
+    for voter in voters:
+        template = voter.get('template_base64', '')
+        voter_id = voter.get('voter_id', '')
+        
+        if voter_id and template and len(template.strip()) > 10:
+            valid_voters.append({
+                'voter_id': voter_id,
+                'name': voter.get('name', ''),
+                'template_base64': template.strip(),
+                'registration_date': voter.get('registration_date', '')
+            })
+    
+    logger.debug("get_voters_json: %d of %d voters have templates", len(valid_voters), len(voters))
+    body = json.dumps(valid_voters).encode('utf-8')
+    _voters_json = (key, body)
+    return body
+
+def results_json():
+    global _results_json
+    try:
+        vote_tally.refresh()
+    except Exception as e:
+        logger.error("Error refreshing vote tally: %s", e)
+    results = vote_tally.results()
+    if _results_json[0] != results['version']:
+        _results_json = (results['version'], json.dumps(results).encode('utf-8'))
+    return _results_json[1]
+
+# (tally version, encoded results) for the results feed
+def results_snapshot():
+    results_json()
+    return _results_json
+
+# Write the warm state; on a read-only filesystem (e.g. Vercel) the next
+# start simply rebuilds everything. Not under template_index_lock, so exit is
+# not held up by a build in progress: a partly built index does not cover
+# the roll and is discarded by the next restore.
+def save_warm_state():
+    if warm_state is None:
+        return
+    try:
+        warm_state.save(index_current=template_index_source ==
+                        (voter_registry.generation, voter_registry.stats()['voters']))
+    except OSError as e:
+        logger.warning("Could not save warm state %s: %s", warm_state.path, e)
+
+# Build what the warm state did not cover (roll, template index, digest
+# index, template store), then save the warm state if it was out of date
+def warm_up():
+    started = time.perf_counter()
+    try:
+        sync_template_index()
+        digest_index.sync(voter_registry)
+    except Exception:
+        logger.exception("Warm-up failed; indexes will be built on first use")
+        return
+    logger.info("Warm-up finished in %.2f s", time.perf_counter() - started)
+    if warm_state is not None and warm_state.stale:
+        save_warm_state()
+
+# Initialize storage on startup
+init_storage()
+vote_journal.recover()
+vote_tally.load()
+vote_tally.refresh()
+vote_tally.save()
+if warm_state is not None and warm_state.restore():
+    template_index_source = (voter_registry.generation, voter_registry.stats()['voters'])
+# Write out templates enrolled since the last rewrite
+atexit.register(template_store.flush)
+atexit.register(save_warm_state)
+vote_window.refresh()
+if WARM_UP:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
 if __name__ == '__main__':
     app.run(debug=True)
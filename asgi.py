@@ -0,0 +1,511 @@
+"""ASGI entry point: the hot routes without a worker thread per request.
+
+Under ``app.run`` every request holds a thread from the moment its first
+byte arrives until the last byte is sent, including while it waits on a
+disk read, a vote commit or SGIMatchScore. Here the event loop owns the
+connections, and request threads are only used for the blocking work:
+
+- /get_candidates_json, /get_voters_json and /admin/results check and
+  serve pre-encoded bodies; refreshing them from the stores runs in the
+  file executor
+- /cast_vote runs its 75-hour check and journaled commit in the file
+  executor
+- /identify and /login_verify run the 1:N search in the match executor,
+  a separate pool, so booths waiting on the match service cannot starve
+  votes and catalogue requests of threads; /login_verify then finishes in
+  the Flask view with the stored result
+- every other route runs the Flask app in the WSGI executor
+
+Pool sizes: ASGI_FILE_WORKERS (default 8), ASGI_MATCH_WORKERS (8) and
+ASGI_WSGI_WORKERS (16). Any ASGI server can serve ``application``, e.g.
+``uvicorn asgi:application``; ``python asgi.py`` runs a small built-in
+HTTP/1.1 server, enough for a booth LAN and the benchmarks.
+
+    python asgi.py --host 0.0.0.0 --port 5000
+"""
+import argparse
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie, parse_accept_header, parse_etags, quote_etag
+
+import app as vms
+from results_feed import HEARTBEAT, HEARTBEAT_SECONDS
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+FILE_WORKERS = int(os.environ.get('ASGI_FILE_WORKERS', '8'))
+MATCH_WORKERS = int(os.environ.get('ASGI_MATCH_WORKERS', '8'))
+WSGI_WORKERS = int(os.environ.get('ASGI_WSGI_WORKERS', '16'))
+# Largest request body accepted (bulk enrolment files carry images)
+MAX_BODY_BYTES = 512 * 2**20
+
+file_executor = ThreadPoolExecutor(max_workers=FILE_WORKERS, thread_name_prefix='asgi-file')
+match_executor = ThreadPoolExecutor(max_workers=MATCH_WORKERS, thread_name_prefix='asgi-match')
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_WORKERS, thread_name_prefix='asgi-wsgi')
+
+
+async def run_in(executor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    if kwargs:
+        return await loop.run_in_executor(executor, lambda: fn(*args, **kwargs))
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+# ========== REQUESTS AND RESPONSES ==========
+
+class Request:
+    def __init__(self, scope, body, receive=None):
+        self.scope = scope
+        self.body = body
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            self.headers[name] = f"{self.headers[name]}, {value}" if name in self.headers else value
+        self._session = None
+
+    def form(self):
+        if not self.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            return {}
+        return {key: values[0] for key, values in
+                urllib.parse.parse_qs(self.body.decode('utf-8', 'replace'), keep_blank_values=True).items()}
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError:
+            return None
+
+    # The Flask session, read from its signed cookie (read-only)
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = {}
+            cookie = SimpleCookie()
+            try:
+                cookie.load(self.headers.get('cookie', ''))
+            except Exception:
+                return self._session
+            morsel = cookie.get(vms.app.config['SESSION_COOKIE_NAME'])
+            serializer = vms.app.session_interface.get_signing_serializer(vms.app)
+            if morsel is not None and serializer is not None:
+                try:
+                    max_age = int(vms.app.permanent_session_lifetime.total_seconds())
+                    self._session = serializer.loads(morsel.value, max_age=max_age)
+                except BadSignature:
+                    pass
+        return self._session
+
+
+async def respond(send, status, body, content_type='application/json', headers=()):
+    header_list = [(b'content-type', content_type.encode('latin-1')),
+                   (b'content-length', str(len(body)).encode('latin-1'))]
+    header_list += [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    if vms.SHARD_NAME:
+        header_list.append((b'x-vms-shard', vms.SHARD_NAME.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': header_list})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def respond_json(send, status, payload, headers=()):
+    await respond(send, status, json.dumps(payload).encode('utf-8'), headers=headers)
+
+
+# Set-Cookie header that removes the Flask session, as Flask does when a
+# view clears it
+def clear_session_cookie():
+    config = vms.app.config
+    return ('Set-Cookie', dump_cookie(
+        config['SESSION_COOKIE_NAME'], '', max_age=0, expires=0, path=config['SESSION_COOKIE_PATH'] or '/',
+        domain=config['SESSION_COOKIE_DOMAIN'], secure=config['SESSION_COOKIE_SECURE'],
+        httponly=config['SESSION_COOKIE_HTTPONLY'], samesite=config['SESSION_COOKIE_SAMESITE']))
+
+
+# ========== HOT ROUTES ==========
+
+async def get_candidates_json(request, send):
+    try:
+        cached = await run_in(file_executor, vms.candidate_catalogue.all)
+    except Exception as e:
+        logger.error("Error reading candidates: %s", e)
+        await respond(send, 200, b'[]')
+        return
+    headers = [('ETag', quote_etag(cached.etag)), ('Vary', 'Accept-Encoding'), ('Cache-Control', 'no-cache')]
+    if parse_etags(request.headers.get('if-none-match')).contains(cached.etag):
+        await send({'type': 'http.response.start', 'status': 304,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': b''})
+    elif cached.gzip_body is not None and 'gzip' in parse_accept_header(request.headers.get('accept-encoding')):
+        await respond(send, 200, cached.gzip_body, headers=headers + [('Content-Encoding', 'gzip')])
+    else:
+        await respond(send, 200, cached.body, headers=headers)
+
+
+async def get_voters_json(request, send):
+    try:
+        body = await run_in(file_executor, vms.voters_json)
+    except Exception as e:
+        logger.exception("Error in get_voters_json")
+        await respond_json(send, 500, {'error': str(e), 'voters': []})
+        return
+    await respond(send, 200, body)
+
+
+async def admin_results(request, send):
+    if not request.session.get('admin'):
+        await respond_json(send, 401, {'error': 'Unauthorized'})
+        return
+    await respond(send, 200, await run_in(file_executor, vms.results_json))
+
+
+# Live results (results_feed.py); the feed thread hands each event to the
+# loop, so an observer holds no worker thread while it waits
+async def admin_results_stream(request, send):
+    if not request.session.get('admin'):
+        await respond_json(send, 401, {'error': 'Unauthorized'})
+        return
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    lagged = False
+
+    def deliver(event):
+        nonlocal lagged
+        if events.qsize() >= vms.results_feed.backlog:
+            lagged = True
+        else:
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+    token, first = await run_in(file_executor, vms.results_feed.subscribe, deliver)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        headers = [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                   (b'x-accel-buffering', b'no')]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': first, 'more_body': True})
+        while not disconnected.done():
+            try:
+                event = await asyncio.wait_for(events.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                event = HEARTBEAT
+            if lagged:
+                lagged = False
+                while not events.empty():
+                    events.get_nowait()
+                event = await run_in(file_executor, vms.results_feed.snapshot_event)
+            await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+    finally:
+        vms.results_feed.unsubscribe(token)
+        disconnected.cancel()
+
+
+async def wait_for_disconnect(request):
+    while True:
+        message = await request.receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def cast_vote(request, send):
+    session = request.session
+    if 'voter_id' not in session:
+        await respond_json(send, 401, {'error': 'Not logged in'})
+        return
+    payload, status = await run_in(file_executor, vms.record_cast_vote, session['voter_id'],
+                                   session.get('voter_name', ''), request.json())
+    await respond_json(send, status, payload, headers=[clear_session_cookie()] if status == 200 else [])
+
+
+# Scan session of this booth and its token
+async def current_scan(request):
+    token = request.session.get('scan_token')
+    scan = await run_in(file_executor, vms.scan_sessions.get, token) if token else None
+    return token, scan or {}
+
+
+async def identify(request, send):
+    token, scan = await current_scan(request)
+    probe = scan.get('template2', '')
+    if not probe:
+        await respond_json(send, 400, {'error': 'No probe template. Please start login process again.'})
+        return
+    result = await run_in(match_executor, vms.identify_voter, probe)
+    if token:
+        await run_in(file_executor, vms.scan_sessions.update, token, identified=result)
+    await respond_json(send, 200, result)
+
+
+# Run the search the view would otherwise do in its own thread, then let
+# the Flask view check the stored result and start the voting session
+async def login_verify(request, send):
+    if vms.get_int_form_value(request.form(), 'ErrorCode', 0) <= 0:
+        token, scan = await current_scan(request)
+        if token and scan.get('identified') is None and scan.get('template2'):
+            result = await run_in(match_executor, vms.identify_voter, scan['template2'])
+            await run_in(file_executor, vms.scan_sessions.update, token, identified=result)
+    await call_wsgi(request, send)
+
+
+# (method, path) -> (handler, Flask endpoint name for the request metrics)
+ROUTES = {
+    ('GET', '/get_candidates_json'): (get_candidates_json, 'get_candidates_json'),
+    ('GET', '/get_voters_json'): (get_voters_json, 'get_voters_json'),
+    ('GET', '/admin/results'): (admin_results, 'admin_results'),
+    ('GET', '/admin/results/stream'): (admin_results_stream, None),
+    ('POST', '/cast_vote'): (cast_vote, 'cast_vote'),
+    ('POST', '/identify'): (identify, 'identify'),
+    ('POST', '/login_verify'): (login_verify, None),
+}
+
+
+# ========== WSGI FALLBACK ==========
+
+def wsgi_environ(request):
+    scope = request.scope
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(request.body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+        else:
+            environ[f'HTTP_{key}'] = value
+    return environ
+
+
+# Run the Flask app in the WSGI executor; a streamed body (CSV exports) is
+# pulled one chunk at a time. Every call runs in the same copied context, so
+# the app context that stream_with_context pushes is still there when the
+# next chunk is pulled on another executor thread.
+async def call_wsgi(request, send):
+    started = {}
+    context = contextvars.copy_context()
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def first_chunk():
+        body = vms.app.wsgi_app(wsgi_environ(request), start_response)
+        iterator = iter(body)
+        return body, iterator, next(iterator, None)
+
+    body, iterator, chunk = await run_in(wsgi_executor, context.run, first_chunk)
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        if chunk is None:
+            await send({'type': 'http.response.body', 'body': b''})
+        while chunk is not None:
+            following = await run_in(wsgi_executor, context.run, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': following is not None})
+            chunk = following
+    finally:
+        if hasattr(body, 'close'):
+            await run_in(wsgi_executor, context.run, body.close)
+
+
+# ========== APPLICATION ==========
+
+async def read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        if size > MAX_BODY_BYTES:
+            raise ValueError('Request body too large')
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                vms.template_store.flush()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    try:
+        body = await read_body(receive)
+    except ValueError:
+        await respond_json(send, 413, {'error': 'Request body too large'})
+        return
+    if body is None:
+        return
+    request = Request(scope, body, receive)
+    handler, endpoint = ROUTES.get((request.method, request.path), (None, None))
+    if handler is None:
+        await call_wsgi(request, send)
+        return
+    start = time.perf_counter()
+    await handler(request, send)
+    if endpoint:
+        metrics.observe('vms_request_seconds', 'endpoint', endpoint, time.perf_counter() - start)
+
+
+# ========== BUILT-IN SERVER ==========
+
+# Minimal HTTP/1.1 server for `application`: keep-alive, Content-Length
+# request bodies, chunked responses when the length is not known
+async def handle_connection(reader, writer):
+    peer = writer.get_extra_info('peername') or ('', 0)
+    sock = writer.get_extra_info('sockname') or ('', 0)
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                break
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+            header_map = dict(headers)
+            connection = header_map.get(b'connection', b'').lower()
+            keep_alive = connection != b'close' if version == 'HTTP/1.1' else connection == b'keep-alive'
+            length = int(header_map.get(b'content-length', b'0') or 0)
+            if length > MAX_BODY_BYTES:
+                writer.write(b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                break
+            body = await reader.readexactly(length) if length else b''
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version.partition('/')[2],
+                'method': method.upper(), 'scheme': 'http', 'path': urllib.parse.unquote(path),
+                'raw_path': path.encode('latin-1'), 'query_string': query.encode('latin-1'), 'root_path': '',
+                'headers': headers, 'client': tuple(peer[:2]), 'server': tuple(sock[:2]),
+            }
+            delivered = False
+
+            async def receive():
+                nonlocal delivered
+                if not delivered:
+                    delivered = True
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                # Only long responses (the results stream) wait past the
+                # body, for the client to hang up
+                while await reader.read(4096):
+                    pass
+                return {'type': 'http.disconnect'}
+
+            state = {'chunked': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    response_headers = list(message.get('headers', []))
+                    has_length = any(name == b'content-length' for name, _ in response_headers)
+                    nonlocal keep_alive
+                    if not has_length:
+                        if version == 'HTTP/1.1':
+                            state['chunked'] = True
+                            response_headers.append((b'transfer-encoding', b'chunked'))
+                        else:
+                            keep_alive = False
+                    if not keep_alive:
+                        response_headers.append((b'connection', b'close'))
+                    status = message['status']
+                    try:
+                        reason = HTTPStatus(status).phrase
+                    except ValueError:
+                        reason = ''
+                    head = [f'HTTP/1.1 {status} {reason}\r\n'.encode('latin-1')]
+                    head += [name + b': ' + value + b'\r\n' for name, value in response_headers]
+                    writer.write(b''.join(head) + b'\r\n')
+                elif message['type'] == 'http.response.body':
+                    data = message.get('body', b'')
+                    more = message.get('more_body', False)
+                    if state['chunked']:
+                        if data:
+                            writer.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
+                        if not more:
+                            writer.write(b'0\r\n\r\n')
+                    elif data:
+                        writer.write(data)
+                    await writer.drain()
+
+            try:
+                await application(scope, receive, send)
+            except ConnectionError:
+                raise
+            except Exception:
+                logger.exception("Unhandled error serving %s %s", method, path)
+                writer.write(b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                break
+            if not keep_alive:
+                break
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_connection, host, port, backlog=1024)
+    logger.info("Serving ASGI app on http://%s:%d", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the app with the async entry point')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        vms.template_store.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
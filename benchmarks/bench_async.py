@@ -0,0 +1,270 @@
+"""Connections served per core at a fixed p99: asgi.py against app.run.
+
+Writes a synthetic election (bench_election.generate_election), starts a
+fake SgiBioSrv with --fake-latency-ms per comparison, and serves the same
+directory twice in turn: with ``app.app.run(threaded=True)`` and with
+``python asgi.py``. An asyncio client then holds N open connections, each
+sending the hot-route mix back to back for --seconds:
+
+- GET /get_candidates_json (revalidated with If-None-Match)
+- POST /login_scan1 and /login_scan2 with a re-scan of an enrolled voter,
+  then POST /identify in the same scan session (scored by the fake service)
+- POST /cast_vote from a voter session (the cookie is signed with the
+  server's SECRET_KEY)
+- GET /admin/results
+
+N grows over --connections. For every server and N it reports req/s, p50
+and p99; the last column is the largest N whose p99 stays under --p99-ms,
+divided by the number of cores.
+
+    python benchmarks/bench_async.py --voters 5000 --connections 8,32,128,256 --p99-ms 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from flask import Flask
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from bench_election import generate_election, percentile, voter_id  # noqa: E402
+from fake_sgibiosrv import FakeSgiBioSrv  # noqa: E402
+from matcher import perturb_template, synthetic_template  # noqa: E402
+from shard_router import stop_local_shards, wait_for_shard  # noqa: E402
+
+PORT = 5301
+SECRET_KEY = 'bench-async-secret'
+SERVERS = {
+    'wsgi': [sys.executable, '-c', f'import app; app.app.run(host="127.0.0.1", port={PORT}, threaded=True)'],
+    'asgi': [sys.executable, os.path.join(REPO_DIR, 'asgi.py'), '--host', '127.0.0.1', '--port', str(PORT)],
+}
+MIX = ['candidates', 'identify', 'cast_vote', 'results']
+
+
+# Signed Flask session cookie the servers accept
+def session_cookie(data):
+    signer = Flask(__name__)
+    signer.secret_key = SECRET_KEY
+    return 'session=' + signer.session_interface.get_signing_serializer(signer).dumps(data)
+
+
+class Workload:
+    def __init__(self, voters, candidates, seed):
+        self.rng = random.Random(seed)
+        self.voters = voters
+        self.candidates = candidates
+        self.admin = session_cookie({'admin': True})
+        self.etag = None
+        # Voters who have not voted yet (the first half of the roll)
+        self.next_voter = 0
+
+    # The requests of one step of the mix, sent in order; each one carries
+    # the session cookie set by the one before
+    def requests(self, kind):
+        if kind == 'candidates':
+            headers = {'If-None-Match': self.etag} if self.etag else {}
+            return [('GET', '/get_candidates_json', headers, b'')]
+        if kind == 'identify':
+            i = self.rng.randrange(self.voters)
+            form = {'Content-Type': 'application/x-www-form-urlencoded'}
+            scan = urllib.parse.urlencode({'TemplateBase64': perturb_template(synthetic_template(i),
+                                                                              self.rng.randrange(10**9)),
+                                           'BMPBase64': ''}).encode('ascii')
+            return [('POST', '/login_scan1', form, scan), ('POST', '/login_scan2', form, scan),
+                    ('POST', '/identify', form, b'')]
+        if kind == 'cast_vote':
+            i = self.next_voter % (self.voters // 2)
+            self.next_voter += 1
+            _id, state, constituency, party, name = self.candidates[i % len(self.candidates)]
+            body = json.dumps({'state': state, 'constituency': constituency, 'candidate_name': name, 'party': party})
+            cookie = session_cookie({'voter_id': voter_id(i), 'voter_name': f'Voter {i}'})
+            return [('POST', '/cast_vote', {'Content-Type': 'application/json', 'Cookie': cookie},
+                     body.encode('utf-8'))]
+        return [('GET', '/admin/results', {'Cookie': self.admin}, b'')]
+
+
+# One HTTP/1.1 exchange; returns (status, headers, body, keep_alive)
+async def exchange(reader, writer, method, path, headers, body):
+    lines = [f'{method} {path} HTTP/1.1', f'Host: 127.0.0.1:{PORT}', f'Content-Length: {len(body)}']
+    lines += [f'{key}: {value}' for key, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    version, status = status_line.decode('latin-1').split()[:2]
+    response_headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        response_headers[key.strip().lower()] = value.strip()
+    if 'content-length' in response_headers:
+        data = await reader.readexactly(int(response_headers['content-length']))
+    elif response_headers.get('transfer-encoding') == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            chunks.append(await reader.readexactly(size + 2))
+            if size == 0:
+                break
+        data = b''.join(chunk[:-2] for chunk in chunks)
+    else:
+        data = await reader.read()
+    connection = response_headers.get('connection', '').lower()
+    keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+    return int(status), response_headers, data, keep_alive
+
+
+async def connection_loop(workload, deadline, latencies, errors, offset):
+    reader = writer = None
+    n = offset
+    while time.monotonic() < deadline:
+        kind = MIX[n % len(MIX)]
+        n += 1
+        cookie = None
+        for method, path, headers, body in workload.requests(kind):
+            if cookie:
+                headers = dict(headers, Cookie=cookie)
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+                status, response_headers, _, keep_alive = await exchange(reader, writer, method, path, headers,
+                                                                         body)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors.append(kind)
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                await asyncio.sleep(0.05)
+                break
+            latencies.append(time.perf_counter() - start)
+            if kind == 'candidates' and status == 200:
+                workload.etag = response_headers.get('etag')
+            if 'set-cookie' in response_headers:
+                cookie = response_headers['set-cookie'].split(';', 1)[0]
+            if not keep_alive:
+                writer.close()
+                reader = writer = None
+            # 403 is a voter who already voted: a normal answer of /cast_vote
+            if status >= 500 or (status >= 400 and status != 403):
+                errors.append(kind)
+                break
+    if writer is not None:
+        writer.close()
+
+
+# The first /identify builds the matching indexes; send it untimed
+async def warm_up(workload):
+    cookie = None
+    for method, path, headers, body in workload.requests('identify'):
+        reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+        try:
+            _, response_headers, _, _ = await exchange(reader, writer, method, path,
+                                                       dict(headers, Cookie=cookie) if cookie else headers, body)
+        finally:
+            writer.close()
+        if 'set-cookie' in response_headers:
+            cookie = response_headers['set-cookie'].split(';', 1)[0]
+
+
+async def drive(workload, connections, seconds):
+    latencies, errors = [], []
+    deadline = time.monotonic() + seconds
+    start = time.perf_counter()
+    await asyncio.gather(*(connection_loop(workload, deadline, latencies, errors, k) for k in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'connections': connections,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def run_server(name, workdir, env, workload, args):
+    process = subprocess.Popen(SERVERS[name], cwd=workdir, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        wait_for_shard(f'http://127.0.0.1:{PORT}')
+        asyncio.run(warm_up(workload))
+        rows = []
+        for connections in args.connections:
+            row = asyncio.run(drive(workload, connections, args.seconds))
+            print(f"  {name} {connections:>5} connections: {row['requests_per_second']:>8.1f} req/s  "
+                  f"p50 {row['p50_ms']:>8.1f} ms  p99 {row['p99_ms']:>8.1f} ms  errors {row['errors']}")
+            rows.append(row)
+        return rows
+    finally:
+        stop_local_shards([process])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', type=int, default=5000)
+    parser.add_argument('--constituencies', type=int, default=543)
+    parser.add_argument('--candidates', type=int, default=8, help='candidates per constituency')
+    parser.add_argument('--connections', default='8,32,128,256', help='comma-separated open connections')
+    parser.add_argument('--seconds', type=float, default=10.0, help='duration of each step')
+    parser.add_argument('--p99-ms', type=float, default=1000.0, help='p99 target for the connections-per-core figure')
+    parser.add_argument('--fake-latency-ms', type=float, default=1.0, help='fake service latency per comparison')
+    parser.add_argument('--servers', default='wsgi,asgi')
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    args.connections = [int(n) for n in args.connections.split(',')]
+
+    cores = os.cpu_count() or 1
+    workdir = tempfile.mkdtemp(prefix='vms-async-bench-')
+    fake = FakeSgiBioSrv(port=0, match_latency_ms=args.fake_latency_ms, seed=args.seed).start()
+    results = {}
+    try:
+        shutil.copytree(os.path.join(REPO_DIR, 'templates'), os.path.join(workdir, 'templates'))
+        candidates = generate_election(workdir, args.voters, args.constituencies, args.candidates, args.seed)
+        env = dict(os.environ, STORAGE_BACKEND='csv', LOG_CONSOLE='0', MATCHER_BACKEND='secugen',
+                   SGI_MATCH_URL=f'{fake.url}/SGIMatchScore', SECRET_KEY=SECRET_KEY,
+                   PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+        print(f"{cores} CPU cores; {args.voters} voters, fake service {args.fake_latency_ms} ms per comparison")
+        for name in args.servers.split(','):
+            # Each server starts from the same votes
+            for filename in ('votes.csv', 'daily_votes.csv'):
+                shutil.copy(os.path.join(workdir, filename), os.path.join(workdir, filename + '.orig'))
+            results[name] = run_server(name, workdir, env, Workload(args.voters, candidates, args.seed), args)
+            for filename in os.listdir(workdir):
+                if filename.endswith('.orig'):
+                    os.replace(os.path.join(workdir, filename), os.path.join(workdir, filename[:-len('.orig')]))
+                elif filename.startswith(('votes.journal', 'vote_tally_')):
+                    os.remove(os.path.join(workdir, filename))
+    finally:
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'server':>6}{'max connections at p99 <= ' + str(int(args.p99_ms)) + ' ms':>36}{'per core':>10}"
+          f"{'peak req/s':>12}")
+    for name, rows in results.items():
+        within = [row['connections'] for row in rows if row['p99_ms'] <= args.p99_ms and not row['errors']]
+        best = max(within, default=0)
+        peak = max((row['requests_per_second'] for row in rows), default=0)
+        print(f"{name:>6}{best:>36}{best / cores:>10.1f}{peak:>12.1f}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'cpu_count': cores, 'p99_ms': args.p99_ms, 'runs': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Storage and parse-time benchmark for moving images out of voters.csv.
+
+Writes a legacy voters.csv (inline bmp_base64 images) with synthetic
+voters, measures its size and parse time, migrates it to the blob store and
+measures again.
+
+    python benchmarks/bench_blob_store.py --voters 2000
+"""
+import argparse
+import base64
+import contextlib
+import csv
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blob_store import BlobStore, migrate_voters_csv  # noqa: E402
+from matcher import synthetic_template  # noqa: E402
+from voter_registry import read_voters_csv  # noqa: E402
+
+# 260x300 8-bit greyscale BMP as produced by SecuGen Hamster devices
+BMP_HEADER_SIZE = 1078
+
+
+def synthetic_bmp(rng, width=260, height=300):
+    return b'BM' + bytes(BMP_HEADER_SIZE - 2) + rng.randbytes(width * height)
+
+
+def timed_parse(path):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        voters = read_voters_csv(path)
+    return time.perf_counter() - start, len(voters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    workdir = tempfile.mkdtemp(prefix='vms-blob-bench-')
+    try:
+        csv_path = os.path.join(workdir, 'voters.csv')
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['voter_id', 'name', 'template_base64', 'bmp_base64', 'registration_date'])
+            for i in range(args.voters):
+                writer.writerow([f'V{i:07d}', f'Voter {i}', synthetic_template(i),
+                                 base64.b64encode(synthetic_bmp(rng)).decode('ascii'), '2025-01-01 09:00:00'])
+
+        legacy_size = os.path.getsize(csv_path)
+        legacy_time, count = timed_parse(csv_path)
+
+        store = BlobStore(os.path.join(workdir, 'fingerprint_images'))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate_voters_csv(csv_path, store)
+        migrate_time = time.perf_counter() - start
+
+        new_size = os.path.getsize(csv_path)
+        new_time, _ = timed_parse(csv_path)
+
+        print(f"Voters: {count}")
+        print(f"voters.csv size:  {legacy_size / 1e6:10.1f} MB -> {new_size / 1e6:8.2f} MB "
+              f"({legacy_size / new_size:.0f}x smaller)")
+        print(f"voters.csv parse: {legacy_time * 1000:10.1f} ms -> {new_time * 1000:8.1f} ms "
+              f"({legacy_time / new_time:.0f}x faster)")
+        print(f"Migration: {migrate_time:.2f}s ({count / migrate_time:.0f} voters/s)")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
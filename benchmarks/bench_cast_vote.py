@@ -0,0 +1,93 @@
+"""Load test for /cast_vote: throughput and the one-vote-per-voter guarantee.
+
+Starts the app in a scratch directory and fires concurrent /cast_vote
+requests from many threads, with every voter attempted by several threads
+at once. Reports sustained votes/sec and how many votes each journal fsync
+covered, and checks that exactly one vote per voter was accepted.
+
+    python benchmarks/bench_cast_vote.py --voters 2000 --attempts 3 --threads 32
+    STORAGE_BACKEND=sqlite python benchmarks/bench_cast_vote.py
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', type=int, default=2000)
+    parser.add_argument('--attempts', type=int, default=3, help='requests per voter')
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='vms-vote-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        shutil.copytree(os.path.join(REPO_DIR, 'templates'), 'templates')
+        os.environ.setdefault('MATCHER_BACKEND', 'local')
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app as vms
+        vms.app.config['TESTING'] = True
+
+        voter_ids = [f'V{i:07d}' for i in range(args.voters)]
+        work = [voter_id for voter_id in voter_ids for _ in range(args.attempts)]
+        next_item = iter(work)
+        item_lock = threading.Lock()
+        statuses = Counter()
+        accepted = Counter()
+        result_lock = threading.Lock()
+
+        def worker():
+            client = vms.app.test_client()
+            while True:
+                with item_lock:
+                    voter_id = next(next_item, None)
+                if voter_id is None:
+                    return
+                with client.session_transaction() as sess:
+                    sess['voter_id'] = voter_id
+                    sess['voter_name'] = 'Bench'
+                response = client.post('/cast_vote', json={'state': 'S', 'constituency': 'C',
+                                                          'candidate_name': 'A', 'party': 'P'})
+                with result_lock:
+                    statuses[response.status_code] += 1
+                    if response.status_code == 200:
+                        accepted[voter_id] += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        stats = vms.vote_journal.stats()
+        stored = Counter(row['voter_id'] for row in vms.storage.votes.log())
+        print(f"backend={vms.STORAGE_BACKEND} voters={args.voters} attempts/voter={args.attempts} "
+              f"threads={args.threads}")
+        print(f"requests: {len(work)} in {elapsed:.2f}s ({len(work) / elapsed:.0f} req/s), "
+              f"statuses={dict(statuses)}")
+        print(f"accepted votes: {stats['committed']} ({stats['committed'] / elapsed:.0f} votes/s)")
+        print(f"journal: {stats['batches']} batches, {stats['votes_per_batch']} votes per fsync")
+        assert all(accepted[v] == 1 for v in voter_ids), 'a voter was accepted more than once or not at all'
+        assert all(stored[v] == 1 for v in voter_ids), 'votes.csv does not hold exactly one vote per voter'
+        print("OK: exactly one vote recorded per voter")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Time from process start to serving, with and without the warm state.
+
+Writes a synthetic election (bench_election.generate_election) and starts
+the app three times in a fresh interpreter, each time importing app and
+then sending a first GET /get_voters_json and a first POST /identify (after
+/login_scan1 and /login_scan2 with a re-scan of an enrolled voter, scored
+by LocalMatcher):
+
+- off: WARM_STATE=0 WARM_UP=0, so every index is built by the first
+  request that needs it. ``eager s`` is what building the digest index and
+  the template store at import time (as before the warm state) adds.
+- first: no snapshot yet; the warm-up thread builds the indexes and writes
+  the snapshot (``warm-up s``, from the start of the import) before the
+  requests are sent
+- warm: restarted from that snapshot; the requests are sent at once, while
+  the warm-up thread is still checking the digest index
+
+    python benchmarks/bench_cold_start.py --voters 10000,100000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from bench_election import generate_election  # noqa: E402
+from matcher import perturb_template, synthetic_template  # noqa: E402
+
+# Run in the child interpreter; prints the timings as JSON
+CHILD = r'''
+import json, os, sys, threading, time
+start = time.perf_counter()
+import app
+timings = {'import_s': time.perf_counter() - start}
+if os.environ['BENCH_MODE'] == 'off':
+    eager = time.perf_counter()
+    app.digest_index.sync(app.voter_registry)
+    app.template_store.sync(app.voter_registry)
+    timings['eager_s'] = time.perf_counter() - eager
+warm_up = [t for t in threading.enumerate() if t.name == 'warm-up']
+if os.environ['BENCH_MODE'] == 'first':
+    for thread in warm_up:
+        thread.join()
+    timings['warm_up_s'] = time.perf_counter() - start
+client = app.app.test_client()
+scan = {'TemplateBase64': os.environ['BENCH_PROBE'], 'BMPBase64': ''}
+client.post('/login_scan1', data=scan)
+client.post('/login_scan2', data=scan)
+for name, send in (('voters_json_s', lambda: client.get('/get_voters_json')),
+                   ('identify_s', lambda: client.post('/identify'))):
+    t = time.perf_counter()
+    response = send()
+    timings[name] = time.perf_counter() - t
+    assert response.status_code == 200, (name, response.status_code)
+timings['matched'] = response.get_json().get('voter_id')
+timings['ready_s'] = time.perf_counter() - start
+timings['restored'] = app.warm_state.restored if app.warm_state is not None else []
+print(json.dumps(timings))
+'''
+MODES = ['off', 'first', 'warm']
+
+
+def run_app(workdir, mode, probe):
+    env = dict(os.environ, STORAGE_BACKEND='csv', LOG_CONSOLE='0', MATCHER_BACKEND='local',
+               BENCH_MODE=mode, BENCH_PROBE=probe,
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    if mode == 'off':
+        env.update(WARM_STATE='0', WARM_UP='0')
+    output = subprocess.run([sys.executable, '-c', CHILD], cwd=workdir, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', default='10000,100000', help='comma-separated roll sizes')
+    parser.add_argument('--constituencies', type=int, default=543)
+    parser.add_argument('--candidates', type=int, default=8, help='candidates per constituency')
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for voters in (int(n) for n in args.voters.split(',')):
+        workdir = tempfile.mkdtemp(prefix='vms-cold-start-bench-')
+        try:
+            print(f"Writing {voters} voters...")
+            generate_election(workdir, voters, args.constituencies, args.candidates, args.seed)
+            target = voters // 3
+            probe = perturb_template(synthetic_template(target), args.seed)
+            for mode in MODES:
+                row = run_app(workdir, mode, probe)
+                row.update(voters=voters, mode=mode,
+                           snapshot_bytes=os.path.getsize(os.path.join(workdir, 'warm_state_csv.bin'))
+                           if mode != 'off' else None)
+                print(f"  {mode:<6} import {row['import_s']:.2f} s, ready {row['ready_s']:.2f} s")
+                results.append(row)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def cell(row, key):
+        return f"{row[key]:.2f}" if row.get(key) is not None else '-'
+
+    header = (f"{'voters':>8} {'mode':<6}{'import s':>10}{'eager s':>9}{'warm-up s':>11}{'voters s':>10}"
+              f"{'identify s':>12}{'ready s':>9}{'snapshot MiB':>14}")
+    print(header)
+    print('-' * len(header))
+    for row in results:
+        size = f"{row['snapshot_bytes'] / 2**20:.1f}" if row['snapshot_bytes'] else '-'
+        print(f"{row['voters']:>8} {row['mode']:<6}{cell(row, 'import_s'):>10}{cell(row, 'eager_s'):>9}"
+              f"{cell(row, 'warm_up_s'):>11}{cell(row, 'voters_json_s'):>10}{cell(row, 'identify_s'):>12}"
+              f"{cell(row, 'ready_s'):>9}{size:>14}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
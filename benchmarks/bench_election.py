@@ -0,0 +1,353 @@
+"""End-to-end load benchmark over a synthetic election.
+
+Generates a reproducible voters.csv, votes.csv, daily_votes.csv and
+candidates.csv (same --seed, same data) in a scratch directory, starts the
+app there and drives its routes through the Flask test client:
+
+- registration: /register_scan + /save_registration with new fingerprints
+- login: /login_scan1, /login_scan2, /identify and /login_verify with a
+  simulated re-scan of an enrolled voter
+- cast_vote, admin_panel, /admin/results and the candidate catalogue
+
+Matching runs in process on LocalMatcher, the deterministic stand-in for
+SGIMatchScore. --fake-service scores through fake_sgibiosrv.py over HTTP
+instead, with optional latency and error injection; --match-url uses any
+running SGIMatchScore service. For every route it reports the first (cold) request, p50,
+p99 and max latency, throughput and peak RSS, and can compare the run with a
+saved baseline:
+
+    python benchmarks/bench_election.py --voters 100000 --requests 200 --json run.json
+    python benchmarks/bench_election.py --voters 100000 --baseline run.json
+    python benchmarks/bench_election.py --voters 10000 --fake-service --fake-latency-ms 5 --fake-error-rate 0.01
+    python benchmarks/bench_election.py --voters 1000000 --storage sqlite --generate-only /data/election-1m
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from candidate_import import KNOWN_STATES  # noqa: E402
+from fake_sgibiosrv import FakeSgiBioSrv  # noqa: E402
+from matcher import perturb_template, synthetic_template  # noqa: E402
+from storage import CANDIDATE_FIELDS, DAILY_VOTE_FIELDS, VOTE_FIELDS, CsvStorage, SqliteStorage, copy_storage  # noqa: E402
+from voter_registry import VOTER_FIELDS  # noqa: E402
+
+PARTIES = ['Party A', 'Party B', 'Party C', 'Party D', 'Independent']
+# Seeds of enrolled templates are the voter number; new registrations use
+# seeds above this
+NEW_TEMPLATE_SEED = 10**8
+
+ROUTES = ['register_scan', 'save_registration', 'login_scan1', 'login_scan2', 'identify', 'login_verify',
+          'candidates', 'cast_vote', 'admin_panel', 'admin_results']
+
+
+def voter_id(i):
+    return f'V{i:07d}'
+
+
+# ========== SYNTHETIC ELECTION ==========
+
+# Write the four CSV files into `directory`. The first half of the roll has
+# not voted yet; the second half voted more than 75 hours ago, so its votes
+# count in the results but do not block the vote window.
+def generate_election(directory, voters, constituencies, candidates_per_constituency, seed):
+    rng = random.Random(seed)
+    states = list(KNOWN_STATES)
+    seats = [(states[i % len(states)], f'Constituency {i:04d}') for i in range(constituencies)]
+    candidates = []
+    with open(os.path.join(directory, 'candidates.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CANDIDATE_FIELDS)
+        for state, constituency in seats:
+            for k in range(candidates_per_constituency):
+                row = [str(len(candidates) + 1), state, constituency, PARTIES[k % len(PARTIES)],
+                       f'Candidate {len(candidates) + 1}']
+                candidates.append(row)
+                writer.writerow(row)
+
+    cast_at = datetime(2025, 1, 1, 9, 0, 0)
+    with open(os.path.join(directory, 'voters.csv'), 'w', newline='', encoding='utf-8') as voters_f, \
+            open(os.path.join(directory, 'votes.csv'), 'w', newline='', encoding='utf-8') as votes_f, \
+            open(os.path.join(directory, 'daily_votes.csv'), 'w', newline='', encoding='utf-8') as daily_f:
+        voters_csv, votes_csv, daily_csv = csv.writer(voters_f), csv.writer(votes_f), csv.writer(daily_f)
+        voters_csv.writerow(VOTER_FIELDS)
+        votes_csv.writerow(VOTE_FIELDS)
+        daily_csv.writerow(DAILY_VOTE_FIELDS)
+        for i in range(voters):
+            voters_csv.writerow([voter_id(i), f'Voter {i}', synthetic_template(i), '', '2025-01-01 08:00:00'])
+            if i >= voters // 2:
+                _id, state, constituency, party, name = rng.choice(candidates)
+                when = cast_at + timedelta(seconds=i)
+                date, timestamp = when.strftime('%Y-%m-%d'), when.strftime('%Y-%m-%d %H:%M:%S')
+                votes_csv.writerow([date, voter_id(i), f'Voter {i}', state, constituency, name, party, timestamp])
+                daily_csv.writerow([date, voter_id(i), 'yes', timestamp])
+    return candidates
+
+
+# ========== MEASUREMENT ==========
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return peak / (2**20 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.peak_rss = 0.0
+        self.peak_traced = 0
+
+    def summary(self):
+        # The first request pays for cold caches and index builds; it is
+        # reported on its own and left out of the percentiles
+        first, rest = (self.latencies[0], sorted(self.latencies[1:])) if self.latencies else (0.0, [])
+        return {
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'first_ms': round(first * 1000, 2),
+            'p50_ms': round(percentile(rest, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(rest, 0.99) * 1000, 2),
+            'max_ms': round((rest[-1] if rest else first) * 1000, 2),
+            'per_second': round(len(self.latencies) / self.elapsed, 1) if self.elapsed else 0,
+            'peak_rss_mib': round(self.peak_rss, 1),
+            'peak_traced_mib': round(self.peak_traced / 2**20, 1),
+        }
+
+
+class Recorder:
+    def __init__(self, trace_memory=False):
+        self.routes = {route: RouteStats() for route in ROUTES}
+        self.trace_memory = trace_memory
+
+    # Time one request; `ok(response)` decides whether it did what it should
+    def call(self, route, request, ok):
+        stats = self.routes[route]
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        response = request()
+        elapsed = time.perf_counter() - start
+        stats.latencies.append(elapsed)
+        stats.elapsed += elapsed
+        if not ok(response):
+            stats.errors += 1
+        stats.peak_rss = max(stats.peak_rss, peak_rss_mib())
+        if self.trace_memory:
+            stats.peak_traced = max(stats.peak_traced, tracemalloc.get_traced_memory()[1])
+        return response
+
+    def summary(self):
+        return {route: stats.summary() for route, stats in self.routes.items() if stats.latencies}
+
+
+def is_page(title):
+    return lambda response: response.status_code == 200 and f'<title>{title}'.encode() in response.data
+
+
+def is_json_ok(response):
+    return response.status_code == 200 and response.is_json and 'error' not in response.json
+
+
+# ========== SCENARIOS ==========
+
+def run_registration(vms, recorder, count):
+    client = vms.app.test_client()
+    for n in range(count):
+        template = synthetic_template(NEW_TEMPLATE_SEED + n)
+        recorder.call('register_scan', lambda: client.post('/register_scan', data={
+            'TemplateBase64': template, 'BMPBase64': ''}), lambda r: r.status_code == 200)
+        recorder.call('save_registration', lambda: client.post('/save_registration', data={
+            'voter_id': f'N{n:07d}', 'name': f'New voter {n}'}), is_page('Registration Successful'))
+
+
+def run_login(vms, recorder, count, voters, rng):
+    client = vms.app.test_client()
+    for n in range(count):
+        i = rng.randrange(voters // 2)
+        probe = perturb_template(synthetic_template(i), rng.randrange(10**9))
+        recorder.call('login_scan1', lambda: client.post('/login_scan1', data={
+            'TemplateBase64': probe, 'BMPBase64': ''}), lambda r: r.status_code == 200)
+        recorder.call('login_scan2', lambda: client.post('/login_scan2', data={
+            'TemplateBase64': probe, 'BMPBase64': ''}), lambda r: r.status_code == 200)
+        recorder.call('identify', lambda: client.post('/identify'),
+                      lambda r: r.status_code == 200 and r.json.get('voter_id') == voter_id(i))
+        recorder.call('login_verify', lambda: client.post('/login_verify', data={'ErrorCode': '0'}),
+                      lambda r: r.status_code == 302)
+
+
+def run_voting(vms, recorder, count, voters, candidates, rng):
+    client = vms.app.test_client()
+    # Voters from the first half, who have not voted yet; each votes once
+    for i in rng.sample(range(voters // 2), min(count, voters // 2)):
+        _id, state, constituency, party, name = rng.choice(candidates)
+        recorder.call('candidates', lambda: client.get(f'/candidates/{state}/{constituency}'),
+                      lambda r: r.status_code == 200)
+        with client.session_transaction() as sess:
+            sess['voter_id'] = voter_id(i)
+            sess['voter_name'] = f'Voter {i}'
+        recorder.call('cast_vote', lambda: client.post('/cast_vote', json={
+            'state': state, 'constituency': constituency, 'candidate_name': name, 'party': party}), is_json_ok)
+
+
+def run_admin(vms, recorder, count):
+    client = vms.app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    for _ in range(count):
+        recorder.call('admin_panel', lambda: client.get('/admin_panel'), is_page('Admin Panel'))
+        recorder.call('admin_results', lambda: client.get('/admin/results'), is_json_ok)
+
+
+# ========== REPORT ==========
+
+def print_report(startup, summary):
+    print(f"Startup (import app, load roll and indexes): {startup:.2f}s, peak RSS {peak_rss_mib():.0f} MiB")
+    header = f"{'route':<18}{'n':>6}{'err':>5}{'first ms':>10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'req/s':>9}{'RSS MiB':>9}"
+    print(header)
+    print('-' * len(header))
+    for route, s in summary.items():
+        print(f"{route:<18}{s['requests']:>6}{s['errors']:>5}{s['first_ms']:>10.1f}{s['p50_ms']:>9.1f}"
+              f"{s['p99_ms']:>9.1f}{s['max_ms']:>9.1f}{s['per_second']:>9.1f}{s['peak_rss_mib']:>9.0f}")
+
+
+# Routes whose p99 or peak memory grew by more than `tolerance` (a
+# fraction) since the baseline run
+def regressions(summary, baseline, tolerance):
+    found = []
+    for route, s in summary.items():
+        before = baseline.get('routes', {}).get(route)
+        if not before:
+            continue
+        for key in ('p50_ms', 'p99_ms', 'peak_rss_mib'):
+            # Ignore sub-millisecond noise
+            if before[key] >= 1 and s[key] > before[key] * (1 + tolerance):
+                found.append(f"{route} {key}: {before[key]} -> {s[key]}")
+        if s['errors'] > before['errors']:
+            found.append(f"{route} errors: {before['errors']} -> {s['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', type=int, default=1000)
+    parser.add_argument('--constituencies', type=int, default=543)
+    parser.add_argument('--candidates', type=int, default=8, help='candidates per constituency')
+    parser.add_argument('--requests', type=int, default=100, help='requests (or flows) per route')
+    parser.add_argument('--storage', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--match-url', help='score through this SGIMatchScore URL instead of LocalMatcher')
+    parser.add_argument('--fake-service', action='store_true', help='score through an in-process fake_sgibiosrv')
+    parser.add_argument('--fake-latency-ms', type=float, default=0.0, help='fake service latency per comparison')
+    parser.add_argument('--fake-error-rate', type=float, default=0.0, help='share of comparisons failing')
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--tracemalloc', action='store_true', help='also report peak traced Python memory (slower)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results of an earlier --json run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed growth over the baseline')
+    parser.add_argument('--generate-only', metavar='DIR', help='only write the synthetic CSV files to DIR')
+    args = parser.parse_args()
+
+    if args.generate_only:
+        os.makedirs(args.generate_only, exist_ok=True)
+        start = time.perf_counter()
+        generate_election(args.generate_only, args.voters, args.constituencies, args.candidates, args.seed)
+        print(f"Wrote {args.voters} voters to {args.generate_only} in {time.perf_counter() - start:.1f}s")
+        return 0
+
+    fake = None
+    workdir = tempfile.mkdtemp(prefix='vms-election-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        shutil.copytree(os.path.join(REPO_DIR, 'templates'), 'templates')
+        print(f"Generating {args.voters} voters, {args.constituencies} constituencies in {workdir}...")
+        start = time.perf_counter()
+        candidates = generate_election(workdir, args.voters, args.constituencies, args.candidates, args.seed)
+        if args.storage == 'sqlite':
+            with contextlib.redirect_stdout(io.StringIO()):
+                copy_storage(CsvStorage(voters_csv='voters.csv', votes_csv='votes.csv',
+                                        daily_votes_csv='daily_votes.csv', candidates_csv='candidates.csv'),
+                             SqliteStorage('vms.sqlite3'))
+        print(f"Generated in {time.perf_counter() - start:.1f}s")
+
+        os.environ['STORAGE_BACKEND'] = args.storage
+        os.environ['SQLITE_DB'] = 'vms.sqlite3'
+        os.environ['LOG_CONSOLE'] = '0'
+        if args.fake_service:
+            fake = FakeSgiBioSrv(port=0, match_latency_ms=args.fake_latency_ms, error_rate=args.fake_error_rate,
+                                 seed=args.seed).start()
+            args.match_url = f'{fake.url}/SGIMatchScore'
+        if args.match_url:
+            os.environ['MATCHER_BACKEND'] = 'secugen'
+            os.environ['SGI_MATCH_URL'] = args.match_url
+        else:
+            os.environ['MATCHER_BACKEND'] = 'local'
+        if args.tracemalloc:
+            tracemalloc.start()
+        start = time.perf_counter()
+        import app as vms
+        startup = time.perf_counter() - start
+        vms.app.config['TESTING'] = True
+
+        rng = random.Random(args.seed)
+        recorder = Recorder(trace_memory=args.tracemalloc)
+        run_registration(vms, recorder, args.requests)
+        run_login(vms, recorder, args.requests, args.voters, rng)
+        run_voting(vms, recorder, args.requests, args.voters, candidates, rng)
+        run_admin(vms, recorder, args.requests)
+        summary = recorder.summary()
+        if fake is not None:
+            print(f"Fake SgiBioSrv: {fake.stats()}")
+            fake.stop()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(startup, summary)
+    result = {
+        'voters': args.voters,
+        'storage': args.storage,
+        'matcher': 'fake_sgibiosrv' if args.fake_service else 'secugen' if args.match_url else 'local',
+        'startup_seconds': round(startup, 3),
+        'routes': summary,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('voters') != args.voters or baseline.get('storage') != args.storage:
+            print("WARNING: baseline was run with a different roll size or storage backend")
+        found = regressions(summary, baseline, args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} of the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""Throughput of login + vote flows as the roll is split over more shards.
+
+For each shard count, writes a synthetic national roll split by home
+constituency (sharding.ShardMap), starts that many app.py processes with
+shard_router.start_local_shards and the coordinator in front of them, and
+drives complete booth flows through the coordinator from --clients
+threads: booth setup, /login_scan1, /login_scan2, /identify, /login_verify
+and /cast_vote. Afterwards the merged /admin/results must count every
+vote cast.
+
+Reported per shard count: flows per second, /identify p50, and the CPU
+time of the busiest shard. On a machine with fewer cores than processes
+the wall-clock rate cannot grow, so the table also gives the projected
+rate with one core per shard (flows / busiest shard's CPU seconds).
+
+    python benchmarks/bench_shards.py --voters 20000 --shards 1,2,4 --flows 200
+"""
+import argparse
+import csv
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from bench_election import PARTIES, percentile, voter_id  # noqa: E402
+from candidate_import import KNOWN_STATES  # noqa: E402
+from matcher import perturb_template, synthetic_template  # noqa: E402
+from shard_router import create_router, start_local_shards, stop_local_shards  # noqa: E402
+from sharding import ShardMap  # noqa: E402
+from storage import CANDIDATE_FIELDS, DAILY_VOTE_FIELDS, VOTE_FIELDS  # noqa: E402
+from voter_registry import VOTER_FIELDS  # noqa: E402
+
+BASE_PORT = 5201
+ADMIN_PASSWORD = 'mini2025'
+
+
+def shard_names(count):
+    return {f'shard{i}': f'http://127.0.0.1:{BASE_PORT + i}' for i in range(count)}
+
+
+def seats_for(constituencies):
+    states = list(KNOWN_STATES)
+    return [(states[i % len(states)], f'Constituency {i:04d}') for i in range(constituencies)]
+
+
+# Write every shard's CSV files; voter i lives in seat i % len(seats).
+# Returns {shard: voters on it}.
+def write_shards(data_dir, shard_map, seats, voters, candidates_per_seat):
+    files = {}
+    writers = {}
+    for name in shard_map.names:
+        directory = os.path.join(data_dir, name)
+        os.makedirs(directory, exist_ok=True)
+        for filename, fields in (('votes.csv', VOTE_FIELDS), ('daily_votes.csv', DAILY_VOTE_FIELDS)):
+            with open(os.path.join(directory, filename), 'w', newline='', encoding='utf-8') as f:
+                csv.writer(f).writerow(fields)
+        with open(os.path.join(directory, 'candidates.csv'), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(CANDIDATE_FIELDS)
+            n = 0
+            for state, constituency in seats:
+                for k in range(candidates_per_seat):
+                    n += 1
+                    writer.writerow([n, state, constituency, PARTIES[k % len(PARTIES)], f'Candidate {n}'])
+        files[name] = open(os.path.join(directory, 'voters.csv'), 'w', newline='', encoding='utf-8')
+        writers[name] = csv.writer(files[name])
+        writers[name].writerow(VOTER_FIELDS)
+    counts = dict.fromkeys(shard_map.names, 0)
+    owners = [shard_map.shard_for(*seat) for seat in seats]
+    for i in range(voters):
+        name = owners[i % len(seats)]
+        writers[name].writerow([voter_id(i), f'Voter {i}', synthetic_template(i), '', '2025-01-01 08:00:00'])
+        counts[name] += 1
+    for f in files.values():
+        f.close()
+    return counts
+
+
+def cpu_seconds(pid):
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def booth_client(base_url):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+    def call(method, path, data=None, json_body=None):
+        body, headers = None, {}
+        if data is not None:
+            body = urllib.parse.urlencode(data).encode('ascii')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(base_url + path, data=body, headers=headers, method=method)
+        try:
+            with opener.open(req, timeout=600) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+    return call
+
+
+# One voter's visit to the booth of their home constituency
+def run_flow(base_url, i, seat, rng_seed, identify_times):
+    call = booth_client(base_url)
+    probe = perturb_template(synthetic_template(i), rng_seed)
+    state, constituency = seat
+    call('GET', f'/booth/{urllib.parse.quote(state)}/{urllib.parse.quote(constituency)}')
+    call('POST', '/login_scan1', {'TemplateBase64': probe, 'BMPBase64': ''})
+    call('POST', '/login_scan2', {'TemplateBase64': probe, 'BMPBase64': ''})
+    start = time.perf_counter()
+    status, body = call('POST', '/identify')
+    identify_times.append(time.perf_counter() - start)
+    if status != 200 or json.loads(body).get('voter_id') != voter_id(i):
+        return False
+    status, _ = call('POST', '/login_verify', {'ErrorCode': '0'})
+    if status != 302:
+        return False
+    status, body = call('POST', '/cast_vote', json_body={
+        'state': state, 'constituency': constituency, 'candidate_name': 'Candidate 1', 'party': PARTIES[0]})
+    return status == 200 and json.loads(body).get('success')
+
+
+def run(shards, args):
+    workdir = tempfile.mkdtemp(prefix='vms-shard-bench-')
+    shard_map = ShardMap(shard_names(shards))
+    seats = seats_for(args.constituencies)
+    processes = []
+    server = None
+    try:
+        counts = write_shards(workdir, shard_map, seats, args.voters, args.candidates)
+        env = {'MATCHER_BACKEND': 'local', 'STORAGE_BACKEND': 'csv', 'LOG_CONSOLE': '0'}
+        started = time.perf_counter()
+        _, processes = start_local_shards(shards, workdir, BASE_PORT, env=env)
+        server = make_server('127.0.0.1', 0, create_router(shard_map), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+        rng = random.Random(args.seed)
+        by_shard = {}
+        for i in range(args.voters):
+            by_shard.setdefault(shard_map.shard_for(*seats[i % len(seats)]), []).append(i)
+        # The first /identify on a shard builds its indexes; do it untimed,
+        # straight on each shard
+        warm_shards = list(by_shard)
+        warm_voters = [by_shard[name][0] for name in warm_shards]
+        warm_seeds = [rng.randrange(10**9) for _ in warm_voters]
+        with ThreadPoolExecutor(max_workers=shards) as pool:
+            list(pool.map(lambda k: run_flow(shard_map.url(warm_shards[k]), warm_voters[k],
+                                             seats[warm_voters[k] % len(seats)], warm_seeds[k], []),
+                          range(len(warm_voters))))
+        warmup = time.perf_counter() - started
+
+        chosen = rng.sample(sorted(set(range(args.voters)) - set(warm_voters)), args.flows)
+        seeds = [rng.randrange(10**9) for _ in chosen]
+        cpu_before = [cpu_seconds(p.pid) for p in processes]
+        identify_times = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            ok = list(pool.map(lambda k: run_flow(base_url, chosen[k], seats[chosen[k] % len(seats)], seeds[k],
+                                                  identify_times), range(len(chosen))))
+        elapsed = time.perf_counter() - start
+        cpu = [cpu_seconds(p.pid) - before for p, before in zip(processes, cpu_before)]
+
+        admin = booth_client(base_url)
+        admin('POST', '/admin', {'password': ADMIN_PASSWORD})
+        _, body = admin('GET', '/admin/results')
+        results = json.loads(body)
+    finally:
+        if server is not None:
+            server.shutdown()
+        stop_local_shards(processes)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    busiest = max(cpu) if cpu else 0.0
+    return {
+        'shards': shards,
+        'voters_per_shard': max(counts.values()),
+        'flows': len(ok),
+        'failed': ok.count(False),
+        'seconds': round(elapsed, 2),
+        'flows_per_second': round(len(ok) / elapsed, 1),
+        'identify_p50_ms': round(percentile(sorted(identify_times), 0.5) * 1000, 1),
+        'busiest_shard_cpu_s': round(busiest, 2),
+        'projected_flows_per_second': round(len(ok) / busiest, 1) if busiest else 0,
+        'merged_votes': results.get('total_votes'),
+        'votes_expected': ok.count(True) + len(by_shard),
+        'warmup_s': round(warmup, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', type=int, default=20000)
+    parser.add_argument('--constituencies', type=int, default=543)
+    parser.add_argument('--candidates', type=int, default=8, help='candidates per constituency')
+    parser.add_argument('--shards', default='1,2,4', help='comma-separated shard counts')
+    parser.add_argument('--flows', type=int, default=200, help='timed booth flows per shard count')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent booths')
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    print(f"{os.cpu_count()} CPU cores; {args.voters} voters, {args.flows} flows, {args.clients} booths")
+    rows = []
+    for shards in [int(n) for n in args.shards.split(',')]:
+        print(f"Running {shards} shard(s)...")
+        rows.append(run(shards, args))
+    base = rows[0]
+    header = (f"{'shards':>6}{'voters/shard':>14}{'flows/s':>9}{'speedup':>9}{'identify p50':>14}"
+              f"{'busiest CPU s':>15}{'projected/s':>13}{'speedup':>9}{'votes ok':>10}")
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        speedup = row['flows_per_second'] / base['flows_per_second'] if base['flows_per_second'] else 0
+        projected = row['projected_flows_per_second'] / base['projected_flows_per_second'] \
+            if base['projected_flows_per_second'] else 0
+        votes_ok = 'yes' if row['merged_votes'] == row['votes_expected'] and not row['failed'] else 'NO'
+        print(f"{row['shards']:>6}{row['voters_per_shard']:>14}{row['flows_per_second']:>9.1f}{speedup:>8.2f}x"
+              f"{row['identify_p50_ms']:>12.1f}ms{row['busiest_shard_cpu_s']:>15.2f}"
+              f"{row['projected_flows_per_second']:>13.1f}{projected:>8.2f}x{votes_ok:>10}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'runs': rows}, f, indent=2)
+    return 0 if all(row['merged_votes'] == row['votes_expected'] and not row['failed'] for row in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
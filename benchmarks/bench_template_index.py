@@ -0,0 +1,71 @@
+"""Recall/speed benchmark for the template pre-filtering index.
+
+Builds an index over synthetic ISO templates, probes it with simulated
+re-scans of enrolled fingers and reports how often the genuine voter lands
+in the top-K shortlist, and how much scoring work the shortlist saves.
+
+    python benchmarks/bench_template_index.py --voters 5000 --probes 200 --k 50
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import LocalMatcher, perturb_template, synthetic_template  # noqa: E402
+from template_index import TemplateIndex  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', type=int, default=5000)
+    parser.add_argument('--probes', type=int, default=200)
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--score-sample', type=int, default=20,
+                        help='probes used to time full vs shortlisted scoring')
+    args = parser.parse_args()
+
+    print(f"Generating {args.voters} synthetic templates...")
+    templates = [synthetic_template(i) for i in range(args.voters)]
+
+    index = TemplateIndex()
+    start = time.perf_counter()
+    for i, template in enumerate(templates):
+        index.add(f'V{i}', template)
+    build_time = time.perf_counter() - start
+    print(f"Index build: {build_time:.2f}s ({args.voters / build_time:.0f} templates/s) {index.stats()}")
+
+    step = max(1, args.voters // args.probes)
+    genuine = list(range(0, args.voters, step))[:args.probes]
+    probes = [(f'V{i}', perturb_template(templates[i], 10_000 + i)) for i in genuine]
+
+    hits = 0
+    start = time.perf_counter()
+    for voter_id, probe in probes:
+        if voter_id in index.shortlist(probe, args.k)[:args.k]:
+            hits += 1
+    query_time = (time.perf_counter() - start) / len(probes)
+    print(f"Recall@{args.k}: {hits / len(probes):.1%} over {len(probes)} probes")
+    print(f"Shortlist query: {query_time * 1000:.2f} ms/probe")
+    print(f"Candidate set: {args.k} of {args.voters} voters ({args.voters / args.k:.0f}x reduction)")
+
+    matcher = LocalMatcher()
+    by_id = {f'V{i}': t for i, t in enumerate(templates)}
+    sample = probes[:args.score_sample]
+    start = time.perf_counter()
+    for _voter_id, probe in sample:
+        for template in templates:
+            matcher.match(probe, template)
+    full_time = (time.perf_counter() - start) / len(sample)
+    start = time.perf_counter()
+    for _voter_id, probe in sample:
+        for voter_id in index.shortlist(probe, args.k):
+            matcher.match(probe, by_id[voter_id])
+    short_time = (time.perf_counter() - start) / len(sample)
+    print(f"Full scoring: {full_time * 1000:.1f} ms/probe, shortlist + scoring: {short_time * 1000:.1f} ms/probe "
+          f"({full_time / short_time:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
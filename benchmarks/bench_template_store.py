@@ -0,0 +1,142 @@
+"""Startup time and memory of the voter roll vs the binary template store.
+
+Writes a voters.csv with synthetic voters and builds the template store
+from it, then measures, each in a fresh process:
+
+- roll: loading the roll as a list of voter dicts (VoterRegistry.voters(),
+  i.e. what get_all_voters returns)
+- store: memory-mapping the template store, then reading every template
+  through it (the pages a full 1:N search would touch)
+
+and compares 1:N scoring from base64 text with scoring from the store.
+
+    python benchmarks/bench_template_store.py --voters 1000000
+"""
+import argparse
+import contextlib
+import csv
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import LocalMatcher, decode_template, perturb_template, synthetic_template  # noqa: E402
+from template_store import TemplateStore  # noqa: E402
+from voter_registry import VoterRegistry  # noqa: E402
+
+# Distinct templates generated; larger rolls reuse them (sizes are what count)
+DISTINCT_TEMPLATES = 5000
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_roll(csv_path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        registry = VoterRegistry(csv_path)
+        return registry, registry.voters()
+
+
+# Runs in a child process so each measurement starts from a clean heap
+def measure(phase, workdir):
+    csv_path = os.path.join(workdir, 'voters.csv')
+    store_path = os.path.join(workdir, 'voter_templates.bin')
+    before = rss_bytes()
+    start = time.perf_counter()
+    if phase == 'roll':
+        _registry, voters = load_roll(csv_path)
+        loaded = time.perf_counter() - start
+        count = len(voters)
+        loaded_rss = rss_bytes() - before
+        start = time.perf_counter()
+        for voter in voters:
+            decode_template(voter['template_base64'])
+    else:
+        store = TemplateStore(store_path)
+        store.load()
+        loaded = time.perf_counter() - start
+        count = len(store)
+        start = time.perf_counter()
+        loaded_rss = rss_bytes() - before
+        start = time.perf_counter()
+        for i in range(count):
+            store.get(f'V{i:07d}')[4]  # Touch the template so its page is read
+    scanned = time.perf_counter() - start
+    print(f"{phase} {count} {loaded:.3f} {scanned:.3f} {loaded_rss} {rss_bytes() - before}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--voters', type=int, default=100000)
+    parser.add_argument('--probes', type=int, default=20, help='probes scored against 1000 voters each way')
+    parser.add_argument('--measure', choices=['roll', 'store'], help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure, args.workdir)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='vms-template-bench-')
+    try:
+        print(f"Writing {args.voters} synthetic voters...")
+        templates = [synthetic_template(i) for i in range(min(args.voters, DISTINCT_TEMPLATES))]
+        csv_path = os.path.join(workdir, 'voters.csv')
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['voter_id', 'name', 'template_base64', 'bmp_hash', 'registration_date'])
+            for i in range(args.voters):
+                writer.writerow([f'V{i:07d}', f'Voter {i}', templates[i % len(templates)], '', '2025-01-01 09:00:00'])
+
+        registry, _voters = load_roll(csv_path)
+        store = TemplateStore(os.path.join(workdir, 'voter_templates.bin'))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.sync(registry)
+        build_time = time.perf_counter() - start
+        del registry, _voters
+        print(f"voters.csv: {os.path.getsize(csv_path) / 2**20:.1f} MiB, template store: "
+              f"{os.path.getsize(store.path) / 2**20:.1f} MiB (built in {build_time:.2f}s)")
+
+        results = {}
+        for phase in ('roll', 'store'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', phase,
+                                     '--workdir', workdir], check=True, capture_output=True, text=True).stdout
+            _phase, count, loaded, scanned, loaded_rss, rss = output.split()
+            results[phase] = (float(loaded), float(scanned), int(loaded_rss), int(rss))
+        roll, mapped = results['roll'], results['store']
+        print(f"Startup: roll as dicts {roll[0]:.2f}s / {roll[2] / 2**20:.0f} MiB RSS, "
+              f"template store {mapped[0] * 1000:.2f}ms / {mapped[2] / 2**20:.1f} MiB RSS")
+        print(f"Every template: base64 decode {roll[1]:.2f}s (RSS {roll[3] / 2**20:.0f} MiB), "
+              f"store lookup + read {mapped[1]:.2f}s (RSS {mapped[3] / 2**20:.0f} MiB, page cache shared between workers)")
+
+        matcher = LocalMatcher()
+        sample = [f'V{i:07d}' for i in range(min(1000, args.voters))]
+        by_id = {voter_id: templates[i % len(templates)] for i, voter_id in enumerate(sample)}
+        probes = [perturb_template(templates[i % len(templates)], 10_000 + i) for i in range(args.probes)]
+        timings = {}
+        for label, lookup in (('base64', by_id.get), ('memoryview', store.get)):
+            start = time.perf_counter()
+            for probe in probes:
+                data = decode_template(probe)
+                for voter_id in sample:
+                    matcher.match(data, lookup(voter_id))
+            timings[label] = (time.perf_counter() - start) / len(probes)
+        print(f"1:{len(sample)} scoring: base64 {timings['base64'] * 1000:.1f} ms/probe, "
+              f"memoryview {timings['memoryview'] * 1000:.1f} ms/probe")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Size and scan time of votes.csv vs the columnar vote snapshot.
+
+Writes a votes.csv with synthetic votes spread over the polling hours, then
+snapshots it compressed and uncompressed (vote_snapshot.write_snapshot) and
+times, from CSV and from each snapshot:
+
+- tally: votes per (state, constituency) and candidate (storage.tally_rows over
+  CsvVoteRepository.log() vs vote_snapshot.tally)
+- turnout: votes per hour (grouping the timestamp text vs
+  vote_snapshot.turnout_by_hour)
+- rows: reading every vote back as a dict
+
+The write time of a snapshot includes reading votes.csv.
+
+    python benchmarks/bench_vote_snapshot.py --votes 1000000
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_election import PARTIES, voter_id  # noqa: E402
+from candidate_import import KNOWN_STATES  # noqa: E402
+from storage import VOTE_FIELDS, CsvVoteRepository, tally_rows  # noqa: E402
+from vote_snapshot import VoteSnapshot, tally, turnout_by_hour, write_snapshot  # noqa: E402
+
+
+def write_votes(path, votes, constituencies, candidates_per_seat, seed):
+    rng = random.Random(seed)
+    states = list(KNOWN_STATES)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(VOTE_FIELDS)
+        for i in range(votes):
+            seat = rng.randrange(constituencies)
+            k = rng.randrange(candidates_per_seat)
+            day = 1 + rng.randrange(3)
+            timestamp = f'2025-04-{day:02d} {7 + rng.randrange(11):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}'
+            writer.writerow([timestamp[:10], voter_id(i), f'Voter {i}', states[seat % len(states)],
+                             f'Constituency {seat:04d}', f'Candidate {seat * candidates_per_seat + k + 1}',
+                             PARTIES[k % len(PARTIES)], timestamp])
+
+
+def csv_turnout(path):
+    hours = Counter(row['timestamp'][:13] for row in CsvVoteRepository(path).log() if row.get('timestamp'))
+    return {hour + ':00': n for hour, n in sorted(hours.items())}
+
+
+def timed(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--votes', type=int, default=1000000)
+    parser.add_argument('--constituencies', type=int, default=543)
+    parser.add_argument('--candidates', type=int, default=8, help='candidates per constituency')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement; the best is reported')
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='vms-snapshot-bench-')
+    try:
+        csv_path = os.path.join(workdir, 'votes.csv')
+        print(f"Writing {args.votes} votes...")
+        write_votes(csv_path, args.votes, args.constituencies, args.candidates, args.seed)
+        formats = {'csv': csv_path}
+        write_times = {}
+        for name, compress in (('snapshot', True), ('snapshot (raw)', False)):
+            path = os.path.join(workdir, f'votes-{int(compress)}.snapshot')
+            write_times[name], _ = timed(lambda: write_snapshot(path, CsvVoteRepository(csv_path).log(),
+                                                                compress=compress), 1)
+            formats[name] = path
+
+        expected_tally = tally_rows(CsvVoteRepository(csv_path).log())
+        expected_turnout = csv_turnout(csv_path)
+        rows = []
+        for name, path in formats.items():
+            if name == 'csv':
+                tally_s, counts = timed(lambda: tally_rows(CsvVoteRepository(path).log()), args.repeat)
+                turnout_s, turnout = timed(lambda: csv_turnout(path), args.repeat)
+                rows_s, _ = timed(lambda: sum(1 for _ in CsvVoteRepository(path).log()), args.repeat)
+            else:
+                # A fresh VoteSnapshot each time, so reading the columns is timed too
+                tally_s, counts = timed(lambda: tally(VoteSnapshot(path)), args.repeat)
+                turnout_s, turnout = timed(lambda: turnout_by_hour(VoteSnapshot(path)), args.repeat)
+                rows_s, _ = timed(lambda: sum(1 for _ in VoteSnapshot(path).log()), args.repeat)
+            rows.append({
+                'format': name,
+                'bytes': os.path.getsize(path),
+                'write_s': round(write_times[name], 3) if name in write_times else None,
+                'tally_s': round(tally_s, 3),
+                'turnout_s': round(turnout_s, 3),
+                'rows_s': round(rows_s, 3),
+                'same_results': counts == expected_tally and turnout == expected_turnout,
+            })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    base = rows[0]
+    header = (f"{'format':<16}{'MiB':>9}{'size':>8}{'write s':>9}{'tally s':>9}{'turnout s':>11}"
+              f"{'rows s':>9}{'same':>6}")
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        write_s = f"{row['write_s']:.2f}" if row['format'] in write_times else '-'
+        print(f"{row['format']:<16}{row['bytes'] / 2**20:>9.1f}{row['bytes'] / base['bytes']:>7.0%} "
+              f"{write_s:>9}{row['tally_s']:>9.3f}{row['turnout_s']:>11.3f}{row['rows_s']:>9.2f}"
+              f"{'yes' if row['same_results'] else 'NO':>6}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'votes': args.votes, 'runs': rows}, f, indent=2)
+    return 0 if all(row['same_results'] for row in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Content-addressed storage for fingerprint BMP images.
+
+Images are stored as binary files named by the SHA-256 of their content,
+fanned out into two-character subdirectories. voters.csv only keeps the
+hash (``bmp_hash``), so the roll stays small and images are read from disk
+only when someone actually views them.
+
+One-shot migration of a legacy voters.csv (with an inline bmp_base64
+column) to the hashed layout:
+
+    python blob_store.py migrate voters.csv --store fingerprint_images
+"""
+import argparse
+import base64
+import csv
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from voter_registry import VOTER_FIELDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOB_DIR = 'fingerprint_images'
+
+
+class BlobStore:
+    """Binary files keyed by the SHA-256 hex digest of their content."""
+
+    def __init__(self, root=DEFAULT_BLOB_DIR):
+        self.root = root
+
+    def path_for(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    @staticmethod
+    def is_key(key):
+        return len(key or '') == 64 and all(c in '0123456789abcdef' for c in key)
+
+    # Store bytes and return their key; storing the same content twice is a no-op
+    def put(self, data):
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path_for(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return key
+
+    def put_base64(self, data_base64):
+        return self.put(base64.b64decode(data_base64))
+
+    # Return the stored bytes, or None if the key is unknown
+    def get(self, key):
+        if not self.is_key(key):
+            return None
+        try:
+            with open(self.path_for(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_base64(self, key):
+        data = self.get(key)
+        return base64.b64encode(data).decode('ascii') if data is not None else None
+
+    def exists(self, key):
+        return self.is_key(key) and os.path.exists(self.path_for(key))
+
+    # Remove every stored blob
+    def clear(self):
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+
+
+# True if voters.csv still has the inline bmp_base64 column
+def is_legacy_voters_csv(csv_path):
+    if not os.path.exists(csv_path):
+        return False
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        header = next(csv.reader(f), [])
+    return 'bmp_base64' in header
+
+
+# Move inline images from a legacy voters.csv into the blob store and
+# rewrite the file with a bmp_hash column. Returns the number of images moved.
+def migrate_voters_csv(csv_path, store, backup_path=None):
+    if not is_legacy_voters_csv(csv_path):
+        return 0
+    original_limit = csv.field_size_limit()
+    csv.field_size_limit(min(2**31-1, sys.maxsize))
+    moved = 0
+    directory = os.path.dirname(os.path.abspath(csv_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.voters-', suffix='.csv')
+    try:
+        with open(csv_path, 'r', encoding='utf-8', newline='') as src, \
+                os.fdopen(fd, 'w', encoding='utf-8', newline='') as dst:
+            writer = csv.writer(dst)
+            writer.writerow(VOTER_FIELDS)
+            for row in csv.DictReader(src):
+                bmp = (row.get('bmp_base64') or '').strip()
+                key = ''
+                if bmp:
+                    try:
+                        key = store.put_base64(bmp)
+                        moved += 1
+                    except ValueError:
+                        logger.warning("Invalid image data for voter %s, image dropped", row.get('voter_id'))
+                writer.writerow([row.get('voter_id', ''), row.get('name', ''), row.get('template_base64', ''),
+                                 key, row.get('registration_date', '')])
+        if backup_path:
+            shutil.copy2(csv_path, backup_path)
+        os.replace(tmp_path, csv_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        csv.field_size_limit(original_limit)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fingerprint image blob store tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+    migrate = sub.add_parser('migrate', help='move inline bmp_base64 images out of voters.csv')
+    migrate.add_argument('csv_path', nargs='?', default='voters.csv')
+    migrate.add_argument('--store', default=DEFAULT_BLOB_DIR)
+    migrate.add_argument('--backup', help='copy the original file here before rewriting it')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        if not is_legacy_voters_csv(args.csv_path):
+            print(f"{args.csv_path} is already in the hashed-image format")
+            return
+        before = os.path.getsize(args.csv_path)
+        moved = migrate_voters_csv(args.csv_path, BlobStore(args.store), args.backup)
+        after = os.path.getsize(args.csv_path)
+        print(f"Moved {moved} images to {args.store}; {args.csv_path}: {before:,} -> {after:,} bytes")
+
+
+if __name__ == '__main__':
+    main()
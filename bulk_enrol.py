@@ -0,0 +1,276 @@
+"""Bulk voter enrolment for pre-election registration drives.
+
+Reads records (voter_id, name, template_base64 and optionally bmp_base64) in
+batches. Each batch goes through three steps:
+
+1. checks, in a thread pool: the template must decode, the voter ID must not
+   be enrolled yet, the template digest must not be in the digest index and,
+   in fuzzy mode, no enrolled voter may match the fingerprint closely
+2. duplicates within the batch (same ID, same digest or, in fuzzy mode, a
+   close match with an earlier record of the batch) are rejected in input
+   order, so the first record wins
+3. the accepted records are written with one append to the voter roll and
+   one to the digest index; their images are stored in parallel
+
+Every record gets a line in the report (enrolled, invalid, duplicate_id or
+duplicate_biometric), and the summary gives the throughput.
+
+    python bulk_enrol.py records.csv --report report.csv
+    python bulk_enrol.py records.csv --fuzzy --workers 16 --storage sqlite --db vms.sqlite3
+
+The input may be a legacy voters.csv with inline bmp_base64 images.
+"""
+import argparse
+import base64
+import binascii
+import csv
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from digest_index import template_digest
+from template_index import TemplateIndex, DEFAULT_SHORTLIST_SIZE
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+DEFAULT_WORKERS = 8
+# Same default as DUPLICATE_MATCH_THRESHOLD in app.py
+DEFAULT_DUPLICATE_THRESHOLD = 60
+
+ENROLLED = 'enrolled'
+INVALID = 'invalid'
+DUPLICATE_ID = 'duplicate_id'
+DUPLICATE_BIOMETRIC = 'duplicate_biometric'
+
+REPORT_FIELDS = ['line', 'voter_id', 'status', 'detail']
+
+
+# (line number, record) pairs from a CSV text stream
+def read_enrolment_csv(text):
+    original_limit = csv.field_size_limit()
+    # Inline images are far larger than the default field limit
+    csv.field_size_limit(min(2**31-1, sys.maxsize))
+    try:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    finally:
+        csv.field_size_limit(original_limit)
+
+
+class EnrolmentReport:
+    def __init__(self):
+        self.records = []
+        self.counts = {ENROLLED: 0, INVALID: 0, DUPLICATE_ID: 0, DUPLICATE_BIOMETRIC: 0}
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add(self, line, voter_id, status, detail=''):
+        self.records.append({'line': line, 'voter_id': voter_id, 'status': status, 'detail': detail})
+        self.counts[status] += 1
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def summary(self):
+        total = len(self.records)
+        return {
+            'records': total,
+            **self.counts,
+            'seconds': round(self.elapsed, 3),
+            'records_per_second': round(total / self.elapsed, 1) if self.elapsed else 0,
+        }
+
+    def rejected(self):
+        return [record for record in self.records if record['status'] != ENROLLED]
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(sorted(self.records, key=lambda record: record['line']))
+
+
+class BulkEnroller:
+    def __init__(self, registry, blob_store, digest_index, template_index=None, find_similar=None,
+                 engine=None, duplicate_threshold=DEFAULT_DUPLICATE_THRESHOLD,
+                 workers=DEFAULT_WORKERS, batch_size=BATCH_SIZE, template_store=None):
+        # find_similar(template) -> voter_id of a close match on the roll, or
+        # None; given only in fuzzy mode. engine (an IdentificationEngine) is
+        # then used to compare records within a batch.
+        self.registry = registry
+        self.blob_store = blob_store
+        self.digest_index = digest_index
+        self.template_index = template_index
+        self.find_similar = find_similar
+        self.engine = engine
+        self.duplicate_threshold = duplicate_threshold
+        self.workers = workers
+        self.batch_size = batch_size
+        self.template_store = template_store
+
+    def enrol(self, records):
+        report = EnrolmentReport()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            batch = []
+            for item in records:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._enrol_batch(pool, batch, report)
+                    batch = []
+            if batch:
+                self._enrol_batch(pool, batch, report)
+        report.finish()
+        return report
+
+    # Step 1: checks against the existing roll; runs in the pool
+    def _check(self, item):
+        line, record = item
+        voter_id = (record.get('voter_id') or '').strip().upper()
+        name = (record.get('name') or '').strip()
+        template = (record.get('template_base64') or '').strip()
+        checked = {'line': line, 'voter_id': voter_id, 'name': name, 'template_base64': template,
+                   'bmp_base64': (record.get('bmp_base64') or '').strip(), 'digest': None}
+        if not voter_id or not name or len(template) <= 10:
+            return checked, INVALID, 'Missing voter_id, name or template'
+        try:
+            base64.b64decode(''.join(template.split()), validate=True)
+        except (binascii.Error, ValueError):
+            return checked, INVALID, 'Template is not valid base64'
+        if self.registry.get(voter_id) is not None:
+            return checked, DUPLICATE_ID, f'Voter ID {voter_id} is already registered'
+        checked['digest'] = template_digest(template)
+        existing = self.digest_index.lookup_digest(checked['digest'])
+        if existing:
+            return checked, DUPLICATE_BIOMETRIC, f'Same fingerprint as voter {existing}'
+        if self.find_similar is not None:
+            similar = self.find_similar(template)
+            if similar:
+                return checked, DUPLICATE_BIOMETRIC, f'Fingerprint matches voter {similar}'
+        return checked, ENROLLED, ''
+
+    def _enrol_batch(self, pool, batch, report):
+        # Step 2: duplicates within the batch, first record wins
+        ids = set()
+        digests = {}
+        batch_index = TemplateIndex() if self.find_similar is not None and self.engine is not None else None
+        batch_voters = {}
+        accepted = []
+        for checked, status, detail in pool.map(self._check, batch):
+            voter_id = checked['voter_id']
+            if status == ENROLLED:
+                if voter_id in ids:
+                    status, detail = DUPLICATE_ID, f'Voter ID {voter_id} appears earlier in the batch'
+                elif checked['digest'] in digests:
+                    status, detail = DUPLICATE_BIOMETRIC, f"Same fingerprint as voter {digests[checked['digest']]} in the batch"
+                elif batch_index is not None and len(batch_index):
+                    similar = self._similar_in_batch(batch_index, batch_voters, checked['template_base64'])
+                    if similar:
+                        status, detail = DUPLICATE_BIOMETRIC, f'Fingerprint matches voter {similar} in the batch'
+            if status != ENROLLED:
+                report.add(checked['line'], voter_id, status, detail)
+                continue
+            ids.add(voter_id)
+            digests[checked['digest']] = voter_id
+            if batch_index is not None:
+                batch_index.add(voter_id, checked['template_base64'])
+                batch_voters[voter_id] = {'voter_id': voter_id, 'name': checked['name'],
+                                          'template_base64': checked['template_base64']}
+            accepted.append(checked)
+        if accepted:
+            self._commit(pool, accepted, report)
+
+    def _similar_in_batch(self, batch_index, batch_voters, template):
+        shortlist = batch_index.shortlist(template, DEFAULT_SHORTLIST_SIZE)
+        candidates = list(batch_voters.values()) if shortlist is None else [batch_voters[v] for v in shortlist]
+        result = self.engine.identify(template, candidates)
+        if result['matched'] and result['score'] >= self.duplicate_threshold:
+            return result['voter_id']
+        return None
+
+    def _store_image(self, checked):
+        if not checked['bmp_base64']:
+            return ''
+        try:
+            return self.blob_store.put_base64(checked['bmp_base64'])
+        except ValueError as e:
+            logger.warning("Could not store fingerprint image for %s: %s", checked['voter_id'], e)
+            return ''
+
+    # Step 3: one append per store for the whole batch
+    def _commit(self, pool, accepted, report):
+        registration_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        bmp_hashes = list(pool.map(self._store_image, accepted))
+        self.registry.extend([{
+            'voter_id': checked['voter_id'],
+            'name': checked['name'],
+            'template_base64': checked['template_base64'],
+            'bmp_hash': bmp_hash,
+            'registration_date': registration_date,
+        } for checked, bmp_hash in zip(accepted, bmp_hashes)])
+        self.digest_index.add_digests([(checked['digest'], checked['voter_id']) for checked in accepted])
+        if self.template_store is not None:
+            self.template_store.add_many([(checked['voter_id'], checked['template_base64']) for checked in accepted])
+        for checked, bmp_hash in zip(accepted, bmp_hashes):
+            if self.template_index is not None:
+                self.template_index.add(checked['voter_id'], checked['template_base64'])
+            detail = '' if bmp_hash or not checked['bmp_base64'] else 'Image could not be stored'
+            report.add(checked['line'], checked['voter_id'], ENROLLED, detail)
+        logger.info("Bulk enrolment: %d enrolled, %d records processed", report.counts[ENROLLED], len(report.records))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enrol many voters from a CSV file')
+    parser.add_argument('csv_path', help='CSV with voter_id, name, template_base64 and optional bmp_base64')
+    parser.add_argument('--report', help='write the per-record report to this CSV file')
+    parser.add_argument('--storage', default='csv', choices=['csv', 'sqlite'])
+    parser.add_argument('--db', default='vms.sqlite3', help='SQLite database path')
+    parser.add_argument('--fuzzy', action='store_true', help='also reject close fingerprint matches')
+    parser.add_argument('--matcher', default=None, help='matcher backend for --fuzzy (default: MATCHER_BACKEND)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    from blob_store import BlobStore
+    from digest_index import DigestIndex
+    from matcher import IdentificationEngine, get_matcher
+    from storage import get_storage
+
+    storage = get_storage(args.storage, sqlite_path=args.db)
+    storage.init()
+    registry = storage.voters
+    digest_index = DigestIndex('template_digests.csv')
+    digest_index.sync(registry)
+    template_index = find_similar = engine = None
+    if args.fuzzy:
+        engine = IdentificationEngine(get_matcher(args.matcher), workers=args.workers)
+        template_index = TemplateIndex()
+        template_index.build(registry.voters())
+
+        def find_similar(template):
+            shortlist = template_index.shortlist(template, DEFAULT_SHORTLIST_SIZE)
+            candidates = registry.voters() if shortlist is None else \
+                [voter for voter in map(registry.get, shortlist) if voter is not None]
+            if not candidates:
+                return None
+            result = engine.identify(template, candidates)
+            return result['voter_id'] if result['matched'] and result['score'] >= DEFAULT_DUPLICATE_THRESHOLD else None
+
+    enroller = BulkEnroller(registry, BlobStore('fingerprint_images'), digest_index, template_index,
+                            find_similar, engine, workers=args.workers, batch_size=args.batch_size)
+    with open(args.csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+        report = enroller.enrol(read_enrolment_csv(f))
+    if args.report:
+        report.write_csv(args.report)
+    for record in report.rejected()[:20]:
+        print(f"line {record['line']}: {record['voter_id']} {record['status']} - {record['detail']}")
+    print(report.summary())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
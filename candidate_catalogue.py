@@ -0,0 +1,115 @@
+"""Precompiled candidate catalogue for the voting booths.
+
+The candidate list is read once per change of the candidates store and
+grouped into a State -> Constituency -> candidates tree. Every slice the
+booths ask for (the state/constituency index, one state, one constituency,
+or the full flat list) is serialised to JSON once, gzipped once and given an
+ETag, so serving it is a dictionary lookup and repeat requests get a 304.
+"""
+import gzip
+import hashlib
+import json
+import threading
+
+# Only responses larger than this are worth compressing
+GZIP_MIN_BYTES = 512
+
+
+class CachedBody:
+    """One pre-serialised JSON document."""
+
+    __slots__ = ('body', 'gzip_body', 'etag')
+
+    def __init__(self, payload):
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.gzip_body = gzip.compress(self.body, mtime=0) if len(self.body) >= GZIP_MIN_BYTES else None
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+class CandidateCatalogue:
+    def __init__(self, source):
+        # source: a candidates repository providing all() and version()
+        self.source = source
+        self._lock = threading.Lock()
+        self._version = None
+        self._built = False
+        self._tree = {}
+        self._candidates = []
+        self._bodies = {}
+        self.builds = 0
+
+    def _build(self):
+        candidates = []
+        tree = {}
+        for row in self.source.all():
+            candidate = {field: (value or '').strip() for field, value in row.items() if field}
+            state, constituency = candidate.get('State', ''), candidate.get('Constituency', '')
+            candidates.append(candidate)
+            if state and constituency:
+                tree.setdefault(state, {}).setdefault(constituency, []).append(candidate)
+        self._candidates = candidates
+        self._tree = {state: dict(sorted(tree[state].items())) for state in sorted(tree)}
+        self._bodies = {}
+        self.builds += 1
+
+    # Rebuild if the candidates store changed (e.g. upload by another worker)
+    def refresh(self):
+        with self._lock:
+            version = self.source.version()
+            if not self._built or version != self._version:
+                self._build()
+                self._version = version
+                self._built = True
+
+    # Drop the compiled catalogue; the next request rebuilds it
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+
+    def _body(self, key, make_payload):
+        body = self._bodies.get(key)
+        if body is None:
+            body = self._bodies[key] = CachedBody(make_payload())
+        return body
+
+    # ---- slices; each returns a CachedBody or None for an unknown slice ----
+
+    # {state: [constituency, ...]}
+    def index(self):
+        self.refresh()
+        with self._lock:
+            return self._body(('index',), lambda: {
+                'states': {state: list(constituencies) for state, constituencies in self._tree.items()}})
+
+    def state(self, state):
+        self.refresh()
+        with self._lock:
+            constituencies = self._tree.get(state)
+            if constituencies is None:
+                return None
+            return self._body(('state', state), lambda: {'state': state, 'constituencies': constituencies})
+
+    def constituency(self, state, constituency):
+        self.refresh()
+        with self._lock:
+            candidates = self._tree.get(state, {}).get(constituency)
+            if candidates is None:
+                return None
+            return self._body(('constituency', state, constituency), lambda: {
+                'state': state, 'constituency': constituency, 'candidates': candidates})
+
+    # Full flat list, as served by /get_candidates_json
+    def all(self):
+        self.refresh()
+        with self._lock:
+            return self._body(('all',), lambda: self._candidates)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'candidates': len(self._candidates),
+                'states': len(self._tree),
+                'constituencies': sum(len(c) for c in self._tree.values()),
+                'cached_slices': len(self._bodies),
+                'builds': self.builds,
+            }
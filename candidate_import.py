@@ -0,0 +1,147 @@
+"""Validated, streaming import of the candidate list.
+
+Uploaded CSV rows are checked one at a time while they are written to the
+candidates store, so even a national list of hundreds of thousands of rows
+is never held in memory. The new list only replaces the old one if every
+row passed; otherwise the old list stays and the report says which rows are
+wrong:
+
+- the header must contain _id, State, Constituency, Party, Candidate Name
+- _id, State, Constituency and Candidate Name must not be empty
+- _id must be unique
+- State must be one of KNOWN_STATES (matched ignoring case and spacing and
+  stored with the canonical spelling)
+
+Check a file without importing it:
+
+    python candidate_import.py "folder of the csv/list of the candidtes.csv"
+"""
+import argparse
+import csv
+import io
+import sys
+
+from storage import CANDIDATE_FIELDS
+
+REQUIRED_FIELDS = ['_id', 'State', 'Constituency', 'Candidate Name']
+
+# States and union territories as spelled in the national candidate list
+KNOWN_STATES = (
+    'Andaman & Nicobar Islands', 'Andhra Pradesh', 'Arunachal Pradesh', 'Assam', 'Bihar', 'Chandigarh',
+    'Chhattisgarh', 'Dadra & Nagar Haveli and Daman & Diu', 'Goa', 'Gujarat', 'Haryana', 'Himachal Pradesh',
+    'Jammu and Kashmir', 'Jharkhand', 'Karnataka', 'Kerala', 'Ladakh', 'Lakshadweep', 'Madhya Pradesh',
+    'Maharashtra', 'Manipur', 'Meghalaya', 'Mizoram', 'NCT OF Delhi', 'Nagaland', 'Odisha', 'Puducherry',
+    'Punjab', 'Rajasthan', 'Sikkim', 'Tamil Nadu', 'Telangana', 'Tripura', 'Uttar Pradesh', 'Uttarakhand',
+    'West Bengal',
+)
+
+# Only the first errors are listed; the rest are just counted
+MAX_REPORTED_ERRORS = 200
+
+
+def _state_key(name):
+    return ' '.join(name.split()).casefold()
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    @property
+    def ok(self):
+        return self.error_count == 0
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+
+# Yield normalised candidate rows from a CSV text stream, recording every
+# problem in `report`. Memory use is one row plus the set of seen _ids.
+def validate_candidates(text, report, known_states=KNOWN_STATES):
+    reader = csv.reader(text)
+    header = [name.strip() for name in next(reader, [])]
+    missing = [field for field in CANDIDATE_FIELDS if field not in header]
+    if missing:
+        report.error(1, f"Missing column(s): {', '.join(missing)}")
+        return
+    columns = {field: header.index(field) for field in CANDIDATE_FIELDS}
+    states = {_state_key(state): state for state in known_states} if known_states else None
+    seen_ids = set()
+    for values in reader:
+        line = reader.line_num
+        if not any(value.strip() for value in values):
+            continue  # Skip empty rows
+        report.rows += 1
+        row = {field: (values[index] if index < len(values) else '').strip() for field, index in columns.items()}
+        empty = [field for field in REQUIRED_FIELDS if not row[field]]
+        if empty:
+            report.error(line, f"Empty {', '.join(empty)}")
+            continue
+        if row['_id'] in seen_ids:
+            report.error(line, f"Duplicate _id {row['_id']}")
+            continue
+        seen_ids.add(row['_id'])
+        if states is not None:
+            state = states.get(_state_key(row['State']))
+            if state is None:
+                report.error(line, f"Unknown state {row['State']!r}")
+                continue
+            row['State'] = state
+        report.imported += 1
+        yield row
+    if report.rows == 0:
+        report.error(None, 'No candidate rows')
+
+
+# Validate an uploaded CSV (binary stream) and, if every row is valid, make
+# it the candidate list of `repository` in one atomic swap.
+def import_candidates(stream, repository, known_states=KNOWN_STATES):
+    report = ImportReport()
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        replaced = repository.replace(validate_candidates(text, report, known_states), accept=lambda: report.ok)
+    except UnicodeDecodeError:
+        report.error(None, 'File is not UTF-8 text')
+        replaced = False
+    except csv.Error as e:
+        report.error(None, f"Unreadable CSV: {e}")
+        replaced = False
+    finally:
+        text.detach()
+    if not replaced:
+        report.imported = 0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a candidates CSV file without importing it')
+    parser.add_argument('csv_path')
+    args = parser.parse_args()
+
+    report = ImportReport()
+    with open(args.csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+        for _ in validate_candidates(f, report):
+            pass
+    for error in report.errors:
+        print(f"line {error['line']}: {error['error']}")
+    if report.error_count > len(report.errors):
+        print(f"... and {report.error_count - len(report.errors)} more")
+    print(f"{report.rows} rows, {report.imported} valid, {report.error_count} errors")
+    return 0 if report.ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
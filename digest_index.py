@@ -0,0 +1,144 @@
+"""Persisted digest index for O(1) duplicate-biometric checks.
+
+Each enrolled template is reduced to the SHA-256 of its normalised decoded
+form and stored in ``template_digests.csv`` (digest, voter_id). The file is
+append-only while voters register and is rewritten from voters.csv whenever
+it no longer agrees with the roll.
+"""
+import binascii
+import csv
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+
+from matcher import decode_template, parse_iso_template
+
+logger = logging.getLogger(__name__)
+
+DIGEST_FIELDS = ['digest', 'voter_id']
+
+
+# SHA-256 of the normalised template: base64 whitespace/padding differences
+# are removed by decoding, and ISO records are reduced to their sorted
+# minutiae so the same minutiae in a different order or with a different
+# extended-data block give the same digest.
+def template_digest(template):
+    try:
+        data = decode_template(template)
+    except (binascii.Error, ValueError, TypeError):
+        return hashlib.sha256((template or '').strip().encode('utf-8')).hexdigest()
+    try:
+        minutiae = sorted(parse_iso_template(data))
+        data = b'ISO' + b''.join(struct.pack('>HHBB', *m) for m in minutiae)
+    except ValueError:
+        pass
+    return hashlib.sha256(data).hexdigest()
+
+
+class DigestIndex:
+    """digest -> voter_id map backed by a CSV file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._by_digest = None
+        # (registry generation, number of its voters covered)
+        self._source = None
+
+    def _load(self):
+        by_digest = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    if row.get('digest') and row.get('voter_id'):
+                        by_digest.setdefault(row['digest'], row['voter_id'])
+        self._by_digest = by_digest
+
+    def _loaded(self):
+        if self._by_digest is None:
+            self._load()
+        return self._by_digest
+
+    # Make sure the index covers exactly the voters in the registry. Voters
+    # the registry read from appended rows are added (their digests were
+    # written by the process that enrolled them); the whole roll is only
+    # re-checked after the registry reloads voters.csv from disk.
+    def sync(self, registry):
+        with self._lock:
+            if self._source is not None and self._by_digest is not None:
+                generation, added = registry.changes_since(*self._source)
+                if added is not None:
+                    for voter in added:
+                        self._by_digest.setdefault(template_digest(voter['template_base64']), voter['voter_id'])
+                    self._source = (generation, self._source[1] + len(added))
+                    return
+            voters = registry.voters()
+            by_digest = self._loaded()
+            indexed_ids = {voter_id.upper() for voter_id in by_digest.values()}
+            roll_ids = {voter['voter_id'].upper() for voter in voters}
+            if not os.path.exists(self.path) or indexed_ids != roll_ids:
+                logger.info("Rebuilding %s from %d voters", self.path, len(voters))
+                self._rebuild(voters)
+            self._source = (registry.generation, len(voters))
+
+    def _rebuild(self, voters):
+        by_digest = {}
+        rows = []
+        for voter in voters:
+            digest = template_digest(voter['template_base64'])
+            if digest not in by_digest:
+                by_digest[digest] = voter['voter_id']
+                rows.append([digest, voter['voter_id']])
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.digests-', suffix='.csv')
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(DIGEST_FIELDS)
+            writer.writerows(rows)
+        os.replace(tmp_path, self.path)
+        self._by_digest = by_digest
+
+    # Voter ID already enrolled with this template, or None
+    def lookup(self, template):
+        return self.lookup_digest(template_digest(template))
+
+    def lookup_digest(self, digest):
+        with self._lock:
+            return self._loaded().get(digest)
+
+    # Record a newly enrolled voter (called by save_voter)
+    def add(self, voter_id, template):
+        self.add_digests([(template_digest(template), voter_id)])
+
+    # Record many (digest, voter_id) pairs with a single append
+    def add_digests(self, pairs):
+        with self._lock:
+            by_digest = self._loaded()
+            rows = []
+            for digest, voter_id in pairs:
+                if digest not in by_digest:
+                    by_digest[digest] = voter_id
+                    rows.append([digest, voter_id])
+            if not rows:
+                return
+            new_file = not os.path.exists(self.path)
+            with open(self.path, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(DIGEST_FIELDS)
+                writer.writerows(rows)
+
+    # Drop every entry (called by delete_voters)
+    def clear(self):
+        with self._lock:
+            with open(self.path, 'w', encoding='utf-8', newline='') as f:
+                csv.writer(f).writerow(DIGEST_FIELDS)
+            self._by_digest = {}
+            self._source = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._loaded())
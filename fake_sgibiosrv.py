@@ -0,0 +1,285 @@
+"""Stand-in for the SecuGen WebAPI service (SgiBioSrv) without a scanner.
+
+Serves the two endpoints the app and its pages use, with the same form
+parameters and JSON fields:
+
+- POST /SGIFPCapture (timeout, quality, licstr, templateformat,
+  imagewsqrate, fakeDetection): returns a simulated capture. Captures walk
+  through a fixed population of synthetic fingers (finger n is the
+  template of ``synthetic_template(n)``, as used by the benchmarks), each
+  finger scanned ``captures_per_finger`` times in a row, so a
+  register/login flow gets consecutive scans of the same finger. A
+  ``finger`` form field picks the finger explicitly.
+- POST /SGIMatchScore (licstr, Template1, Template2, Templateformat):
+  scores two templates with LocalMatcher, or in ``exact`` mode gives 199
+  for the same minutiae and 0 otherwise.
+
+Everything is deterministic for a given --seed. Latency (fixed plus
+jitter) and failures can be injected: a share of requests returns one of
+the SecuGen error codes (see TranslateErrorNumber in app.py), and a share
+can be dropped without a response to simulate an unreachable service.
+GET /stats returns request counters.
+
+    python fake_sgibiosrv.py --port 8443 --cert cert.pem --key key.pem
+    python fake_sgibiosrv.py --port 8080 --match-latency-ms 15 --error-rate 0.02 --error-codes 54,59
+    MATCHER_BACKEND=secugen SGI_MATCH_URL=http://localhost:8080/SGIMatchScore python app.py
+
+Without --cert/--key it serves plain HTTP.
+"""
+import argparse
+import base64
+import json
+import random
+import ssl
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from digest_index import template_digest
+from matcher import LocalMatcher, MAX_SCORE, perturb_template, synthetic_template
+
+# Error codes injected by default: capture timeout, no device, device busy
+DEFAULT_ERROR_CODES = (54, 55, 59)
+WRONG_IMAGE = 57
+
+IMAGE_WIDTH = 260
+IMAGE_HEIGHT = 300
+IMAGE_DPI = 500
+DEVICE = {'Manufacturer': 'SecuGen', 'Model': 'HU20-A (simulated)', 'SerialNumber': 'FAKE00000001'}
+
+
+# 8-bit greyscale BMP, as returned by SecuGen Hamster devices
+def synthetic_bmp(seed, width=IMAGE_WIDTH, height=IMAGE_HEIGHT):
+    rng = random.Random(seed)
+    row = (width + 3) & ~3
+    palette = b''.join(bytes((i, i, i, 0)) for i in range(256))
+    pixels = rng.randbytes(row * height)
+    offset = 14 + 40 + len(palette)
+    header = b'BM' + struct.pack('<IHHI', offset + len(pixels), 0, 0, offset)
+    info = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 8, 0, len(pixels), 19685, 19685, 256, 0)
+    return header + info + palette + pixels
+
+
+class FakeSgiBioSrv:
+    def __init__(self, host='127.0.0.1', port=8443, scoring='local', fingers=1000, captures_per_finger=2,
+                 match_latency_ms=0.0, capture_latency_ms=0.0, jitter_ms=0.0, error_rate=0.0,
+                 error_codes=DEFAULT_ERROR_CODES, drop_rate=0.0, seed=0, certfile=None, keyfile=None):
+        self.host = host
+        self.port = port
+        self.scoring = scoring
+        self.fingers = fingers
+        self.captures_per_finger = captures_per_finger
+        self.match_latency = match_latency_ms / 1000
+        self.capture_latency = capture_latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.drop_rate = drop_rate
+        self.seed = seed
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.matcher = LocalMatcher()
+        self._lock = threading.Lock()
+        # One random stream for faults/latency and one for captures, so the
+        # capture sequence does not depend on how many faults were drawn
+        self._faults = random.Random(seed)
+        self._captures = 0
+        self._bmp_cache = {}
+        self.counts = {'capture': 0, 'match': 0, 'errors': 0, 'dropped': 0}
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        scheme = 'https' if self.certfile else 'http'
+        return f'{scheme}://{self.host}:{self.port}'
+
+    # ---- behaviour ----
+
+    # (delay in seconds, injected error code or 0, drop the request?)
+    def _draw_fault(self, latency):
+        with self._lock:
+            delay = max(0.0, latency + (self._faults.uniform(-self.jitter, self.jitter) if self.jitter else 0.0))
+            drop = self.drop_rate and self._faults.random() < self.drop_rate
+            error = 0
+            if not drop and self.error_rate and self._faults.random() < self.error_rate:
+                error = self._faults.choice(self.error_codes)
+            return delay, error, drop
+
+    def _next_finger(self):
+        with self._lock:
+            n = self._captures
+            self._captures += 1
+        slot = n // self.captures_per_finger
+        return random.Random(self.seed * 1_000_003 + slot).randrange(self.fingers), n
+
+    def capture(self, form):
+        finger = form.get('finger')
+        if finger is not None and finger.isdigit():
+            finger, n = int(finger), self._next_finger()[1]
+        else:
+            finger, n = self._next_finger()
+        quality = random.Random(n).randint(60, 100)
+        template = perturb_template(synthetic_template(finger), seed=self.seed * 1_000_003 + n)
+        bmp = self._bmp_cache.get(finger)
+        if bmp is None:
+            bmp = self._bmp_cache[finger] = base64.b64encode(synthetic_bmp(finger)).decode('ascii')
+        return {
+            'ErrorCode': 0,
+            **DEVICE,
+            'ImageWidth': IMAGE_WIDTH,
+            'ImageHeight': IMAGE_HEIGHT,
+            'ImageDPI': IMAGE_DPI,
+            'ImageQuality': quality,
+            'NFIQ': 1 + (100 - quality) // 20,
+            'TemplateBase64': template,
+            'WSQImageSize': 0,
+            'WSQImage': '',
+            'BMPBase64': bmp,
+        }
+
+    def match(self, form):
+        template1 = (form.get('Template1') or '').strip()
+        template2 = (form.get('Template2') or '').strip()
+        if not template1 or not template2:
+            return {'ErrorCode': WRONG_IMAGE, 'MatchingScore': 0}
+        if self.scoring == 'exact':
+            score = MAX_SCORE if template_digest(template1) == template_digest(template2) else 0
+            return {'ErrorCode': 0, 'MatchingScore': score}
+        error_code, score = self.matcher.match(template1, template2)
+        return {'ErrorCode': error_code, 'MatchingScore': score}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, captures=self._captures)
+
+    # ---- server ----
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; without this, Nagle's
+            # algorithm and delayed ACKs add ~40 ms to every keep-alive reply
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass  # One line per request would dominate a load test
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Browser pages post cross-origin, so answer the CORS preflight
+            def do_OPTIONS(self):
+                self.send_response(204)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+                self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/stats':
+                    self._send(200, service.stats())
+                else:
+                    self._send(404, {'error': 'Not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {key: values[0] for key, values in
+                        urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True).items()}
+                path = self.path.split('?')[0]
+                if path == '/SGIFPCapture':
+                    kind, latency, handle = 'capture', service.capture_latency, service.capture
+                elif path == '/SGIMatchScore':
+                    kind, latency, handle = 'match', service.match_latency, service.match
+                else:
+                    self._send(404, {'error': 'Not found'})
+                    return
+                delay, error, drop = service._draw_fault(latency)
+                with service._lock:
+                    service.counts[kind] += 1
+                    service.counts['errors'] += bool(error)
+                    service.counts['dropped'] += bool(drop)
+                if delay:
+                    time.sleep(delay)
+                if drop:
+                    self.close_connection = True
+                    return
+                if error:
+                    self._send(200, {'ErrorCode': error, 'MatchingScore': 0} if kind == 'match' else {'ErrorCode': error})
+                    return
+                self._send(200, handle(form))
+
+        return Handler
+
+    def start(self):
+        # A deep listen backlog, so bursts of new connections in load tests are
+        # not delayed by SYN retransmits
+        ThreadingHTTPServer.request_queue_size = 128
+        self._server = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self._server.daemon_threads = True
+        if self.certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        # Port 0 picks a free port
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-sgibiosrv', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated SecuGen WebAPI (SGIFPCapture, SGIMatchScore)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--cert', help='TLS certificate (PEM); serves HTTPS like SgiBioSrv')
+    parser.add_argument('--key', help='TLS private key (PEM)')
+    parser.add_argument('--scoring', choices=['local', 'exact'], default='local',
+                        help='local: LocalMatcher scores; exact: 199 for the same minutiae, else 0')
+    parser.add_argument('--fingers', type=int, default=1000, help='size of the simulated finger population')
+    parser.add_argument('--captures-per-finger', type=int, default=2)
+    parser.add_argument('--match-latency-ms', type=float, default=0.0)
+    parser.add_argument('--capture-latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with an error code')
+    parser.add_argument('--error-codes', default=','.join(map(str, DEFAULT_ERROR_CODES)))
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='share of requests left without a response')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    service = FakeSgiBioSrv(
+        args.host, args.port, scoring=args.scoring, fingers=args.fingers,
+        captures_per_finger=args.captures_per_finger, match_latency_ms=args.match_latency_ms,
+        capture_latency_ms=args.capture_latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(',') if code.strip()],
+        drop_rate=args.drop_rate, seed=args.seed, certfile=args.cert, keyfile=args.key,
+    ).start()
+    print(f"Fake SgiBioSrv listening on {service.url} (scoring={args.scoring})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        service.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
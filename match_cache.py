@@ -0,0 +1,81 @@
+"""Bounded cache of match scores for template pairs that were already compared.
+
+The same pairs are scored again and again: a login that finds no match in
+the shortlist searches the whole roll, including the shortlisted voters
+again; a voter retrying after an error sends the same probe; duplicate
+checks at enrolment compare the same templates as the search that follows.
+
+Entries are keyed by ``matcher.template_key`` of both templates, a digest
+of the decoded bytes, so the base64 text and the memory-mapped copy of one
+template share an entry. The least recently used entry is evicted once
+``max_entries`` are held, and entries expire ``ttl`` seconds after they
+were stored. Only successful comparisons are cached; a service error is
+always retried. ``stats`` reports the hit rate, for sizing the cache.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+MATCH_CACHE_SIZE = 100_000
+MATCH_CACHE_TTL = 60 * 60
+
+
+class MatchCache:
+    def __init__(self, max_entries=MATCH_CACHE_SIZE, ttl=MATCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (probe key, gallery key) -> (expiry time, score), oldest first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    # Cached score for the pair, or None
+    def get(self, probe_key, gallery_key):
+        key = (probe_key, gallery_key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, probe_key, gallery_key, score):
+        key = (probe_key, gallery_key)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, score)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Forget every score (called by delete_voters)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expired': self.expired,
+            }
@@ -0,0 +1,233 @@
+"""Client for the SGIMatchScore service with pooling, retries and a breaker.
+
+A 1:N search sends thousands of comparisons to SgiBioSrv. Opening a new
+HTTPS connection for each one costs more than the comparison itself, and a
+Device Busy (59) or timeout (54) answer used to skip the voter outright. The
+client therefore:
+
+- keeps up to ``max_in_flight`` keep-alive connections and never has more
+  requests outstanding than that; callers wait for a free slot
+- retries transient answers (``TRANSIENT_ERRORS``) and unreachable-service
+  failures with exponential backoff and jitter
+- opens a circuit breaker after ``failure_threshold`` consecutive
+  unreachable failures; while it is open every call fails at once with
+  SERVICE_UNREACHABLE, and after ``reset_timeout`` seconds one trial
+  request decides whether it closes again
+- records the latency of every call in a histogram, also exported as
+  ``vms_match_service_seconds`` on /metrics
+"""
+import http.client
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import urllib.parse
+
+from telemetry import Histogram, metrics
+
+logger = logging.getLogger(__name__)
+
+# Error code reported when the match service cannot be reached at all
+SERVICE_UNREACHABLE = 3
+# Answers worth asking again: capture timeout, device busy
+TRANSIENT_ERRORS = (54, 59)
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_RETRIES = 2
+BACKOFF_BASE = 0.05
+BACKOFF_MAX = 1.0
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 10.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.times_opened = 0
+
+    # False if the call should fail fast. In the half-open state only one
+    # trial call is let through at a time.
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("Match service reachable again, closing circuit")
+            self.state = CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    logger.warning("Match service unreachable after %d attempts, opening circuit for %.0fs",
+                                   self._failures, self.reset_timeout)
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.times_opened += 1
+
+
+class MatchServiceClient:
+    def __init__(self, url, ssl_context=None, timeout=10, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 retries=DEFAULT_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        # Idle keep-alive connections; at most max_in_flight exist at once
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.latency = Histogram()
+        self.counts = {'calls': 0, 'retries': 0, 'transient': 0, 'unreachable': 0, 'fast_failed': 0,
+                       'connections_opened': 0}
+
+    # ---- connections ----
+
+    def _connect(self):
+        with self._lock:
+            self.counts['connections_opened'] += 1
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    # One POST on a pooled connection; raises OSError or HTTPException if the
+    # service cannot be reached
+    def _post(self, body):
+        try:
+            conn, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            conn, reused = self._connect(), False
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        try:
+            conn.request('POST', self.path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # The service closed an idle keep-alive connection; try once on
+            # a fresh one before counting a failure
+            conn = self._connect()
+            try:
+                conn.request('POST', self.path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._idle.put(conn)
+        if resp.status != 200:
+            raise http.client.HTTPException(f"HTTP {resp.status}")
+        return json.loads(data.decode('utf-8'))
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    # ---- calls ----
+
+    def _backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        time.sleep(random.uniform(delay / 2, delay))
+
+    # POST the form fields and return (error code, response JSON). Transient
+    # answers and unreachable-service failures are retried; SERVICE_UNREACHABLE
+    # is returned when every attempt failed or the circuit is open.
+    def call(self, fields):
+        body = urllib.parse.urlencode(fields).encode('ascii')
+        start = time.perf_counter()
+        outcome = 'ok'
+        error_code, data = 0, {}
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    with self._lock:
+                        self.counts['retries'] += 1
+                    self._backoff(attempt - 1)
+                if not self.breaker.allow():
+                    with self._lock:
+                        self.counts['fast_failed'] += 1
+                    outcome, error_code, data = 'circuit_open', SERVICE_UNREACHABLE, {}
+                    break
+                try:
+                    with self._slots:
+                        data = self._post(body)
+                except (OSError, ValueError, http.client.HTTPException) as e:
+                    self.breaker.record_failure()
+                    with self._lock:
+                        self.counts['unreachable'] += 1
+                    logger.warning("Match service request failed: %s", e)
+                    outcome, error_code, data = 'unreachable', SERVICE_UNREACHABLE, {}
+                    continue
+                self.breaker.record_success()
+                error_code = int(data.get('ErrorCode', 0) or 0)
+                if error_code in TRANSIENT_ERRORS:
+                    with self._lock:
+                        self.counts['transient'] += 1
+                    outcome = 'transient'
+                    continue
+                outcome = 'error' if error_code else 'ok'
+                break
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.counts['calls'] += 1
+                self.latency.observe(elapsed)
+            metrics.observe('vms_match_service_seconds', 'outcome', outcome, elapsed)
+        return error_code, data
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.counts,
+                'circuit': self.breaker.state,
+                'circuit_opened': self.breaker.times_opened,
+                'idle_connections': self._idle.qsize(),
+                'max_in_flight': self.max_in_flight,
+                'p50_ms': round(self.latency.quantile(0.5) * 1000, 3),
+                'p99_ms': round(self.latency.quantile(0.99) * 1000, 3),
+            }
@@ -0,0 +1,369 @@
+"""Server-side fingerprint matching and 1:N voter identification.
+
+Matchers compare two ISO 19794-2 templates (base64 text as captured by the
+SecuGen WebAPI, or raw bytes) and return ``(error_code, score)`` using the
+same error codes and 0-199 score range as the SGIMatchScore endpoint.
+"""
+import base64
+import binascii
+import hashlib
+import math
+import os
+import random
+import ssl
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from match_client import MatchServiceClient, DEFAULT_MAX_IN_FLIGHT, DEFAULT_RETRIES
+
+# Minimum score accepted as a match (same threshold the login page used)
+MATCH_THRESHOLD = 20
+# A score this high is treated as a certain match and stops the search early
+EARLY_EXIT_SCORE = 150
+MAX_SCORE = 199
+
+SGI_MATCH_URL = 'https://localhost:8443/SGIMatchScore'
+
+# ========== ISO 19794-2 TEMPLATES ==========
+
+ISO_HEADER_SIZE = 24
+ISO_VIEW_HEADER_SIZE = 4
+ISO_MINUTIA_SIZE = 6
+# ISO angles are stored in units of 360/256 degrees
+ANGLE_UNITS = 256
+
+
+# Accept base64 text, bytes or a memoryview and return the raw template bytes
+def decode_template(template):
+    if isinstance(template, str):
+        return base64.b64decode(template.strip())
+    return bytes(template)
+
+
+# Short digest of a template's decoded bytes (MatchCache keys)
+def template_key(template):
+    if isinstance(template, str):
+        try:
+            template = decode_template(template)
+        except (binascii.Error, ValueError):
+            template = template.strip().encode('utf-8')
+    return hashlib.blake2b(template, digest_size=16).digest()
+
+
+# Parse the minutiae of the first finger view of an ISO 19794-2 record.
+# Returns a tuple of (x, y, angle, type) tuples; raises ValueError if the
+# data is not an ISO finger minutiae record.
+def parse_iso_template(data):
+    if len(data) < ISO_HEADER_SIZE + ISO_VIEW_HEADER_SIZE or data[:4] != b'FMR\x00':
+        raise ValueError('Not an ISO 19794-2 template')
+    count = data[ISO_HEADER_SIZE + 3]
+    offset = ISO_HEADER_SIZE + ISO_VIEW_HEADER_SIZE
+    if len(data) < offset + count * ISO_MINUTIA_SIZE:
+        raise ValueError('Truncated ISO 19794-2 template')
+    minutiae = []
+    for i in range(count):
+        type_x, y, angle, _quality = struct.unpack_from('>HHBB', data, offset + i * ISO_MINUTIA_SIZE)
+        minutiae.append((type_x & 0x3FFF, y & 0x3FFF, angle, type_x >> 14))
+    return tuple(minutiae)
+
+
+# Build an ISO 19794-2 record from (x, y, angle, type) minutiae
+def build_iso_template(minutiae, width=260, height=300, resolution=197, quality=80):
+    body = bytearray()
+    for x, y, angle, mtype in minutiae:
+        body += struct.pack('>HHBB', (mtype << 14) | (x & 0x3FFF), y & 0x3FFF, angle % ANGLE_UNITS, 60)
+    length = ISO_HEADER_SIZE + ISO_VIEW_HEADER_SIZE + len(body) + 2
+    header = b'FMR\x00' + b' 20\x00' + struct.pack('>IHHHHHBB', length, 0, width, height, resolution, resolution, 1, 0)
+    view = struct.pack('>BBBB', 0, 0, quality, len(minutiae))
+    return header + view + bytes(body) + b'\x00\x00'
+
+
+# ========== SYNTHETIC TEMPLATES (testing and benchmarks) ==========
+
+# Generate a random but reproducible ISO template as base64 text
+def synthetic_template(seed, minutiae=40, width=260, height=300):
+    rng = random.Random(seed)
+    points = [(rng.randrange(16, width - 16), rng.randrange(16, height - 16),
+               rng.randrange(ANGLE_UNITS), rng.choice((1, 2)))
+              for _ in range(minutiae)]
+    return base64.b64encode(build_iso_template(points, width, height)).decode('ascii')
+
+
+# Simulate a re-scan of the same finger: small shift/rotation, positional
+# jitter, a few lost minutiae and a few spurious ones
+def perturb_template(template, seed, jitter=3, drop=0.1, extra=3, shift=10, rotation=4):
+    rng = random.Random(seed)
+    points = parse_iso_template(decode_template(template))
+    dx, dy = rng.randint(-shift, shift), rng.randint(-shift, shift)
+    rot = rng.randint(-rotation, rotation)
+    theta = rot * 2 * math.pi / ANGLE_UNITS
+    cos_t, sin_t = math.cos(theta), math.sin(theta)
+    result = []
+    for x, y, angle, mtype in points:
+        if rng.random() < drop:
+            continue
+        nx = x * cos_t - y * sin_t + dx + rng.randint(-jitter, jitter)
+        ny = x * sin_t + y * cos_t + dy + rng.randint(-jitter, jitter)
+        result.append((max(0, int(nx)), max(0, int(ny)), angle + rot + rng.randint(-2, 2), mtype))
+    for _ in range(extra):
+        result.append((rng.randrange(16, 244), rng.randrange(16, 284), rng.randrange(ANGLE_UNITS), rng.choice((1, 2))))
+    rng.shuffle(result)
+    return base64.b64encode(build_iso_template(result)).decode('ascii')
+
+
+# ========== MATCHERS ==========
+
+_COS = [math.cos(i * 2 * math.pi / ANGLE_UNITS) for i in range(ANGLE_UNITS)]
+_SIN = [math.sin(i * 2 * math.pi / ANGLE_UNITS) for i in range(ANGLE_UNITS)]
+
+
+@lru_cache(maxsize=65536)
+def _cached_minutiae(data):
+    return parse_iso_template(data)
+
+
+def _angle_diff(a, b):
+    d = (a - b) % ANGLE_UNITS
+    return min(d, ANGLE_UNITS - d)
+
+
+class LocalMatcher:
+    """Pure-Python stand-in for SGIMatchScore.
+
+    Aligns the two minutiae sets with a coarse Hough vote over rotation and
+    translation, then counts one-to-one minutia pairs under that alignment.
+    It is deterministic and needs no scanner, so it is used for tests,
+    benchmarks and deployments without a reachable SgiBioSrv.
+    """
+    name = 'local'
+    # match() accepts decoded templates (bytes or memoryviews) as well
+    takes_bytes = True
+
+    def __init__(self, distance_tolerance=12, angle_tolerance=12, bin_size=8, **_service_options):
+        # Service options such as licstr are accepted and ignored so the
+        # backends are interchangeable in get_matcher()
+        self.distance_tolerance = distance_tolerance
+        self.angle_tolerance = angle_tolerance
+        self.bin_size = bin_size
+
+    def match(self, template1, template2):
+        try:
+            data1 = decode_template(template1)
+            data2 = decode_template(template2)
+        except (ValueError, TypeError):
+            return 57, 0  # Wrong Image
+        if data1 == data2:
+            return 0, MAX_SCORE
+        try:
+            probe = _cached_minutiae(data1)
+            gallery = _cached_minutiae(data2)
+        except ValueError:
+            return 0, 0
+        if not probe or not gallery:
+            return 0, 0
+        return 0, self.score(probe, gallery)
+
+    def score(self, probe, gallery):
+        bin_size = self.bin_size
+        votes = {}
+        for px, py, pa, pt in probe:
+            for gx, gy, ga, gt in gallery:
+                if pt != gt:
+                    continue
+                rot = (ga - pa) % ANGLE_UNITS
+                # Only consider rotations a re-placed finger can plausibly have
+                if 16 < rot < ANGLE_UNITS - 16:
+                    continue
+                cos_r, sin_r = _COS[rot], _SIN[rot]
+                tx = gx - (px * cos_r - py * sin_r)
+                ty = gy - (px * sin_r + py * cos_r)
+                key = (rot // 4, int(tx // bin_size), int(ty // bin_size))
+                entry = votes.get(key)
+                if entry is None:
+                    votes[key] = [1, rot, tx, ty]
+                else:
+                    entry[0] += 1
+                    entry[2] += tx
+                    entry[3] += ty
+        if not votes:
+            return 0
+        count, rot, tx, ty = max(votes.values(), key=lambda v: v[0])
+        tx, ty = tx / count, ty / count
+        cos_r, sin_r = _COS[rot], _SIN[rot]
+        limit = self.distance_tolerance ** 2
+        used = set()
+        matched = 0
+        for px, py, pa, pt in probe:
+            ax = px * cos_r - py * sin_r + tx
+            ay = px * sin_r + py * cos_r + ty
+            aa = (pa + rot) % ANGLE_UNITS
+            best = None
+            best_dist = limit + 1
+            for j, (gx, gy, ga, gt) in enumerate(gallery):
+                if j in used or gt != pt:
+                    continue
+                dist = (gx - ax) ** 2 + (gy - ay) ** 2
+                if dist < best_dist and _angle_diff(aa, ga) <= self.angle_tolerance:
+                    best, best_dist = j, dist
+            if best is not None:
+                used.add(best)
+                matched += 1
+        return min(MAX_SCORE, round(MAX_SCORE * matched * matched / (len(probe) * len(gallery))))
+
+
+class SecuGenMatcher:
+    """Calls the SecuGen WebAPI SGIMatchScore endpoint from the server
+    through a pooled MatchServiceClient (see match_client.py)."""
+    name = 'secugen'
+    # SGIMatchScore takes base64 text, so decoded templates would only be
+    # encoded again for every comparison
+    takes_bytes = False
+
+    def __init__(self, url=SGI_MATCH_URL, licstr='', template_format='ISO', timeout=10,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, retries=DEFAULT_RETRIES):
+        self.url = url
+        self.licstr = licstr
+        self.template_format = template_format
+        self.timeout = timeout
+        # SgiBioSrv uses a self-signed certificate on localhost
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.client = MatchServiceClient(url, self.ssl_context, timeout=timeout,
+                                         max_in_flight=max_in_flight, retries=retries)
+
+    def match(self, template1, template2):
+        if not isinstance(template1, str):
+            template1 = base64.b64encode(bytes(template1)).decode('ascii')
+        if not isinstance(template2, str):
+            template2 = base64.b64encode(bytes(template2)).decode('ascii')
+        error_code, data = self.client.call({
+            'licstr': self.licstr,
+            'Template1': template1,
+            'Template2': template2,
+            'Templateformat': self.template_format,
+        })
+        if error_code:
+            return error_code, 0
+        return 0, int(data.get('MatchingScore', 0) or 0)
+
+    def stats(self):
+        return self.client.stats()
+
+
+MATCHERS = {
+    LocalMatcher.name: LocalMatcher,
+    SecuGenMatcher.name: SecuGenMatcher,
+}
+
+
+# Create a matcher backend by name (defaults to the MATCHER_BACKEND env var)
+def get_matcher(name=None, **options):
+    name = (name or os.environ.get('MATCHER_BACKEND') or SecuGenMatcher.name).lower()
+    if name not in MATCHERS:
+        raise ValueError(f"Unknown matcher backend: {name}")
+    return MATCHERS[name](**options)
+
+
+# ========== 1:N IDENTIFICATION ==========
+
+class IdentificationEngine:
+    """Scores a probe template against many voters in a worker pool.
+
+    Voters are split into chunks that run in parallel; as soon as any
+    comparison reaches ``early_exit_score`` the remaining chunks stop.
+    """
+
+    def __init__(self, matcher, workers=8, threshold=MATCH_THRESHOLD,
+                 early_exit_score=EARLY_EXIT_SCORE, chunk_size=32, templates=None, cache=None):
+        self.matcher = matcher
+        # Optional store with get(voter_id) -> decoded template (e.g. a
+        # TemplateStore); voters it does not know use their base64 text.
+        # Only used with matchers that compare decoded templates.
+        self.templates = templates if getattr(matcher, 'takes_bytes', False) else None
+        # Optional MatchCache of scores for pairs compared before
+        self.cache = cache
+        self.workers = workers
+        self.threshold = threshold
+        self.early_exit_score = early_exit_score
+        self.chunk_size = chunk_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='matcher')
+
+    def _match(self, probe, probe_key, template):
+        if probe_key is None:
+            return self.matcher.match(probe, template)
+        gallery_key = template_key(template)
+        score = self.cache.get(probe_key, gallery_key)
+        if score is not None:
+            return 0, score
+        error_code, score = self.matcher.match(probe, template)
+        if not error_code:
+            self.cache.put(probe_key, gallery_key, score)
+        return error_code, score
+
+    def _score_chunk(self, probe, probe_key, voters, stop):
+        best = None
+        checked = 0
+        errors = 0
+        last_error = 0
+        for voter in voters:
+            if stop.is_set():
+                break
+            template = self.templates.get(voter['voter_id']) if self.templates is not None else None
+            if template is None:
+                template = voter['template_base64']
+            error_code, score = self._match(probe, probe_key, template)
+            checked += 1
+            if error_code:
+                errors += 1
+                last_error = error_code
+                continue
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (voter, score)
+                if score >= self.early_exit_score:
+                    stop.set()
+                    break
+        return best, checked, errors, last_error
+
+    # Identify the voter whose template best matches the probe.
+    # Returns a dict with matched, voter_id, name, score, checked, errors,
+    # error_code and early_exit.
+    def identify(self, probe, voters):
+        voters = [v for v in voters if v.get('template_base64')]
+        # Decode the probe once instead of once per comparison
+        if isinstance(probe, str) and self.templates is not None:
+            try:
+                probe = decode_template(probe)
+            except ValueError:
+                pass
+        probe_key = template_key(probe) if self.cache is not None else None
+        stop = threading.Event()
+        chunks = [voters[i:i + self.chunk_size] for i in range(0, len(voters), self.chunk_size)]
+        futures = [self._executor.submit(self._score_chunk, probe, probe_key, chunk, stop) for chunk in chunks]
+
+        best = None
+        checked = errors = last_error = 0
+        for future in futures:
+            chunk_best, chunk_checked, chunk_errors, chunk_error = future.result()
+            checked += chunk_checked
+            errors += chunk_errors
+            last_error = chunk_error or last_error
+            if chunk_best and (best is None or chunk_best[1] > best[1]):
+                best = chunk_best
+
+        result = {
+            'matched': best is not None,
+            'voter_id': best[0]['voter_id'] if best else '',
+            'name': best[0].get('name', '') if best else '',
+            'score': best[1] if best else 0,
+            'checked': checked,
+            'errors': errors,
+            # Without a match, any failed comparison (e.g. the circuit
+            # breaker opening partway through) may have hidden the voter, so
+            # report the error and let the booth retry
+            'error_code': last_error if best is None and errors else 0,
+            'early_exit': stop.is_set(),
+        }
+        return result
@@ -0,0 +1,146 @@
+"""Live results pushed to admin observers as Server-Sent Events.
+
+Observers do not poll /admin/results. They hold open /admin/results/stream:
+
+- on connect, one ``results`` event carries the full results document
+- then, at most once per ``interval`` seconds, one ``delta`` event carries
+  the constituencies whose counts changed since the previous event, plus
+  the new totals. Votes committed within an interval are coalesced.
+- after the votes are cleared or recounted, a ``results`` event replaces
+  everything
+
+One publisher thread reads the changes from the VoteTally in memory and
+encodes each event once, then hands the same bytes to every observer. An
+observer therefore adds no disk reads and no encoding, only a socket
+write per interval. The thread runs only while someone is watching.
+Observers that fall ``backlog`` events behind are sent the full results
+again instead of the missed deltas.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FEED_INTERVAL = 1.0
+RESULTS_FEED_BACKLOG = 32
+# Comment line sent to idle streams so proxies keep them open
+HEARTBEAT_SECONDS = 15
+HEARTBEAT = b': keep-alive\n\n'
+
+
+def sse_event(event, version, data):
+    return b'event: ' + event.encode('ascii') + b'\nid: ' + str(version).encode('ascii') + b'\ndata: ' + data + b'\n\n'
+
+
+class ResultsFeed:
+    def __init__(self, tally, snapshot, interval=RESULTS_FEED_INTERVAL, backlog=RESULTS_FEED_BACKLOG):
+        # snapshot: callable returning (version, encoded full results)
+        self.tally = tally
+        self.snapshot = snapshot
+        self.interval = interval
+        self.backlog = backlog
+        self._lock = threading.Lock()
+        # token -> deliver(event bytes); called on the publisher thread, must not block
+        self._subscribers = {}
+        self._next_token = 0
+        self._thread = None
+        self.events = 0
+        self.deliveries = 0
+
+    def snapshot_event(self):
+        version, body = self.snapshot()
+        return sse_event('results', version, body)
+
+    # Register an observer. Returns (token, first event): the full results,
+    # to be sent before anything passed to deliver.
+    def subscribe(self, deliver):
+        with self._lock:
+            if self._thread is None:
+                # Changes from before anyone watched are in the snapshot
+                self.tally.take_changes()
+                self._thread = threading.Thread(target=self._run, name='results-feed', daemon=True)
+                self._thread.start()
+            first = self.snapshot_event()
+            token = self._next_token
+            self._next_token += 1
+            self._subscribers[token] = deliver
+        return token, first
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                event = self._next_event()
+            except Exception:
+                logger.exception("Results feed could not read the tally")
+                continue
+            if event is None:
+                continue
+            with self._lock:
+                subscribers = list(self._subscribers.values())
+            self.events += 1
+            self.deliveries += len(subscribers)
+            for deliver in subscribers:
+                try:
+                    deliver(event)
+                except Exception:
+                    logger.exception("Results feed could not deliver an event")
+
+    def _next_event(self):
+        # Votes committed by other processes sharing the store
+        self.tally.refresh()
+        version, rebuilt, delta = self.tally.take_changes()
+        if rebuilt:
+            return self.snapshot_event()
+        if delta is None:
+            return None
+        return sse_event('delta', version, json.dumps(delta).encode('utf-8'))
+
+    # Blocking iterator of one observer's stream, for a WSGI response
+    def stream(self):
+        events = queue.Queue()
+        lagged = threading.Event()
+
+        def deliver(event):
+            if events.qsize() >= self.backlog:
+                lagged.set()
+            else:
+                events.put(event)
+
+        token, first = self.subscribe(deliver)
+        try:
+            yield first
+            while True:
+                try:
+                    event = events.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield HEARTBEAT
+                    continue
+                if lagged.is_set():
+                    lagged.clear()
+                    while not events.empty():
+                        events.get_nowait()
+                    event = self.snapshot_event()
+                yield event
+        finally:
+            self.unsubscribe(token)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'observers': len(self._subscribers),
+                'interval': self.interval,
+                'events': self.events,
+                'deliveries': self.deliveries,
+            }
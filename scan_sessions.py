@@ -0,0 +1,142 @@
+"""Server-side store for fingerprint scans in progress.
+
+Registration and login span several requests (scan, then form / second
+scan, then identification). The captured templates and images used to sit
+in module-level dicts shared by every booth, so two booths scanning at the
+same time overwrote each other. Each scan flow now gets its own entry,
+keyed by a random token that is kept in the booth's (signed) Flask session.
+
+Entries are small JSON files under one directory, so every worker process
+and thread sees the same data. They expire ``ttl`` seconds after their last
+update and the number of entries is capped; the oldest are evicted first.
+"""
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+SCAN_SESSION_TTL = 10 * 60
+SCAN_SESSION_MAX = 10000
+# Expired entries are swept at most this often
+SWEEP_INTERVAL = 60
+
+_TOKEN_RE = re.compile(r'^[A-Za-z0-9_-]{32}$')
+
+
+class ScanSessionStore:
+    def __init__(self, root='scan_sessions', ttl=SCAN_SESSION_TTL, max_sessions=SCAN_SESSION_MAX):
+        self.root = root
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._swept_at = 0
+        # Entries known to exist: live ones at the last sweep plus those created since
+        self._known = 0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _path(self, token):
+        if not token or not _TOKEN_RE.match(token):
+            return None
+        return os.path.join(self.root, token + '.json')
+
+    def _write(self, path, data):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if name.endswith('.json'):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(self.root, name)), name))
+                except OSError:
+                    continue  # Removed by another worker meanwhile
+        return entries
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.root, name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    # Drop expired entries and, if still over the cap, the oldest ones
+    def _sweep(self, room=0):
+        now = time.time()
+        entries = self._entries()
+        live = []
+        for mtime, name in entries:
+            if now - mtime >= self.ttl:
+                self.expired += self._remove(name)
+            else:
+                live.append((mtime, name))
+        excess = len(live) + room - self.max_sessions
+        if excess > 0:
+            for _, name in sorted(live)[:excess]:
+                self.evicted += self._remove(name)
+        self._known = min(len(live), self.max_sessions - room)
+        self._swept_at = now
+
+    # Start a new scan session holding `data`; returns its token
+    def create(self, data=None):
+        with self._lock:
+            if time.time() - self._swept_at >= SWEEP_INTERVAL or self._known >= self.max_sessions:
+                self._sweep(room=1)
+            token = secrets.token_urlsafe(24)
+            self._write(self._path(token), data or {})
+            self._known += 1
+            self.created += 1
+            return token
+
+    # Data of a live session, or None if unknown or expired
+    def get(self, token):
+        path = self._path(token)
+        if path is None:
+            return None
+        try:
+            if time.time() - os.path.getmtime(path) >= self.ttl:
+                self.expired += self._remove(os.path.basename(path))
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Merge values into a live session; returns False if it is gone
+    def update(self, token, **values):
+        data = self.get(token)
+        if data is None:
+            return False
+        data.update(values)
+        self._write(self._path(token), data)
+        return True
+
+    def discard(self, token):
+        path = self._path(token)
+        if path is not None:
+            self._remove(os.path.basename(path))
+
+    def clear(self):
+        with self._lock:
+            for _, name in self._entries():
+                self._remove(name)
+
+    def stats(self):
+        return {
+            'active': len(self._entries()),
+            'created': self.created,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,485 @@
+"""Coordinator for a sharded deployment (see sharding.py).
+
+Booths talk to the coordinator, which forwards each request to one shard:
+
+- a booth is set up once with /booth/<state>/<constituency>, which stores
+  its constituency in a cookie; registration, login and identification
+  requests go to the shard that owns that constituency
+- /cast_vote goes to the shard that verified the voter (the shard name is
+  kept in the signed session by /login_verify), so the 75-hour vote window
+  is always checked where the voter's earlier votes are
+- any request with ?shard=<name> goes to that shard (admin pages, exports,
+  bulk enrolment, /metrics)
+- /admin/results asks every shard in parallel and merges the tallies;
+  /admin/results/stream sends that merged document as a Server-Sent Event
+  whenever it changes (shards are asked every RESULTS_STREAM_INTERVAL s)
+- /save_registration is only forwarded once every shard has confirmed
+  that neither the voter ID nor the fingerprint digest is enrolled there;
+  /admin/bulk_enrol is refused if any of its records is enrolled on
+  another shard
+- candidate uploads and the admin delete actions are sent to every shard
+- /admin/shards reports which shards respond
+
+The coordinator and the shards must share SECRET_KEY, so the session
+cookie one process sets is valid on the others.
+
+    python shard_router.py --map shards.json --port 5000
+    python shard_router.py --local 4 --port 5000      # 4 shard processes under shards/
+"""
+import argparse
+import csv
+import http.client
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, jsonify, redirect, render_template, request, session
+
+from bulk_enrol import BATCH_SIZE, DUPLICATE_BIOMETRIC, DUPLICATE_ID, read_enrolment_csv
+from digest_index import template_digest
+from results_feed import HEARTBEAT, HEARTBEAT_SECONDS, sse_event
+from sharding import ShardMap, merge_results
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BOOTH_COOKIE = 'vms_booth'
+BOOTH_COOKIE_MAX_AGE = 365 * 24 * 3600
+# A shard builds its matching indexes on its first login, which can take minutes
+SHARD_TIMEOUT = 300
+# How often /admin/results/stream asks the shards for their results
+RESULTS_STREAM_INTERVAL = float(os.environ.get('RESULTS_STREAM_INTERVAL', '2'))
+
+# Steps of a booth flow that must reach the booth's shard
+BOOTH_ROUTES = {'/register_scan', '/save_registration', '/login_scan1', '/login_scan2', '/identify',
+                '/login_verify', '/cast_vote'}
+# Admin actions applied to every shard
+BROADCAST_ROUTES = {'/admin/upload_candidates', '/admin/delete_daily_votes', '/admin/delete_voters',
+                    '/admin/delete_votes', '/admin/delete_candidates'}
+# Request headers passed on to the shard
+FORWARD_HEADERS = ('Content-Type', 'Cookie', 'Accept', 'Accept-Encoding', 'If-None-Match', 'Authorization',
+                   'User-Agent')
+# Response headers that only apply to one hop
+HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length'}
+
+
+class ShardClient:
+    """Keep-alive HTTP connections to one shard."""
+
+    def __init__(self, name, url, timeout=SHARD_TIMEOUT):
+        parts = urllib.parse.urlsplit(url)
+        self.name = name
+        self.url = url
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.https = parts.scheme == 'https'
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    # (status, [(header, value)], body); raises OSError or HTTPException
+    # if the shard cannot be reached
+    def request(self, method, path, body=None, headers=None):
+        try:
+            conn, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            conn, reused = self._connect(), False
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # Stale keep-alive connection; retry once on a new one
+            conn = self._connect()
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                data = resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._idle.put(conn)
+        return resp.status, resp.getheaders(), data
+
+
+def create_router(shard_map):
+    router = Flask(__name__)
+    router.secret_key = os.environ.get('SECRET_KEY', 'your_secret_key_change_in_production')
+    clients = {name: ShardClient(name, shard_map.url(name)) for name in shard_map.names}
+    fan_out = ThreadPoolExecutor(max_workers=max(4, len(clients)), thread_name_prefix='shard-fanout')
+
+    def booth():
+        state, _, constituency = (request.cookies.get(BOOTH_COOKIE) or '').partition('|')
+        return (state, constituency) if state else None
+
+    # Shard for this request, or None if it needs a booth that is not set up
+    def choose_shard():
+        name = request.args.get('shard')
+        if name in clients:
+            return name
+        if request.path == '/cast_vote' and session.get('shard') in clients:
+            return session['shard']
+        seat = booth()
+        if seat is not None:
+            return shard_map.shard_for(*seat)
+        if request.path in BOOTH_ROUTES:
+            return None
+        return shard_map.names[0]
+
+    def forwarded_headers():
+        headers = {key: request.headers[key] for key in FORWARD_HEADERS if key in request.headers}
+        headers['X-Forwarded-For'] = request.remote_addr or ''
+        return headers
+
+    def send(name):
+        return clients[name].request(request.method, request.full_path.rstrip('?'),
+                                     body=request.get_data() or None, headers=forwarded_headers())
+
+    def relay(status, headers, data):
+        response = Response(data, status=status)
+        for key, value in headers:
+            if key.lower() not in HOP_HEADERS:
+                # Keep every Set-Cookie; replace the defaults for the rest
+                if key.lower() == 'set-cookie':
+                    response.headers.add(key, value)
+                else:
+                    response.headers[key] = value
+        return response
+
+    # {shard: (status, headers, body) or the exception}
+    def send_all(path=None):
+        return request_all(request.method, path or request.full_path.rstrip('?'), request.get_data() or None,
+                           forwarded_headers())
+
+    def request_all(method, path, body, headers):
+        futures = {name: fan_out.submit(client.request, method, path, body, headers)
+                   for name, client in clients.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning("Shard %s unreachable: %s", name, e)
+                results[name] = e
+        return results
+
+    # Error response if the voter ID or the fingerprint of this registration
+    # is already enrolled on any shard, else None. The booth's shard gives
+    # the digest of its pending scan; the others are asked by digest. The
+    # booth's shard repeats its own checks (fuzzy ones too) when it saves.
+    def check_enrolment(name):
+        # Read the body first so it can still be forwarded after request.form
+        request.get_data()
+        voter_id = request.form.get('voter_id', '').strip().upper()
+        headers = forwarded_headers()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        body = urllib.parse.urlencode({'voter_id': voter_id})
+        try:
+            status, _, data = clients[name].request('POST', '/enrolment_check', body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning("Shard %s unreachable: %s", name, e)
+            status = None
+        if status != 200:
+            return jsonify({'error': f'Shard {name} could not check the registration'}), 502
+        checks = {name: json.loads(data)}
+        others = [other for other in clients if other != name]
+        if others:
+            body = urllib.parse.urlencode({'voter_id': voter_id, 'digest': checks[name]['digest'] or ''})
+            futures = {other: fan_out.submit(clients[other].request, 'POST', '/enrolment_check', body, headers)
+                       for other in others}
+            for other, future in futures.items():
+                try:
+                    status, _, data = future.result()
+                except (OSError, http.client.HTTPException) as e:
+                    logger.warning("Shard %s unreachable: %s", other, e)
+                    status = None
+                if status != 200:
+                    # A shard that can not be asked might hold the voter
+                    return jsonify({'error': f'Shard {other} could not check the registration'}), 502
+                checks[other] = json.loads(data)
+        for shard, check in checks.items():
+            if check['voter_id_exists']:
+                logger.info("Voter ID %s is already enrolled on shard %s", voter_id, shard)
+                return render_template('error.html', error=409,
+                                       errordescription=f"Voter ID {voter_id} is already registered")
+            if check['biometric_exists']:
+                logger.info("Biometric of %s is already enrolled on shard %s", voter_id, shard)
+                return render_template('error.html', error=409, errordescription=(
+                    "This biometric is already registered with another voter ID"))
+        return None
+
+    # Error response if any record of a bulk enrolment upload is already
+    # enrolled on a shard other than `name`, else None. The other shards are
+    # asked one batch at a time; `name` checks its own roll while it enrols.
+    # Unreadable uploads are left to the shard to reject.
+    def check_bulk_enrolment(name):
+        request.get_data()
+        file = request.files.get('file')
+        others = [other for other in clients if other != name]
+        if file is None or not others:
+            return None
+        headers = forwarded_headers()
+        headers['Content-Type'] = 'application/json'
+        rejected = []
+        text = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+        try:
+            batch = []
+            for line, record in read_enrolment_csv(text):
+                voter_id = (record.get('voter_id') or '').strip().upper()
+                template = (record.get('template_base64') or '').strip()
+                batch.append((line, voter_id, template_digest(template) if len(template) > 10 else ''))
+                if len(batch) >= BATCH_SIZE:
+                    failed = check_batch(others, batch, headers, rejected)
+                    if failed:
+                        return failed
+                    batch = []
+            if batch:
+                failed = check_batch(others, batch, headers, rejected)
+                if failed:
+                    return failed
+        except (UnicodeDecodeError, csv.Error):
+            return None
+        finally:
+            text.detach()
+        if rejected:
+            logger.info("Bulk enrolment refused: %d records are enrolled on other shards", len(rejected))
+            return jsonify({'error': 'Some records are already enrolled on other shards; nothing was enrolled',
+                            'rejected': sorted(rejected, key=lambda r: r['line'])}), 409
+        return None
+
+    # Adds the records of `batch` ((line, voter_id, digest) tuples) that
+    # `others` already hold to `rejected`; error response if a shard can
+    # not be asked
+    def check_batch(others, batch, headers, rejected):
+        body = json.dumps({'records': [{'voter_id': voter_id, 'digest': digest}
+                                       for _, voter_id, digest in batch]}).encode('utf-8')
+        futures = {other: fan_out.submit(clients[other].request, 'POST', '/enrolment_check', body, headers)
+                   for other in others}
+        for other, future in futures.items():
+            try:
+                status, _, data = future.result()
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning("Shard %s unreachable: %s", other, e)
+                status = None
+            if status != 200:
+                return jsonify({'error': f'Shard {other} could not check the enrolment'}), 502
+            for (line, voter_id, _), check in zip(batch, json.loads(data)['records']):
+                if check['voter_id_exists']:
+                    rejected.append({'line': line, 'voter_id': voter_id, 'status': DUPLICATE_ID,
+                                     'detail': f'Voter ID {voter_id} is already registered on shard {other}'})
+                elif check['biometric_exists']:
+                    rejected.append({'line': line, 'voter_id': voter_id, 'status': DUPLICATE_BIOMETRIC,
+                                     'detail': f'Same fingerprint as a voter on shard {other}'})
+        return None
+
+    @router.route('/booth/<state>/<constituency>', methods=['GET'])
+    def set_booth(state, constituency):
+        response = redirect('/')
+        response.set_cookie(BOOTH_COOKIE, f'{state}|{constituency}', max_age=BOOTH_COOKIE_MAX_AGE,
+                            httponly=True, samesite='Lax')
+        return response
+
+    # Merged results document of every shard's /admin/results, or None if
+    # the shards refused the session
+    def merged_results(headers):
+        documents = []
+        missing = []
+        for name, result in request_all('GET', '/admin/results', None, headers).items():
+            if isinstance(result, Exception) or result[0] != 200:
+                if not isinstance(result, Exception) and result[0] == 401:
+                    return None
+                missing.append(name)
+                continue
+            documents.append(json.loads(result[2]))
+        merged = merge_results(documents)
+        merged['shards'] = len(clients)
+        merged['missing_shards'] = missing
+        return merged
+
+    @router.route('/admin/results', methods=['GET'])
+    def results():
+        merged = merged_results(forwarded_headers())
+        if merged is None:
+            return jsonify({'error': 'Unauthorized'}), 401
+        return jsonify(merged)
+
+    # The shards' own streams never end and only cover one shard each, so
+    # the coordinator polls the merged results and sends a full ``results``
+    # event whenever they change (the panel replaces its tables with it)
+    @router.route('/admin/results/stream', methods=['GET'])
+    def results_stream():
+        if not session.get('admin'):
+            return jsonify({'error': 'Unauthorized'}), 401
+        headers = forwarded_headers()
+
+        def events():
+            last = None
+            version = 0
+            idle = 0.0
+            while True:
+                merged = merged_results(headers)
+                if merged is None:
+                    return
+                body = json.dumps(merged).encode('utf-8')
+                if body != last:
+                    last = body
+                    version += 1
+                    idle = 0.0
+                    yield sse_event('results', version, body)
+                elif idle >= HEARTBEAT_SECONDS:
+                    idle = 0.0
+                    yield HEARTBEAT
+                time.sleep(RESULTS_STREAM_INTERVAL)
+                idle += RESULTS_STREAM_INTERVAL
+
+        return Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @router.route('/admin/shards', methods=['GET'])
+    def shards():
+        if not session.get('admin'):
+            return jsonify({'error': 'Unauthorized'}), 401
+        status = {}
+        for name, result in send_all('/admin/cache_stats').items():
+            if isinstance(result, Exception):
+                status[name] = {'url': clients[name].url, 'reachable': False, 'error': str(result)}
+            else:
+                stats = json.loads(result[2]) if result[0] == 200 else {}
+                status[name] = {'url': clients[name].url, 'reachable': result[0] == 200,
+                                'voters': stats.get('voter_registry', {}).get('voters'),
+                                'votes': stats.get('vote_tally', {}).get('total_votes')}
+        return jsonify(status)
+
+    @router.route('/', defaults={'path': ''}, methods=['GET', 'POST'])
+    @router.route('/<path:path>', methods=['GET', 'POST'])
+    def forward(path):
+        if request.path in BROADCAST_ROUTES:
+            results = send_all()
+            failed = {name: (str(result) if isinstance(result, Exception) else result[0])
+                      for name, result in results.items()
+                      if isinstance(result, Exception) or result[0] >= 400}
+            if failed:
+                first = next(iter(results.values()))
+                if not isinstance(first, Exception) and all(
+                        not isinstance(r, Exception) and r[0] == first[0] for r in results.values()):
+                    return relay(*first)  # Same answer everywhere (e.g. 401, invalid file)
+                return jsonify({'error': 'Some shards did not apply the change', 'shards': failed}), 502
+            return relay(*next(iter(results.values())))
+        name = choose_shard()
+        if name is None:
+            return jsonify({'error': 'This booth is not set up; open /booth/<state>/<constituency> first'}), 409
+        if request.path == '/save_registration' and len(clients) > 1:
+            refused = check_enrolment(name)
+            if refused is not None:
+                return refused
+        if request.path == '/admin/bulk_enrol' and request.method == 'POST' and len(clients) > 1:
+            if not session.get('admin'):
+                return jsonify({'error': 'Unauthorized'}), 401
+            refused = check_bulk_enrolment(name)
+            if refused is not None:
+                return refused
+        try:
+            return relay(*send(name))
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning("Shard %s unreachable: %s", name, e)
+            return jsonify({'error': f'Shard {name} is unreachable'}), 502
+
+    return router
+
+
+# ========== LOCAL SHARDS ==========
+
+# Start `count` app.py processes, each in its own directory under
+# `data_dir` and on its own port. Returns (ShardMap, processes).
+def start_local_shards(count, data_dir='shards', base_port=5101, env=None, candidates_csv='candidates.csv'):
+    shards = {}
+    processes = []
+    for i in range(count):
+        name = f'shard{i}'
+        directory = os.path.abspath(os.path.join(data_dir, name))
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(candidates_csv) and not os.path.exists(os.path.join(directory, 'candidates.csv')):
+            shutil.copy(candidates_csv, os.path.join(directory, 'candidates.csv'))
+        port = base_port + i
+        shard_env = dict(os.environ, **(env or {}), SHARD_NAME=name,
+                         PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+        processes.append(subprocess.Popen(
+            [sys.executable, '-c', f'import app; app.app.run(host="127.0.0.1", port={port}, threaded=True)'],
+            cwd=directory, env=shard_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        shards[name] = f'http://127.0.0.1:{port}'
+    shard_map = ShardMap(shards)
+    for name in shard_map.names:
+        wait_for_shard(shard_map.url(name))
+    return shard_map, processes
+
+
+def wait_for_shard(url, timeout=300):
+    parts = urllib.parse.urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+            conn.request('GET', '/candidates')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def stop_local_shards(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Route booth requests to constituency shards')
+    parser.add_argument('--map', default=os.environ.get('SHARD_MAP', 'shards.json'), help='shard map JSON file')
+    parser.add_argument('--local', type=int, metavar='N', help='start N shard processes on this machine')
+    parser.add_argument('--data-dir', default='shards', help='parent directory of the local shards')
+    parser.add_argument('--base-port', type=int, default=5101, help='port of the first local shard')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    processes = []
+    if args.local:
+        shard_map, processes = start_local_shards(args.local, args.data_dir, args.base_port)
+        print(f"Started {args.local} shards: {shard_map.shards}")
+    else:
+        shard_map = ShardMap.load(args.map)
+    try:
+        create_router(shard_map).run(host=args.host, port=args.port, threaded=True)
+    finally:
+        stop_local_shards(processes)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""Partitioning of voters and votes across app processes by constituency.
+
+Each shard is an ordinary app.py process with its own data directory, so
+it owns its voters, votes, daily votes and indexes. A voter belongs to the
+shard of the constituency where they registered. Booths are set up for one
+constituency, so that shard handles every step of a booth's registration,
+login and vote. The coordinator (shard_router.py) routes booth requests
+and merges the per-shard tallies for the admin results.
+
+The shard map is a JSON file:
+
+    {
+      "shards": {"north": "http://10.0.0.11:5000", "south": "http://10.0.0.12:5000"},
+      "states": {"Kerala": "south"},
+      "constituencies": {"Uttar Pradesh/Varanasi": "north"}
+    }
+
+A constituency listed under "constituencies" goes to that shard, otherwise
+its state's entry in "states" applies, otherwise a stable hash of state and
+constituency picks the shard.
+"""
+import json
+import zlib
+
+
+def seat_key(state, constituency):
+    return f"{(state or '').strip()}/{(constituency or '').strip()}".upper()
+
+
+class ShardMap:
+    def __init__(self, shards, states=None, constituencies=None):
+        # name -> base URL, in a fixed order for hashing
+        self.shards = dict(shards)
+        self.names = sorted(self.shards)
+        if not self.names:
+            raise ValueError("Shard map has no shards")
+        self.states = {state.strip().upper(): name for state, name in (states or {}).items()}
+        self.constituencies = {}
+        for key, name in (constituencies or {}).items():
+            state, _, constituency = key.partition('/')
+            self.constituencies[seat_key(state, constituency)] = name
+        unknown = (set(self.states.values()) | set(self.constituencies.values())) - set(self.shards)
+        if unknown:
+            raise ValueError(f"Shard map refers to unknown shards: {', '.join(sorted(unknown))}")
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data.get('shards', {}), data.get('states'), data.get('constituencies'))
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'shards': self.shards, 'states': self.states, 'constituencies': self.constituencies},
+                      f, indent=2)
+
+    # Name of the shard that owns a constituency
+    def shard_for(self, state, constituency):
+        key = seat_key(state, constituency)
+        name = self.constituencies.get(key) or self.states.get((state or '').strip().upper())
+        if name is None:
+            name = self.names[zlib.crc32(key.encode('utf-8')) % len(self.names)]
+        return name
+
+    def url(self, name):
+        return self.shards[name]
+
+
+# Merge the /admin/results documents of several shards into one of the same
+# shape. A constituency's votes may be spread over shards (voters can vote
+# for any seat), so counts are summed per candidate. Constituencies are
+# keyed by (state, constituency), as some names occur in several states.
+def merge_results(documents):
+    counts = {}
+    parties = {}
+    total = 0
+    version = 0
+    for document in documents:
+        total += document.get('total_votes', 0)
+        version += document.get('version', 0)
+        for party, n in document.get('parties', {}).items():
+            parties[party] = parties.get(party, 0) + n
+        for entry in document.get('constituencies', []):
+            by_candidate = counts.setdefault((entry.get('state', ''), entry['constituency']), {})
+            for candidate in entry.get('candidates', []):
+                key = (candidate['candidate_name'], candidate['party'])
+                by_candidate[key] = by_candidate.get(key, 0) + candidate['votes']
+    constituencies = []
+    for (state, constituency), by_candidate in counts.items():
+        candidates = sorted(({'candidate_name': candidate_name, 'party': party, 'votes': n}
+                             for (candidate_name, party), n in by_candidate.items()),
+                            key=lambda c: -c['votes'])
+        constituencies.append({
+            'state': state,
+            'constituency': constituency,
+            'total': sum(by_candidate.values()),
+            'leader': candidates[0] if candidates else None,
+            'candidates': candidates,
+        })
+    return {
+        # Sum of the shard versions; changes whenever any shard's counts do
+        'version': version,
+        'total_votes': total,
+        'parties': dict(sorted(parties.items(), key=lambda item: -item[1])),
+        'constituencies': constituencies,
+    }
@@ -0,0 +1,878 @@
+"""Storage backends for voters, votes, daily votes and candidates.
+
+Each backend exposes one repository per record type with the same methods,
+so the app does not care where the data lives:
+
+    storage.voters       voters(), get(), changes_since(), page(), refresh(), append(),
+                         extend(), clear()
+    storage.votes        append(), extend(), log(), page(), tally(), read_since(), mark(),
+                         truncate_to(), sync(), clear()
+    storage.daily_votes  append(), extend(), rows(), read_since(), last_vote_time(),
+                         mark(), truncate_to(), sync(), clear()
+    storage.candidates   all(), version(), replace(), clear()
+
+``CsvStorage`` is the original append-only CSV layout. ``SqliteStorage``
+keeps the same records in one SQLite database in WAL mode with indexes on
+voter_id, timestamp and constituency, using one connection per thread.
+
+Copy data between the two:
+
+    python storage.py import --db vms.sqlite3 --data-dir .
+    python storage.py export --db vms.sqlite3 --data-dir export/
+"""
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import zlib
+from datetime import datetime
+
+from blob_store import is_legacy_voters_csv
+from voter_registry import VOTER_FIELDS, VoterRegistry, page_voters
+
+VOTE_FIELDS = ['date', 'voter_id', 'name', 'state', 'constituency', 'candidate_name', 'party', 'timestamp']
+DAILY_VOTE_FIELDS = ['date', 'voter_id', 'voted', 'timestamp']
+CANDIDATE_FIELDS = ['_id', 'State', 'Constituency', 'Party', 'Candidate Name']
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+# Time of the vote recorded in a daily_votes row. Rows written before the
+# timestamp column existed only have a date and count from midnight.
+def daily_vote_time(row):
+    timestamp_str = row.get('timestamp') or ''
+    if timestamp_str:
+        try:
+            return datetime.strptime(timestamp_str, TIMESTAMP_FORMAT)
+        except ValueError:
+            return None
+    vote_date = row.get('date') or ''
+    if vote_date:
+        try:
+            return datetime.strptime(vote_date, DATE_FORMAT)
+        except ValueError:
+            return None
+    return None
+
+
+# Count votes per (state, constituency) and "candidate (party)" from vote
+# rows; some constituency names occur in more than one state
+def tally_rows(rows):
+    votes = {}
+    for row in rows:
+        if row.get('constituency') and row.get('candidate_name'):
+            seat = (row.get('state', ''), row['constituency'])
+            candidate = f"{row['candidate_name']} ({row['party']})"
+            if seat not in votes:
+                votes[seat] = {}
+            if candidate not in votes[seat]:
+                votes[seat][candidate] = 0
+            votes[seat][candidate] += 1
+    return votes
+
+
+# ========== CSV BACKEND ==========
+
+def _ensure_csv(path, fields):
+    if not os.path.exists(path):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow(fields)
+
+
+def _reset_csv(path, fields):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(fields)
+
+
+def _append_csv(path, fields, records):
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows([record.get(field, '') for field in fields] for record in records)
+
+
+# Flush a file's written data to disk
+def _sync_file(path):
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+
+
+# Size of a CSV file, used as a rollback point for append-only writes
+def _csv_mark(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+# Bytes just before a read position; a file rewritten in place no longer
+# matches them even when it has grown past the old offset
+TAIL_CHECK_BYTES = 64
+
+
+def _tail_crc(f, offset):
+    start = max(0, offset - TAIL_CHECK_BYTES)
+    f.seek(start)
+    return zlib.crc32(f.read(offset - start))
+
+
+# Rows appended to a CSV file since `position`, mapped by column position.
+# The position is (inode, byte offset, crc of the bytes before the offset).
+def csv_read_since(path, fields, position):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [], None, True
+    with open(path, 'rb') as f:
+        reset = (position is None or position[0] != st.st_ino or st.st_size < position[1]
+                 or _tail_crc(f, position[1]) != position[2])
+        offset = 0 if reset else position[1]
+        f.seek(offset)
+        data = f.read()
+        # Leave a partially written last record for the next call
+        end = _records_end(data)
+        crc = _tail_crc(f, offset + end)
+    # Parsed as one stream so newlines inside quoted fields are kept
+    records = csv.reader(io.StringIO(data[:end].decode('utf-8'), newline=''))
+    if offset == 0:
+        next(records, None)
+    rows = [dict(zip(fields, values)) for values in records]
+    return [row for row in rows if row.get('voter_id')], (st.st_ino, offset + end, crc), reset
+
+
+# Length of the complete CSV records at the start of `data`: up to the last
+# newline that is not inside a quoted field
+def _records_end(data):
+    end = 0
+    quotes = 0
+    start = 0
+    while True:
+        newline = data.find(b'\n', start)
+        if newline < 0:
+            return end
+        quotes += data.count(b'"', start, newline)
+        start = newline + 1
+        if quotes % 2 == 0:
+            end = start
+
+
+# Position at the current end of a CSV file, in the form csv_read_since
+# takes; None if the file is missing or ends in a partly written line
+def csv_end_position(path):
+    try:
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            if st.st_size:
+                f.seek(st.st_size - 1)
+                if f.read(1) != b'\n':
+                    return None
+            return st.st_ino, st.st_size, _tail_crc(f, st.st_size)
+    except OSError:
+        return None
+
+
+# Filter used by the vote log pages; empty filters match everything
+def _vote_matches(row, date=None, constituency=None, voter_id=None):
+    return ((not date or row.get('date') == date) and
+            (not constituency or row.get('constituency') == constituency) and
+            (not voter_id or row.get('voter_id', '').upper() == voter_id.upper()))
+
+
+# One CSV record from a binary file, including newlines inside quoted
+# fields (a record is complete once its quotes are balanced); None at the
+# end of the file or before a partly written record
+def _read_record(f):
+    record = f.readline()
+    while record.count(b'"') % 2:
+        line = f.readline()
+        if not line:
+            return None
+        record += line
+    return record if record.endswith(b'\n') else None
+
+
+# Up to `limit` rows matching the filters, read record by record from byte
+# offset `cursor` (a value returned by a previous call; None starts after
+# the header). Returns (rows, next cursor or None at the end of the file).
+def _csv_page(path, fields, cursor, limit, **filters):
+    rows = []
+    if not os.path.exists(path):
+        return rows, None
+    with open(path, 'rb') as f:
+        if cursor:
+            f.seek(cursor - 1)
+            if f.read(1) != b'\n':
+                raise ValueError('Invalid cursor')
+        else:
+            f.readline()
+        while True:
+            record = _read_record(f)
+            if record is None:
+                return rows, None
+            row = dict(zip(fields, next(csv.reader(io.StringIO(record.decode('utf-8'))), [])))
+            if row.get('voter_id') and _vote_matches(row, **filters):
+                rows.append(row)
+                if len(rows) >= limit:
+                    return rows, f.tell()
+
+
+def _read_csv(path, encoding='utf-8'):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding=encoding, newline='') as f:
+        yield from csv.DictReader(f)
+
+
+class CsvVoteRepository:
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, vote):
+        self.extend([vote])
+
+    def extend(self, votes):
+        _append_csv(self.path, VOTE_FIELDS, votes)
+
+    # Yield every vote row in the order it was cast
+    def log(self):
+        for row in _read_csv(self.path):
+            if row.get('voter_id'):  # Skip empty rows
+                yield row
+
+    # One page of the vote log; see _csv_page for the cursor
+    def page(self, cursor=None, limit=100, date=None, constituency=None, voter_id=None):
+        return _csv_page(self.path, VOTE_FIELDS, cursor, limit,
+                         date=date, constituency=constituency, voter_id=voter_id)
+
+    def tally(self):
+        return tally_rows(_read_csv(self.path))
+
+    # Same contract as CsvDailyVoteRepository.read_since
+    def read_since(self, position):
+        return csv_read_since(self.path, VOTE_FIELDS, position)
+
+    # Rollback point for the vote journal: truncate_to(mark()) undoes any
+    # rows appended in between
+    def mark(self):
+        return _csv_mark(self.path)
+
+    def truncate_to(self, mark):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > mark:
+            os.truncate(self.path, mark)
+
+    # Make appended rows durable (the vote journal calls this before it
+    # moves its checkpoint past them)
+    def sync(self):
+        _sync_file(self.path)
+
+    def clear(self):
+        _reset_csv(self.path, VOTE_FIELDS)
+
+
+class CsvDailyVoteRepository:
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, record):
+        self.extend([record])
+
+    def extend(self, records):
+        _append_csv(self.path, DAILY_VOTE_FIELDS, records)
+
+    # Rows are mapped by position: some files still carry the old
+    # three-column header although every row has a timestamp
+    def rows(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for values in reader:
+                row = dict(zip(DAILY_VOTE_FIELDS, values))
+                if row.get('voter_id'):
+                    yield row
+
+    # Rows appended after `position` (as returned by a previous call).
+    # Returns (rows, position, reset); reset is True when everything was
+    # read from the start because the file is new or was rewritten.
+    def read_since(self, position):
+        return csv_read_since(self.path, DAILY_VOTE_FIELDS, position)
+
+    # Latest time the voter was marked as voted, or None
+    def last_vote_time(self, voter_id):
+        latest = None
+        voter_id = voter_id.upper()
+        for row in self.rows():
+            if row['voter_id'].upper() == voter_id:
+                vote_time = daily_vote_time(row)
+                if vote_time and (latest is None or vote_time > latest):
+                    latest = vote_time
+        return latest
+
+    def mark(self):
+        return _csv_mark(self.path)
+
+    def truncate_to(self, mark):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > mark:
+            os.truncate(self.path, mark)
+
+    # Make appended rows durable (the vote journal calls this before it
+    # moves its checkpoint past them)
+    def sync(self):
+        _sync_file(self.path)
+
+    def clear(self):
+        _reset_csv(self.path, DAILY_VOTE_FIELDS)
+
+
+class CsvCandidateRepository:
+    def __init__(self, path):
+        self.path = path
+
+    def all(self):
+        # utf-8-sig so a spreadsheet BOM does not end up in the first column name
+        return [row for row in _read_csv(self.path, encoding='utf-8-sig')
+                if row.get('State') or row.get('Candidate Name')]  # Skip empty rows
+
+    # Changes whenever the file is rewritten
+    def version(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    # Swap in a new candidate list. `candidates` may be a generator; rows are
+    # streamed to a temporary file which replaces the old one only after all
+    # of them were written and accept() (if given) returns True.
+    # Returns True if the list was replaced.
+    def replace(self, candidates, accept=None):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.candidates-', suffix='.csv')
+        try:
+            with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(CANDIDATE_FIELDS)
+                writer.writerows([c.get(field, '') for field in CANDIDATE_FIELDS] for c in candidates)
+            if accept is not None and not accept():
+                os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, self.path)
+            return True
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def clear(self):
+        _reset_csv(self.path, CANDIDATE_FIELDS)
+
+
+class CsvStorage:
+    name = 'csv'
+
+    def __init__(self, voters_csv='voters.csv', votes_csv='votes.csv',
+                 daily_votes_csv='daily_votes.csv', candidates_csv='candidates.csv'):
+        self.paths = {
+            'voters': voters_csv,
+            'votes': votes_csv,
+            'daily_votes': daily_votes_csv,
+            'candidates': candidates_csv,
+        }
+        self.voters = VoterRegistry(voters_csv)
+        self.votes = CsvVoteRepository(votes_csv)
+        self.daily_votes = CsvDailyVoteRepository(daily_votes_csv)
+        self.candidates = CsvCandidateRepository(candidates_csv)
+
+    # Create any missing file with its header row
+    def init(self):
+        _ensure_csv(self.paths['voters'], VOTER_FIELDS)
+        _ensure_csv(self.paths['votes'], VOTE_FIELDS)
+        _ensure_csv(self.paths['daily_votes'], DAILY_VOTE_FIELDS)
+        _ensure_csv(self.paths['candidates'], CANDIDATE_FIELDS)
+
+
+# ========== SQLITE BACKEND ==========
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('voters_version', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('daily_votes_epoch', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('votes_epoch', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('candidates_version', 0);
+
+CREATE TABLE IF NOT EXISTS voters (
+    id INTEGER PRIMARY KEY,
+    voter_id TEXT NOT NULL COLLATE NOCASE,
+    name TEXT NOT NULL DEFAULT '',
+    template_base64 TEXT NOT NULL,
+    bmp_hash TEXT NOT NULL DEFAULT '',
+    registration_date TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_voters_voter_id ON voters (voter_id);
+
+CREATE TABLE IF NOT EXISTS votes (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL DEFAULT '',
+    voter_id TEXT NOT NULL COLLATE NOCASE,
+    name TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT '',
+    constituency TEXT NOT NULL DEFAULT '',
+    candidate_name TEXT NOT NULL DEFAULT '',
+    party TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_votes_voter_id ON votes (voter_id);
+CREATE INDEX IF NOT EXISTS idx_votes_timestamp ON votes (timestamp);
+CREATE INDEX IF NOT EXISTS idx_votes_constituency ON votes (constituency);
+
+CREATE TABLE IF NOT EXISTS daily_votes (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL DEFAULT '',
+    voter_id TEXT NOT NULL COLLATE NOCASE,
+    voted TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_daily_votes_voter_id ON daily_votes (voter_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS candidates (
+    id INTEGER PRIMARY KEY,
+    source_id TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT '',
+    constituency TEXT NOT NULL DEFAULT '',
+    party TEXT NOT NULL DEFAULT '',
+    candidate_name TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_candidates_constituency ON candidates (state, constituency);
+"""
+
+
+class SqliteDatabase:
+    """One SQLite connection per thread, all in WAL mode."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    # Run `fn(conn)` inside a write transaction
+    def write(self, fn):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    # With synchronous=NORMAL, commits reach the WAL but are only fsynced
+    # at a checkpoint; a passive checkpoint syncs the WAL first
+    def sync(self):
+        self.connection().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def init(self):
+        self.connection().executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class SqliteVoterRepository:
+    """Voters table with the same in-memory cache behaviour as VoterRegistry.
+
+    A version counter in the meta table is bumped by every write, so the
+    cached list is only reloaded when another process changed the table.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.RLock()
+        self._version = None
+        self._voters = []
+        self._by_id = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.appends = 0
+
+    def _current_version(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE key = 'voters_version'").fetchone()[0]
+
+    def _index(self, voter):
+        self._by_id.setdefault(voter['voter_id'].upper(), voter)
+
+    def _refresh(self):
+        conn = self.db.connection()
+        version = self._current_version(conn)
+        if version == self._version:
+            self.hits += 1
+            return
+        self.misses += 1
+        rows = conn.execute('SELECT voter_id, name, template_base64, bmp_hash, registration_date '
+                            'FROM voters ORDER BY id').fetchall()
+        self._voters = [dict(row) for row in rows]
+        self._by_id = {}
+        for voter in self._voters:
+            self._index(voter)
+        self._version = version
+        self.generation += 1
+
+    def voters(self):
+        with self._lock:
+            self._refresh()
+            return list(self._voters)
+
+    # Pick up outside changes; returns the (possibly bumped) generation
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+            return self.generation
+
+    # Same as VoterRegistry.changes_since; a change made by another process
+    # reloads the table, so only this process's appends keep the generation
+    def changes_since(self, generation, count):
+        with self._lock:
+            self._refresh()
+            if generation != self.generation or count > len(self._voters):
+                return self.generation, None
+            return self.generation, self._voters[count:]
+
+    def get(self, voter_id):
+        with self._lock:
+            self._refresh()
+            return self._by_id.get((voter_id or '').strip().upper())
+
+    def page(self, cursor=0, limit=100, voter_id=None, date=None):
+        with self._lock:
+            self._refresh()
+            return page_voters(self._voters, cursor, limit, voter_id, date)
+
+    def extend(self, voters):
+        records = []
+        for voter in voters:
+            record = {field: str(voter.get(field, '') or '').strip() for field in VOTER_FIELDS}
+            if record['voter_id'] and len(record['template_base64']) > 10:
+                records.append(record)
+
+        def insert(conn):
+            before = self._current_version(conn)
+            conn.executemany(
+                'INSERT INTO voters (voter_id, name, template_base64, bmp_hash, registration_date) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(r['voter_id'], r['name'], r['template_base64'], r['bmp_hash'], r['registration_date'])
+                 for r in records])
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'voters_version'")
+            return before
+
+        with self._lock:
+            before = self.db.write(insert)
+            self.appends += len(records)
+            if before == self._version:
+                # Nobody else wrote in between: extend the cache in place
+                for record in records:
+                    self._voters.append(record)
+                    self._index(record)
+                self._version = before + 1
+
+    def append(self, voter):
+        self.extend([voter])
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def clear(self):
+        def delete(conn):
+            conn.execute('DELETE FROM voters')
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'voters_version'")
+        with self._lock:
+            self.db.write(delete)
+            self._version = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'voters': len(self._voters),
+                'hits': self.hits,
+                'misses': self.misses,
+                'appends': self.appends,
+                'generation': self.generation,
+            }
+
+
+# Rows of an append-only table added since `position` = (epoch, last row id).
+# Deleting rows bumps the table's epoch so readers start over.
+def _sqlite_read_since(conn, table, fields, position):
+    epoch = conn.execute('SELECT value FROM meta WHERE key = ?', (f'{table}_epoch',)).fetchone()[0]
+    reset = position is None or position[0] != epoch
+    last_id = 0 if reset else position[1]
+    rows = conn.execute(f"SELECT id, {', '.join(fields)} FROM {table} WHERE id > ? ORDER BY id",
+                        (last_id,)).fetchall()
+    if rows:
+        last_id = rows[-1]['id']
+    return [dict(row) for row in rows], (epoch, last_id), reset
+
+
+def _sqlite_delete(conn, table, where='', params=()):
+    if conn.execute(f'DELETE FROM {table} {where}', params).rowcount:
+        conn.execute('UPDATE meta SET value = value + 1 WHERE key = ?', (f'{table}_epoch',))
+
+
+class SqliteVoteRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def append(self, vote):
+        self.extend([vote])
+
+    def extend(self, votes):
+        rows = [tuple(vote.get(field, '') or '' for field in VOTE_FIELDS) for vote in votes]
+        self.db.write(lambda conn: conn.executemany(
+            f"INSERT INTO votes ({', '.join(VOTE_FIELDS)}) VALUES ({', '.join('?' * len(VOTE_FIELDS))})", rows))
+
+    def log(self):
+        cursor = self.db.connection().execute(f"SELECT {', '.join(VOTE_FIELDS)} FROM votes ORDER BY id")
+        for row in cursor:
+            yield dict(row)
+
+    # One page of the vote log; the cursor is the id of the last row returned
+    def page(self, cursor=None, limit=100, date=None, constituency=None, voter_id=None):
+        where, params = ['id > ?'], [int(cursor or 0)]
+        for column, value in (('date', date), ('constituency', constituency), ('voter_id', voter_id)):
+            if value:
+                where.append(f'{column} = ?')
+                params.append(value)
+        rows = self.db.connection().execute(
+            f"SELECT id, {', '.join(VOTE_FIELDS)} FROM votes WHERE {' AND '.join(where)} ORDER BY id LIMIT ?",
+            params + [limit]).fetchall()
+        next_cursor = rows[-1]['id'] if len(rows) == limit else None
+        return [{field: row[field] for field in VOTE_FIELDS} for row in rows], next_cursor
+
+    def tally(self):
+        votes = {}
+        rows = self.db.connection().execute(
+            "SELECT state, constituency, candidate_name, party, COUNT(*) AS n FROM votes "
+            "WHERE constituency != '' AND candidate_name != '' "
+            "GROUP BY state, constituency, candidate_name, party ORDER BY MIN(id)")
+        for row in rows:
+            candidate = f"{row['candidate_name']} ({row['party']})"
+            votes.setdefault((row['state'], row['constituency']), {})[candidate] = row['n']
+        return votes
+
+    # Same contract as SqliteDailyVoteRepository.read_since
+    def read_since(self, position):
+        return _sqlite_read_since(self.db.connection(), 'votes', VOTE_FIELDS, position)
+
+    def mark(self):
+        return self.db.connection().execute('SELECT COALESCE(MAX(id), 0) FROM votes').fetchone()[0]
+
+    def truncate_to(self, mark):
+        self.db.write(lambda conn: _sqlite_delete(conn, 'votes', 'WHERE id > ?', (mark,)))
+
+    def sync(self):
+        self.db.sync()
+
+    def clear(self):
+        self.db.write(lambda conn: _sqlite_delete(conn, 'votes'))
+
+
+class SqliteDailyVoteRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def append(self, record):
+        self.extend([record])
+
+    def extend(self, records):
+        rows = [tuple(record.get(field, '') or '' for field in DAILY_VOTE_FIELDS) for record in records]
+        self.db.write(lambda conn: conn.executemany(
+            'INSERT INTO daily_votes (date, voter_id, voted, timestamp) VALUES (?, ?, ?, ?)', rows))
+
+    def rows(self):
+        cursor = self.db.connection().execute('SELECT date, voter_id, voted, timestamp FROM daily_votes ORDER BY id')
+        for row in cursor:
+            yield dict(row)
+
+    # Same contract as CsvDailyVoteRepository.read_since; the position is
+    # (clear epoch, last row id)
+    def read_since(self, position):
+        return _sqlite_read_since(self.db.connection(), 'daily_votes', DAILY_VOTE_FIELDS, position)
+
+    def last_vote_time(self, voter_id):
+        latest = None
+        rows = self.db.connection().execute(
+            'SELECT date, timestamp FROM daily_votes WHERE voter_id = ?', (voter_id,))
+        for row in rows:
+            vote_time = daily_vote_time(dict(row))
+            if vote_time and (latest is None or vote_time > latest):
+                latest = vote_time
+        return latest
+
+    def mark(self):
+        return self.db.connection().execute('SELECT COALESCE(MAX(id), 0) FROM daily_votes').fetchone()[0]
+
+    def truncate_to(self, mark):
+        self.db.write(lambda conn: _sqlite_delete(conn, 'daily_votes', 'WHERE id > ?', (mark,)))
+
+    def sync(self):
+        self.db.sync()
+
+    def clear(self):
+        self.db.write(lambda conn: _sqlite_delete(conn, 'daily_votes'))
+
+
+class _Rejected(Exception):
+    """Raised inside a write transaction to roll it back."""
+
+
+class SqliteCandidateRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def all(self):
+        rows = self.db.connection().execute(
+            'SELECT source_id, state, constituency, party, candidate_name FROM candidates ORDER BY id')
+        return [dict(zip(CANDIDATE_FIELDS, tuple(row))) for row in rows]
+
+    def version(self):
+        return self.db.connection().execute("SELECT value FROM meta WHERE key = 'candidates_version'").fetchone()[0]
+
+    # Same contract as CsvCandidateRepository.replace; the swap is one
+    # transaction that is rolled back if accept() returns False
+    def replace(self, candidates, accept=None):
+        rows = (tuple((c.get(field) or '').strip() for field in CANDIDATE_FIELDS) for c in candidates
+                if c.get('State') or c.get('Candidate Name'))
+
+        def swap(conn):
+            conn.execute('DELETE FROM candidates')
+            conn.executemany('INSERT INTO candidates (source_id, state, constituency, party, candidate_name) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+            if accept is not None and not accept():
+                raise _Rejected()
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'candidates_version'")
+        try:
+            self.db.write(swap)
+        except _Rejected:
+            return False
+        return True
+
+    def clear(self):
+        def delete(conn):
+            conn.execute('DELETE FROM candidates')
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'candidates_version'")
+        self.db.write(delete)
+
+
+class SqliteStorage:
+    name = 'sqlite'
+
+    def __init__(self, path='vms.sqlite3'):
+        self.path = path
+        self.db = SqliteDatabase(path)
+        self.voters = SqliteVoterRepository(self.db)
+        self.votes = SqliteVoteRepository(self.db)
+        self.daily_votes = SqliteDailyVoteRepository(self.db)
+        self.candidates = SqliteCandidateRepository(self.db)
+
+    def init(self):
+        self.db.init()
+
+
+# Create a storage backend by name ('csv' or 'sqlite')
+def get_storage(name=None, sqlite_path='vms.sqlite3', **csv_paths):
+    name = (name or os.environ.get('STORAGE_BACKEND') or CsvStorage.name).lower()
+    if name == CsvStorage.name:
+        return CsvStorage(**csv_paths)
+    if name == SqliteStorage.name:
+        return SqliteStorage(sqlite_path)
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+# Replace everything in `target` with the contents of `source`
+def copy_storage(source, target, batch_size=5000):
+    target.init()
+    for repo in ('voters', 'votes', 'daily_votes'):
+        getattr(target, repo).clear()
+    counts = {}
+    batches = {
+        'voters': iter(source.voters.voters()),
+        'votes': source.votes.log(),
+        'daily_votes': source.daily_votes.rows(),
+    }
+    for repo, rows in batches.items():
+        counts[repo] = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                getattr(target, repo).extend(batch)
+                counts[repo] += len(batch)
+                batch = []
+        if batch:
+            getattr(target, repo).extend(batch)
+            counts[repo] += len(batch)
+    candidates = source.candidates.all()
+    target.candidates.replace(candidates)
+    counts['candidates'] = len(candidates)
+    return counts
+
+
+def _csv_storage(data_dir):
+    return CsvStorage(
+        voters_csv=os.path.join(data_dir, 'voters.csv'),
+        votes_csv=os.path.join(data_dir, 'votes.csv'),
+        daily_votes_csv=os.path.join(data_dir, 'daily_votes.csv'),
+        candidates_csv=os.path.join(data_dir, 'candidates.csv'),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy voting data between CSV files and SQLite')
+    parser.add_argument('command', choices=['import', 'export'],
+                        help='import: CSV files -> SQLite; export: SQLite -> CSV files')
+    parser.add_argument('--db', default='vms.sqlite3', help='SQLite database path')
+    parser.add_argument('--data-dir', default='.', help='directory holding the CSV files')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    csv_storage = _csv_storage(args.data_dir)
+    sqlite_storage = SqliteStorage(args.db)
+    if args.command == 'import':
+        if is_legacy_voters_csv(csv_storage.paths['voters']):
+            print("voters.csv still has inline images; run 'python blob_store.py migrate' first")
+            return
+        csv_storage.init()
+        counts = copy_storage(csv_storage, sqlite_storage)
+        print(f"Imported into {args.db}: {counts}")
+    else:
+        sqlite_storage.init()
+        counts = copy_storage(sqlite_storage, csv_storage)
+        print(f"Exported to {args.data_dir}: {counts}")
+    sqlite_storage.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Structured logging and latency metrics.
+
+``setup_logging`` sends log records through a queue to a background thread
+that writes them as JSON lines to a rotating file in Logs/ (one per
+process) and to stderr,
+so request threads never wait on disk or console I/O. Each call site may
+log at most ``RATE_LIMIT_BURST`` records per ``RATE_LIMIT_INTERVAL``
+seconds; the rest are dropped and counted, and the next record let through
+carries the number dropped in its ``suppressed`` field.
+
+``metrics`` collects latency histograms per processing stage (voter CSV
+parse, matching, vote commit, template render) and per endpoint. /metrics
+serves them in the Prometheus text format. Each worker process keeps its
+own histograms.
+"""
+import atexit
+import bisect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+LOG_DIR = 'Logs'
+# One file per process: RotatingFileHandler renames the file it writes to,
+# so workers sharing one file would rotate it under each other
+LOG_FILE = 'vms-{process}.log'
+LOG_MAX_BYTES = 10 * 2**20
+LOG_BACKUP_COUNT = 5
+
+RATE_LIMIT_BURST = 20
+RATE_LIMIT_INTERVAL = 10
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# LogRecord attributes that are not extra fields
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+# ========== LOGGING ==========
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; values passed with extra= become fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per call site (logger name and line number)."""
+
+    def __init__(self, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        # (logger, line) -> [tokens, last refill, suppressed since last emitted]
+        self._buckets = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = (record.name, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.burst / self.interval)
+                bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # Resolve the message and traceback before queuing (their arguments may
+    # change afterwards) but keep extra fields for the JSON formatter
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+rate_limit = RateLimitFilter()
+
+
+# Route all logging through the queue; safe to call more than once.
+# Level, directory and console output can be set with LOG_LEVEL, LOG_DIR
+# and LOG_CONSOLE=0.
+def setup_logging(log_dir=None, level=None, console=None):
+    global _listener
+    if _listener is not None:
+        return
+    log_dir = log_dir or os.environ.get('LOG_DIR', LOG_DIR)
+    level = (level or os.environ.get('LOG_LEVEL', 'INFO')).upper()
+    if console is None:
+        console = os.environ.get('LOG_CONSOLE', '1') != '0'
+
+    formatter = JsonFormatter()
+    handlers = []
+    os.makedirs(log_dir, exist_ok=True)
+    process = '-'.join(filter(None, [os.environ.get('SHARD_NAME', ''), str(os.getpid())]))
+    file_handler = logging.handlers.RotatingFileHandler(os.path.join(log_dir, LOG_FILE.format(process=process)),
+                                                        maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                                        encoding='utf-8')
+    handlers.append(file_handler)
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(rate_limit)
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+# ========== METRICS ==========
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    # Estimated q-quantile (0 < q < 1), interpolated within its bucket and
+    # kept within the observed range
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        estimate = self.max
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / n
+                break
+            seen += n
+        return min(max(estimate, self.min), self.max)
+
+
+class Metrics:
+    """Latency histograms keyed by metric name and one label."""
+
+    HELP = {
+        'vms_stage_seconds': 'Time spent in a processing stage',
+        'vms_request_seconds': 'Time to build the response, per endpoint',
+        'vms_match_service_seconds': 'SGIMatchScore calls including retries, per outcome',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (label name, {label value: Histogram})
+        self._histograms = {}
+
+    def observe(self, name, label, value, seconds):
+        with self._lock:
+            _, by_value = self._histograms.setdefault(name, (label, {}))
+            histogram = by_value.get(value)
+            if histogram is None:
+                histogram = by_value[value] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('vms_stage_seconds', 'stage', stage, time.perf_counter() - start)
+
+    # {name: {label value: {count, sum, p50, p99}}}
+    def snapshot(self):
+        with self._lock:
+            return {name: {value: {'count': h.count, 'sum': round(h.sum, 6),
+                                   'p50': round(h.quantile(0.5), 6), 'p99': round(h.quantile(0.99), 6)}
+                           for value, h in by_value.items()}
+                    for name, (_label, by_value) in self._histograms.items()}
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (label, by_value) in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for value, h in sorted(by_value.items()):
+                    value = value.replace('\\', '\\\\').replace('"', '\\"')
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + ('+Inf',), h.counts):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{label}="{value}"}} {h.sum:.6f}')
+                    lines.append(f'{name}_count{{{label}="{value}"}} {h.count}')
+            lines.append('# HELP vms_log_suppressed_total Log records dropped by the rate limit')
+            lines.append('# TYPE vms_log_suppressed_total counter')
+            lines.append(f'vms_log_suppressed_total {rate_limit.suppressed}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,194 @@
+"""Candidate pre-filtering index for fingerprint templates.
+
+Each ISO template is reduced to a set of minutiae-triplet keys: for every
+minutia, triangles formed with pairs of its nearest neighbours are described
+by their quantised side lengths, minutia types and relative ridge angles.
+Those features do not change when the finger is shifted or rotated, so a
+re-scan of the same finger shares many keys with its enrolled template.
+
+A probe is looked up by counting shared keys per voter; only the top-K
+voters are then scored by the (expensive) matcher.
+"""
+import heapq
+import threading
+from array import array
+from collections import Counter
+
+from matcher import ANGLE_UNITS, decode_template, parse_iso_template
+
+# Voters passed on to full scoring
+DEFAULT_SHORTLIST_SIZE = 50
+
+NEIGHBOURS = 4
+# Side lengths are quantised into bins of this many pixels
+DISTANCE_BIN = 12
+MAX_DISTANCE_BINS = 31
+# Relative angles are quantised into 8 sectors of 45 degrees
+ANGLE_BINS = 8
+
+
+def _side_bin(a, b):
+    d = ((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) ** 0.5
+    return min(int(d // DISTANCE_BIN), MAX_DISTANCE_BINS)
+
+
+def _angle_bin(a, b):
+    return ((b[2] - a[2]) % ANGLE_UNITS) * ANGLE_BINS // ANGLE_UNITS
+
+
+# Compute the set of integer triplet keys for a template.
+# Raises ValueError if the template is not an ISO 19794-2 record.
+def triplet_keys(template):
+    minutiae = parse_iso_template(decode_template(template))
+    keys = set()
+    seen = set()
+    for i, (x, y, _a, _t) in enumerate(minutiae):
+        distances = sorted(((mx - x) ** 2 + (my - y) ** 2, j)
+                           for j, (mx, my, _ma, _mt) in enumerate(minutiae) if j != i)
+        nearest = [j for _d, j in distances[:NEIGHBOURS]]
+        for a in range(len(nearest)):
+            for b in range(a + 1, len(nearest)):
+                triangle = tuple(sorted((i, nearest[a], nearest[b])))
+                if triangle in seen:
+                    continue
+                seen.add(triangle)
+                keys.add(_triangle_key([minutiae[k] for k in triangle]))
+    return keys
+
+
+# Describe a triangle of minutiae in a rotation/translation invariant way.
+# Vertices are put in a canonical order by the length of the opposite side
+# so the same triangle yields the same key whatever order it was found in.
+def _triangle_key(points):
+    p0, p1, p2 = points
+    opposite = [(_side_bin(p1, p2), p0), (_side_bin(p0, p2), p1), (_side_bin(p0, p1), p2)]
+    opposite.sort(key=lambda item: item[0])
+    (s0, v0), (s1, v1), (s2, v2) = opposite
+    key = s0
+    key = key * 32 + s1
+    key = key * 32 + s2
+    key = key * 4 + v0[3]
+    key = key * 4 + v1[3]
+    key = key * 4 + v2[3]
+    key = key * ANGLE_BINS + _angle_bin(v0, v1)
+    key = key * ANGLE_BINS + _angle_bin(v0, v2)
+    return key
+
+
+def _keys_or_none(template):
+    try:
+        return triplet_keys(template)
+    except (ValueError, TypeError):
+        return None
+
+
+# Add a voter to index structures (a voter already in them is skipped)
+def _insert(postings, voter_ids, ordinals, unindexed, voter_id, keys):
+    if voter_id.upper() in ordinals:
+        return
+    ordinal = len(voter_ids)
+    voter_ids.append(voter_id)
+    ordinals[voter_id.upper()] = ordinal
+    if not keys:
+        unindexed.append(voter_id)
+        return
+    for key in keys:
+        posting = postings.get(key)
+        if posting is None:
+            postings[key] = array('I', (ordinal,))
+        else:
+            posting.append(ordinal)
+
+
+class TemplateIndex:
+    """Inverted index from triplet keys to voters.
+
+    Voters whose templates cannot be parsed are kept in a separate list and
+    are always included in shortlists so they are never silently skipped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._postings = {}
+            self._voter_ids = []
+            self._ordinals = {}
+            self._unindexed = []
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def __contains__(self, voter_id):
+        return voter_id.upper() in self._ordinals
+
+    # Rebuild the index from a list of voter dicts (as from get_all_voters).
+    # The new postings are built aside and swapped in under the lock, as
+    # restore() does, so shortlists keep using the old index meanwhile.
+    def build(self, voters):
+        postings, voter_ids, ordinals, unindexed = {}, [], {}, []
+        for voter in voters:
+            _insert(postings, voter_ids, ordinals, unindexed, voter['voter_id'],
+                    _keys_or_none(voter['template_base64']))
+        with self._lock:
+            self._postings = postings
+            self._voter_ids = voter_ids
+            self._ordinals = ordinals
+            self._unindexed = unindexed
+
+    # Index one voter's template; incremental, used by save_voter
+    def add(self, voter_id, template):
+        keys = _keys_or_none(template)
+        with self._lock:
+            _insert(self._postings, self._voter_ids, self._ordinals, self._unindexed, voter_id, keys)
+
+    # Return up to `size` voter IDs most likely to match the probe, best
+    # first, followed by any unindexed voters. Returns None when the probe
+    # itself cannot be indexed, meaning the caller should search everyone.
+    def shortlist(self, probe, size=DEFAULT_SHORTLIST_SIZE):
+        try:
+            keys = triplet_keys(probe)
+        except (ValueError, TypeError):
+            return None
+        votes = Counter()
+        with self._lock:
+            for key in keys:
+                posting = self._postings.get(key)
+                if posting is not None:
+                    votes.update(posting)
+            best = heapq.nlargest(size, votes.items(), key=lambda item: item[1])
+            return [self._voter_ids[ordinal] for ordinal, _count in best] + list(self._unindexed)
+
+    # Contents for the warm-state snapshot: voter IDs in ordinal order,
+    # unindexed voter IDs, and key -> posting list bytes
+    def state(self):
+        with self._lock:
+            return {
+                'voter_ids': list(self._voter_ids),
+                'unindexed': list(self._unindexed),
+                'postings': {key: posting.tobytes() for key, posting in self._postings.items()},
+            }
+
+    def restore(self, state):
+        postings = {}
+        for key, data in state['postings'].items():
+            posting = array('I')
+            posting.frombytes(data)
+            postings[key] = posting
+        voter_ids = list(state['voter_ids'])
+        with self._lock:
+            self._postings = postings
+            self._voter_ids = voter_ids
+            self._ordinals = {voter_id.upper(): ordinal for ordinal, voter_id in enumerate(voter_ids)}
+            self._unindexed = list(state['unindexed'])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'voters': len(self._voter_ids),
+                'keys': len(self._postings),
+                'postings': sum(len(p) for p in self._postings.values()),
+                'unindexed': len(self._unindexed),
+            }
@@ -0,0 +1,417 @@
+"""Memory-mapped store of decoded fingerprint templates.
+
+voters.csv keeps templates as base64 text, so every comparison used to
+decode them again. This store keeps the decoded ISO records in one binary
+file that is memory-mapped on startup; ``get`` returns a zero-copy
+memoryview into the mapping, and the operating system pages templates in
+only when they are compared.
+
+File layout (all integers big-endian):
+
+    header   magic (8s) | voters (I) | entries (I) | roll checksum (Q) | index offset (Q) | slots (I)
+    data     the decoded templates, back to back
+    index    open-addressing hash table of ``slots`` fixed-size slots, a power
+             of two and at least twice the number of templates; a voter's
+             first slot is the CRC-32 of its ID, followed by linear probing:
+             voter ID, upper-cased and NUL-padded (32s) | offset (Q) | length (I)
+             (offset 0 marks an empty slot, length 0 a voter whose template
+             is not stored)
+    segments voters enrolled after the file was written, one segment per
+             flush: magic (8s) | count (I) | data length (Q), their
+             templates, then ``count`` entries as in the index
+
+``voters`` and the roll checksum (sum of the CRC-32 of every voter ID on
+the roll) describe the roll the file was built from, and each voter in a
+segment that the file did not have yet is added to them; when they no
+longer agree with the registry the file is rebuilt. Templates that do not
+decode are not stored, and the caller falls back to the base64 text for
+them. Voters enrolled since the last flush are kept in memory and appended
+as a segment every ``flush_every`` enrolments, under an flock on
+``<path>.lock`` so that workers sharing the file do not write at the same
+time; each worker reads the segments the others appended. Once the
+segments hold more templates than the index, the file is rewritten.
+"""
+import binascii
+import contextlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from matcher import decode_template
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking is available
+    fcntl = None
+
+MAGIC = b'VMSTPL\x00\x02'
+HEADER = struct.Struct('>8sIIQQI')
+INDEX_ENTRY = struct.Struct('>32sQI')
+SEGMENT_MAGIC = b'VMSSEG\x00\x01'
+SEGMENT = struct.Struct('>8sIQ')
+VOTER_ID_SIZE = 32
+FLUSH_EVERY = 1000
+
+_CHECKSUM_MASK = 2**64 - 1
+
+
+def _id_key(voter_id):
+    return voter_id.strip().upper().encode('utf-8')
+
+
+def _id_checksum(key):
+    return zlib.crc32(key)
+
+
+# Checksum of a whole roll; independent of voter order
+def roll_checksum(voters):
+    total = 0
+    for voter in voters:
+        total += _id_checksum(_id_key(voter['voter_id']))
+    return total & _CHECKSUM_MASK
+
+
+class TemplateStore:
+    def __init__(self, path, flush_every=FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._file = None
+        self._mm = None
+        self._voters = 0
+        self._entries = 0
+        self._checksum = 0
+        self._index_offset = HEADER.size
+        self._slots = 0
+        # End of the last complete segment read
+        self._end = 0
+        # voter ID key -> (offset, length) of the voters in segments
+        self._appended = {}
+        self._appended_entries = 0
+        # voter ID key -> decoded template, enrolled since the last flush
+        self._pending = {}
+        # Keys of every voter enrolled since the last flush, with or without
+        # a template, so a voter added by save_voter is not counted again
+        # when sync() picks up the registry's new rows
+        self._pending_keys = set()
+        # (registry generation, number of its voters covered)
+        self._source = None
+        self.rebuilds = 0
+        self.appends = 0
+
+    # ---- file handling ----
+
+    def _unmap(self):
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                pass  # Views still held by a running match; closed when released
+            self._mm = None
+
+    def _close(self):
+        self._unmap()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # Map the file; returns False if it is missing or not a template store
+    def _open(self):
+        self._close()
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            f.close()
+            return False  # Empty file
+        magic, voters, entries, checksum, index_offset, slots = HEADER.unpack_from(mm, 0) \
+            if len(mm) >= HEADER.size else (b'', 0, 0, 0, 0, 0)
+        if magic != MAGIC or index_offset + slots * INDEX_ENTRY.size > len(mm) or \
+                not slots or slots < 2 * entries or slots & (slots - 1):
+            logger.warning("Ignoring unreadable template store %s", self.path)
+            mm.close()
+            f.close()
+            return False
+        self._file, self._mm = f, mm
+        self._voters, self._entries, self._checksum, self._index_offset = voters, entries, checksum, index_offset
+        self._slots = slots
+        self._end = index_offset + slots * INDEX_ENTRY.size
+        self._appended = {}
+        self._appended_entries = 0
+        self._read_segments()
+        return True
+
+    # Index the complete segments after self._end
+    def _read_segments(self):
+        mm = self._mm
+        while self._end + SEGMENT.size <= len(mm):
+            magic, count, length = SEGMENT.unpack_from(mm, self._end)
+            index = self._end + SEGMENT.size + length
+            end = index + count * INDEX_ENTRY.size
+            if magic != SEGMENT_MAGIC or end > len(mm):
+                break  # Partly written; cut off by the next flush
+            for i in range(count):
+                key, offset, size = INDEX_ENTRY.unpack_from(mm, index + i * INDEX_ENTRY.size)
+                key = key.rstrip(b'\x00')
+                if self._in_file(key):
+                    continue
+                self._voters += 1
+                self._checksum = (self._checksum + _id_checksum(key)) & _CHECKSUM_MASK
+                self._appended[key] = (offset, size)
+                if size:
+                    self._appended_entries += 1
+            self._end = end
+
+    # Follow what other workers did to the file since it was mapped: a
+    # rewritten file is mapped afresh, appended segments are read
+    def _catch_up(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._close()
+            return
+        if self._mm is None or os.fstat(self._file.fileno()).st_ino != st.st_ino:
+            self._open()
+        elif st.st_size > len(self._mm):
+            self._unmap()
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._read_segments()
+
+    # Exclusive flock on <path>.lock while the file is appended to or
+    # rewritten; callers hold self._lock
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    # Map an existing file (e.g. at startup); sync() still checks it
+    # against the roll
+    def load(self):
+        with self._lock:
+            return self._open()
+
+    # Whether the file has this voter, with or without a template
+    def _in_file(self, key):
+        if key in self._appended:
+            return True
+        return self._mm is not None and len(key) <= VOTER_ID_SIZE and self._find(key) is not None
+
+    # Whether a voter is already counted, in the file or since it was written
+    def _known(self, key):
+        return key in self._pending_keys or self._in_file(key)
+
+    # Keys of the pending voters the file does not have yet
+    def _unflushed(self):
+        return [key for key in self._pending_keys if not self._in_file(key)]
+
+    def _stored_entries(self):
+        for slot in range(self._slots):
+            key, offset, length = INDEX_ENTRY.unpack_from(self._mm, self._index_offset + slot * INDEX_ENTRY.size)
+            if offset:
+                yield key.rstrip(b'\x00'), offset, length
+
+    # Write `entries` ((key, template bytes) pairs) as a new file and map it
+    def _write(self, entries, voters, checksum):
+        entries = list(entries)
+        slots = 8
+        while slots < 2 * len(entries):
+            slots *= 2
+        index = bytearray(slots * INDEX_ENTRY.size)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.templates-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytes(HEADER.size))
+            offset = HEADER.size
+            for key, data in entries:
+                f.write(data)
+                slot = zlib.crc32(key) & (slots - 1)
+                while INDEX_ENTRY.unpack_from(index, slot * INDEX_ENTRY.size)[1]:
+                    slot = (slot + 1) & (slots - 1)
+                INDEX_ENTRY.pack_into(index, slot * INDEX_ENTRY.size, key, offset, len(data))
+                offset += len(data)
+            f.write(index)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, voters, len(entries), checksum, offset, slots))
+        self._close()
+        os.replace(tmp_path, self.path)
+        self._pending = {}
+        self._pending_keys = set()
+        self._open()
+
+    def _rebuild(self, voters):
+        entries = {}
+        for voter in voters:
+            key = _id_key(voter['voter_id'])
+            if len(key) > VOTER_ID_SIZE or key in entries:
+                continue
+            try:
+                data = decode_template(voter['template_base64'])
+            except (binascii.Error, ValueError, TypeError):
+                data = b''
+            entries[key] = data or b''
+        self._write(entries.items(), len(voters), roll_checksum(voters))
+        self.rebuilds += 1
+
+    # Append the pending voters the file does not have yet as one segment
+    def _flush(self):
+        if not self._pending_keys:
+            return
+        with self._file_lock():
+            self._catch_up()
+            if self._mm is None:
+                # No file yet: write one with these voters; sync() rebuilds
+                # it if they are not the whole roll
+                keys = self._pending_keys
+                self._write(list(self._pending.items()), len(keys),
+                            sum(map(_id_checksum, keys)) & _CHECKSUM_MASK)
+                return
+            keys = [key for key in self._unflushed() if len(key) <= VOTER_ID_SIZE]
+            if keys:
+                self._append(keys)
+            self._pending = {}
+            self._pending_keys = set()
+            if self._appended_entries > max(self._entries, self.flush_every):
+                self._compact()
+
+    def _append(self, keys):
+        data = bytearray()
+        index = bytearray()
+        start = self._end + SEGMENT.size
+        for key in keys:
+            template = self._pending.get(key, b'')
+            index += INDEX_ENTRY.pack(key, start + len(data), len(template))
+            data += template
+        with open(self.path, 'r+b') as f:
+            # Drop whatever a worker that died while appending left behind
+            f.truncate(self._end)
+            f.seek(self._end)
+            f.write(SEGMENT.pack(SEGMENT_MAGIC, len(keys), len(data)) + data + index)
+        self.appends += 1
+        self._catch_up()
+
+    # Rewrite the file as one index once the segments outgrow it
+    def _compact(self):
+        mm = self._mm
+        entries = [(key, mm[offset:offset + length]) for key, offset, length in self._stored_entries()]
+        entries += [(key, mm[offset:offset + length]) for key, (offset, length) in self._appended.items()]
+        self._write(entries, self._voters, self._checksum)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    # ---- keeping in step with the roll ----
+
+    # Make sure the store covers exactly the voters in the registry. Voters
+    # the registry read from appended rows are added; the whole roll is only
+    # re-checked after the registry reloads its voters.
+    def sync(self, registry):
+        with self._lock:
+            if self._source is not None and self._mm is not None:
+                generation, added = registry.changes_since(*self._source)
+                if added is not None:
+                    self._add_many([(voter['voter_id'], voter['template_base64']) for voter in added
+                                    if not self._known(_id_key(voter['voter_id']))])
+                    self._source = (generation, self._source[1] + len(added))
+                    return
+            with self._file_lock():
+                self._catch_up()
+                voters = registry.voters()
+                unflushed = self._unflushed()
+                expected = (len(voters), roll_checksum(voters))
+                actual = (self._voters + len(unflushed),
+                          (self._checksum + sum(map(_id_checksum, unflushed))) & _CHECKSUM_MASK)
+                if self._mm is None or expected != actual:
+                    logger.info("Rebuilding %s from %d voters", self.path, len(voters))
+                    self._rebuild(voters)
+            self._source = (registry.generation, len(voters))
+
+    # Record a newly enrolled voter (called by save_voter)
+    def add(self, voter_id, template):
+        self.add_many([(voter_id, template)])
+
+    def add_many(self, pairs):
+        with self._lock:
+            self._add_many(pairs)
+
+    def _add_many(self, pairs):
+        for voter_id, template in pairs:
+            key = _id_key(voter_id)
+            self._pending_keys.add(key)
+            if len(key) > VOTER_ID_SIZE:
+                continue
+            try:
+                data = decode_template(template)
+            except (binascii.Error, ValueError, TypeError):
+                continue
+            if data:
+                self._pending[key] = data
+        if len(self._pending) >= self.flush_every:
+            self._flush()
+
+    # Drop every template (called by delete_voters)
+    def clear(self):
+        with self._lock, self._file_lock():
+            self._write([], 0, 0)
+            self._source = None
+
+    # ---- lookups ----
+
+    def _find(self, key):
+        mm, start, mask = self._mm, self._index_offset, self._slots - 1
+        padded = key.ljust(VOTER_ID_SIZE, b'\x00')
+        slot = zlib.crc32(key) & mask
+        while True:
+            found, offset, length = INDEX_ENTRY.unpack_from(mm, start + slot * INDEX_ENTRY.size)
+            if not offset:
+                return None
+            if found == padded:
+                return offset, length
+            slot = (slot + 1) & mask
+
+    # Decoded template of a voter as a read-only memoryview, or None if the
+    # store does not have it
+    def get(self, voter_id):
+        key = _id_key(voter_id)
+        with self._lock:
+            data = self._pending.get(key)
+            if data is not None:
+                return memoryview(data)
+            if self._mm is None or len(key) > VOTER_ID_SIZE:
+                return None
+            found = self._appended.get(key) or self._find(key)
+            if found is None or not found[1]:
+                return None
+            offset, length = found
+            return memoryview(self._mm)[offset:offset + length]
+
+    def __len__(self):
+        with self._lock:
+            return self._entries + self._appended_entries + len(self._pending)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'voters': self._voters + len(self._unflushed()),
+                'templates': self._entries + self._appended_entries + len(self._pending),
+                'pending': len(self._pending),
+                'file_bytes': len(self._mm) if self._mm is not None else 0,
+                'appends': self.appends,
+                'rebuilds': self.rebuilds,
+            }
@@ -0,0 +1,319 @@
+"""Write-ahead journal and group commit for cast votes.
+
+A vote and its "voted" marker are written as a single checksummed record to
+an append-only journal, fsynced, and only then applied to the vote and daily
+vote stores. Concurrent requests are queued and committed in batches by one
+writer thread, so a single fsync covers many votes.
+
+The double-vote check runs inside the commit, while holding an exclusive
+lock on the journal file, after refreshing the 75-hour vote window from the
+store. Two requests for the same voter - from the same process or from
+different workers - can therefore never both be accepted.
+
+Crash recovery: before applying a batch the writer saves a checkpoint with
+rollback marks for both stores. If the process dies mid-apply, ``recover``
+rolls the stores back to those marks and replays every valid journal record
+from the checkpoint offset; a torn last record is discarded.
+"""
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking is available
+    fcntl = None
+
+# Journal is truncated once everything is applied and it grows past this size
+JOURNAL_MAX_BYTES = 16 * 1024 * 1024
+# Striped per-voter locks so a voter's concurrent requests queue up in-process
+VOTER_LOCK_STRIPES = 256
+
+
+# fsync a directory so a rename inside it survives a power loss
+def _sync_directory(directory):
+    if not hasattr(os, 'O_DIRECTORY'):  # Windows: not supported
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _PendingVote:
+    __slots__ = ('voter_id', 'vote', 'daily', 'event', 'accepted', 'error', 'taken', 'cancelled')
+
+    def __init__(self, voter_id, vote, daily):
+        self.voter_id = voter_id
+        self.vote = vote
+        self.daily = daily
+        self.event = threading.Event()
+        self.accepted = False
+        self.error = None
+        # Both guarded by VoteJournal._claim_lock: the writer takes a vote
+        # for a batch, or commit gives up on it after a timeout
+        self.taken = False
+        self.cancelled = False
+
+
+def _encode_record(vote, daily):
+    payload = json.dumps({'vote': vote, 'daily': daily}, separators=(',', ':'), ensure_ascii=False)
+    return f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n".encode('utf-8')
+
+
+# Parse journal bytes into records; stops at the first torn or corrupt line.
+# Returns (records, number of valid bytes).
+def _decode_records(data):
+    records = []
+    valid = 0
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b'\n') or len(line) < 10:
+            break
+        try:
+            crc, payload = line[:8].decode('ascii'), line[9:-1]
+            if int(crc, 16) != zlib.crc32(payload):
+                break
+            records.append(json.loads(payload.decode('utf-8')))
+        except ValueError:
+            break
+        valid += len(line)
+    return records, valid
+
+
+class VoteJournal:
+    def __init__(self, path, storage, vote_window, max_batch=256, linger=0.002,
+                 max_bytes=JOURNAL_MAX_BYTES):
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.lock_path = path + '.lock'
+        self.storage = storage
+        self.vote_window = vote_window
+        self.max_batch = max_batch
+        self.linger = linger
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue()
+        self._thread_lock = threading.Lock()
+        self._writer = None
+        self._voter_locks = [threading.Lock() for _ in range(VOTER_LOCK_STRIPES)]
+        self._commit_lock = threading.Lock()
+        self._claim_lock = threading.Lock()
+        self.batches = 0
+        self.committed = 0
+        self.rejected = 0
+
+    # ---- cross-process exclusive section ----
+
+    def _lock(self):
+        return _JournalLock(self.lock_path, self._commit_lock)
+
+    # Hold off all commits, e.g. while the vote stores are being cleared
+    def exclusive(self):
+        return self._lock()
+
+    # ---- checkpoint ----
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'offset': 0}
+
+    def _write_checkpoint(self, checkpoint, sync=False):
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.checkpoint-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        if sync:
+            _sync_directory(directory)
+
+    # ---- apply ----
+
+    def _apply(self, start, end, records):
+        votes = self.storage.votes
+        daily_votes = self.storage.daily_votes
+        # The checkpoint must be durable before the stores change, so a
+        # crash part-way through can be rolled back and replayed
+        self._write_checkpoint({'offset': start, 'pending_until': end,
+                                'marks': {'votes': votes.mark(), 'daily_votes': daily_votes.mark()}}, sync=True)
+        votes.extend([r['vote'] for r in records])
+        daily_votes.extend([r['daily'] for r in records])
+        for r in records:
+            self.vote_window.record(r['daily']['voter_id'])
+        # Moving the offset past these records means they are never replayed,
+        # so the stores must hold them durably first; and the journal may be
+        # truncated right after, so the new offset must be durable too
+        votes.sync()
+        daily_votes.sync()
+        self._write_checkpoint({'offset': end}, sync=True)
+
+    def _journal_size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    # Only called once the stores and the offset checkpoint are durable. The
+    # truncation is synced before the offset goes back to 0, so a crash in
+    # between can not replay records that were already applied.
+    def _compact(self):
+        with open(self.path, 'wb') as f:
+            os.fsync(f.fileno())
+        self._write_checkpoint({'offset': 0}, sync=True)
+
+    # Bring the stores in line with the journal after a crash. Returns the
+    # number of records replayed.
+    def recover(self):
+        with self._lock():
+            checkpoint = self._read_checkpoint()
+            marks = checkpoint.get('marks')
+            if marks:
+                self.storage.votes.truncate_to(marks['votes'])
+                self.storage.daily_votes.truncate_to(marks['daily_votes'])
+            offset = checkpoint.get('offset', 0)
+            data = b''
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            records, valid = _decode_records(data)
+            if valid < len(data):
+                logger.warning("Vote journal: discarding %d bytes of torn/corrupt records", len(data) - valid)
+                os.truncate(self.path, offset + valid)
+            if records:
+                logger.info("Vote journal: replaying %d committed votes", len(records))
+                self._apply(offset, offset + valid, records)
+            self._compact()
+            return len(records)
+
+    # ---- commit ----
+
+    def _ensure_writer(self):
+        with self._thread_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._writer_loop, name='vote-journal', daemon=True)
+                self._writer.start()
+
+    # Durably record a vote and its voted marker. Returns True if accepted,
+    # False if the voter already voted within the window. Blocks until the
+    # batch containing the vote has been fsynced and applied. If the writer
+    # has not taken the vote after `timeout` seconds it is withdrawn and
+    # TimeoutError raised, so a retry is not refused as a double vote; once
+    # taken, its batch is waited for.
+    def commit(self, vote, daily, timeout=30):
+        voter_id = daily['voter_id']
+        pending = _PendingVote(voter_id, vote, daily)
+        with self._voter_locks[hash(voter_id.upper()) % VOTER_LOCK_STRIPES]:
+            self._ensure_writer()
+            self._queue.put(pending)
+            if not pending.event.wait(timeout):
+                with self._claim_lock:
+                    if not pending.taken:
+                        pending.cancelled = True
+                        raise TimeoutError('Vote commit timed out')
+                pending.event.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.accepted
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._claim_lock:
+                batch = [pending for pending in batch if not pending.cancelled]
+                for pending in batch:
+                    pending.taken = True
+            if not batch:
+                continue
+            try:
+                self._commit_batch(batch)
+            except Exception as e:
+                logger.exception("Vote journal commit failed: %s", e)
+                for pending in batch:
+                    pending.accepted = False
+                    pending.error = e
+            for pending in batch:
+                pending.event.set()
+
+    def _commit_batch(self, batch):
+        with self._lock():
+            # See votes committed by other workers before deciding
+            self.vote_window.refresh()
+            accepted = []
+            seen = set()
+            for pending in batch:
+                key = pending.voter_id.upper()
+                if key in seen or self.vote_window.has_voted(key):
+                    self.rejected += 1
+                    continue
+                seen.add(key)
+                accepted.append(pending)
+            if accepted:
+                records = [{'vote': p.vote, 'daily': p.daily} for p in accepted]
+                data = b''.join(_encode_record(r['vote'], r['daily']) for r in records)
+                with open(self.path, 'ab') as f:
+                    start = f.tell()
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._apply(start, start + len(data), records)
+                for pending in accepted:
+                    pending.accepted = True
+                self.committed += len(accepted)
+                if start + len(data) > self.max_bytes:
+                    self._compact()
+            self.batches += 1
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'committed': self.committed,
+            'rejected': self.rejected,
+            'votes_per_batch': round(self.committed / self.batches, 2) if self.batches else 0,
+            'queued': self._queue.qsize(),
+        }
+
+
+class _JournalLock:
+    """Thread lock plus an exclusive flock on the journal lock file."""
+
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self._file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            if fcntl is not None:
+                self._file = open(self.path, 'a')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self._file is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                self._file.close()
+                self._file = None
+        finally:
+            self.thread_lock.release()
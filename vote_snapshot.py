@@ -0,0 +1,372 @@
+"""Compact columnar snapshot of the votes, for archiving and audits.
+
+votes.csv repeats the state, constituency, candidate and party names and a
+19-character timestamp on every line, and reading it back builds one dict
+of strings per vote. A snapshot stores each field as one column instead:
+
+- date, state, constituency, candidate_name and party are dictionary
+  encoded: the distinct values once, then one 2-byte code per vote
+  (4 bytes past 65535 distinct values)
+- timestamp is seconds since 1970-01-01 (of the naive local time the app
+  records) as 8-byte integers; -1 if the row had none
+- voter_id and name keep their text, UTF-8 and NUL-separated (CSV cannot
+  hold NUL, so it never occurs in a value)
+
+File layout (all integers big-endian):
+
+    header     magic (8s) | rows (Q) | directory length (I)
+    directory  JSON list of columns: name, kind ("dict", "int" or "text"),
+               array type (none for text), offset (from the end of the directory) and size
+               of its block, size before compression, CRC-32 of the stored
+               bytes, and the values of a "dict" column
+    columns    the column blocks, back to back, each zlib-compressed
+               unless the snapshot was written with compress=False
+
+Columns are read and checked only when first used, so a tally only reads
+the constituency, candidate and party columns. ``tally``, ``party_totals``
+and ``turnout_by_hour`` count straight over the codes and integers.
+
+    python vote_snapshot.py write votes.snapshot --data-dir .      # from votes.csv
+    python vote_snapshot.py write votes.snapshot --db vms.sqlite3
+    python vote_snapshot.py tally votes.snapshot
+    python vote_snapshot.py turnout votes.snapshot
+    python vote_snapshot.py export votes.snapshot votes-restored.csv
+"""
+import argparse
+import calendar
+import csv
+import json
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import repeat
+from operator import floordiv
+
+from storage import TIMESTAMP_FORMAT, VOTE_FIELDS, CsvVoteRepository, SqliteStorage
+
+MAGIC = b'VMSVOTE\x01'
+HEADER = struct.Struct('>8sQI')
+DICT_COLUMNS = ('date', 'state', 'constituency', 'candidate_name', 'party')
+TEXT_COLUMNS = ('voter_id', 'name')
+NO_TIMESTAMP = -1
+COMPRESS_LEVEL = 6
+
+_EPOCH = datetime(1970, 1, 1)
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def _to_bytes(values):
+    if not _BIG_ENDIAN:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if not _BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+class _TimestampCodec:
+    """'YYYY-MM-DD HH:MM:SS' <-> seconds, with the day part cached."""
+
+    def __init__(self):
+        self._day_seconds = {}
+        self._day_text = {}
+
+    def encode(self, text):
+        if len(text) == 19 and text[10] == ' ':
+            day = self._day_seconds.get(text[:10])
+            try:
+                if day is None:
+                    day = self._day_seconds[text[:10]] = calendar.timegm(
+                        datetime.strptime(text[:10], '%Y-%m-%d').timetuple())
+                return day + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+            except ValueError:
+                pass
+        try:
+            return calendar.timegm(datetime.strptime(text, TIMESTAMP_FORMAT).timetuple())
+        except ValueError:
+            return NO_TIMESTAMP
+
+    def decode(self, seconds):
+        if seconds == NO_TIMESTAMP:
+            return ''
+        day, rest = divmod(seconds, 86400)
+        text = self._day_text.get(day)
+        if text is None:
+            text = self._day_text[day] = (_EPOCH + timedelta(days=day)).strftime('%Y-%m-%d ')
+        return text + _time_of_day()[rest]
+
+
+_TIMES_OF_DAY = []
+
+
+# 'HH:MM:SS' of every second of the day, built on first use
+def _time_of_day():
+    if not _TIMES_OF_DAY:
+        _TIMES_OF_DAY.extend(f'{h:02d}:{m:02d}:{s:02d}' for h in range(24) for m in range(60) for s in range(60))
+    return _TIMES_OF_DAY
+
+
+# ========== WRITING ==========
+
+# Write the vote rows (dicts with VOTE_FIELDS, e.g. storage.votes.log())
+# to `path`, replacing it atomically. Returns the number of rows.
+def write_snapshot(path, rows, compress=True):
+    dictionaries = {name: {} for name in DICT_COLUMNS}
+    codes = {name: array('I') for name in DICT_COLUMNS}
+    texts = {name: [] for name in TEXT_COLUMNS}
+    timestamps = array('q')
+    encode_timestamp = _TimestampCodec().encode
+    dict_columns = [(name, dictionaries[name], codes[name].append) for name in DICT_COLUMNS]
+    text_columns = [(name, texts[name].append) for name in TEXT_COLUMNS]
+    count = 0
+    for row in rows:
+        for name, dictionary, append in dict_columns:
+            value = row.get(name) or ''
+            code = dictionary.get(value)
+            if code is None:
+                code = dictionary[value] = len(dictionary)
+            append(code)
+        for name, append in text_columns:
+            append(row.get(name) or '')
+        timestamps.append(encode_timestamp(row.get('timestamp') or ''))
+        count += 1
+
+    blocks = []
+    for name in VOTE_FIELDS:
+        if name in DICT_COLUMNS:
+            typecode = 'H' if len(dictionaries[name]) <= 0xFFFF else 'I'
+            data = _to_bytes(array(typecode, codes[name]))
+            blocks.append(({'name': name, 'kind': 'dict', 'type': typecode,
+                            'values': list(dictionaries[name])}, data))
+        elif name in TEXT_COLUMNS:
+            values = texts[name]
+            text = '\x00'.join(values)
+            if values and text.count('\x00') != len(values) - 1:
+                text = '\x00'.join(value.replace('\x00', '') for value in values)
+            data = text.encode('utf-8')
+            blocks.append(({'name': name, 'kind': 'text'}, data))
+        else:
+            blocks.append(({'name': name, 'kind': 'int', 'type': 'q'}, _to_bytes(timestamps)))
+
+    directory = []
+    payloads = []
+    offset = 0
+    for column, data in blocks:
+        stored = zlib.compress(data, COMPRESS_LEVEL) if compress else data
+        column.update(offset=offset, size=len(stored), raw_size=len(data), crc=zlib.crc32(stored),
+                      compression='zlib' if compress else None)
+        directory.append(column)
+        payloads.append(stored)
+        offset += len(stored)
+    directory_data = json.dumps(directory, separators=(',', ':')).encode('utf-8')
+
+    target_dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, count, len(directory_data)))
+            f.write(directory_data)
+            for stored in payloads:
+                f.write(stored)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+# ========== READING ==========
+
+class SnapshotError(ValueError):
+    pass
+
+
+class VoteSnapshot:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise SnapshotError(f"{path} is not a vote snapshot")
+            magic, self.rows, directory_size = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise SnapshotError(f"{path} is not a vote snapshot")
+            try:
+                directory = json.loads(f.read(directory_size))
+            except ValueError:
+                raise SnapshotError(f"{path} has an unreadable column directory") from None
+        self.columns = {column['name']: column for column in directory}
+        self._start = HEADER.size + directory_size
+        self._decoded = {}
+
+    def __len__(self):
+        return self.rows
+
+    def _block(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            raise SnapshotError(f"{self.path} has no column {name}")
+        with open(self.path, 'rb') as f:
+            f.seek(self._start + column['offset'])
+            stored = f.read(column['size'])
+        if len(stored) != column['size'] or zlib.crc32(stored) != column['crc']:
+            raise SnapshotError(f"Column {name} of {self.path} is damaged")
+        data = zlib.decompress(stored) if column.get('compression') == 'zlib' else stored
+        if len(data) != column['raw_size']:
+            raise SnapshotError(f"Column {name} of {self.path} is damaged")
+        return column, data
+
+    # (codes, values) of a dictionary-encoded column: row i holds values[codes[i]]
+    def codes(self, name):
+        if name not in self._decoded:
+            column, data = self._block(name)
+            if column['kind'] != 'dict':
+                raise SnapshotError(f"Column {name} is not dictionary encoded")
+            self._decoded[name] = (_from_bytes(column['type'], data), column['values'])
+        return self._decoded[name]
+
+    # Vote times in seconds since 1970-01-01 (NO_TIMESTAMP if unknown)
+    def timestamps(self):
+        if 'timestamp' not in self._decoded:
+            column, data = self._block('timestamp')
+            self._decoded['timestamp'] = _from_bytes(column['type'], data)
+        return self._decoded['timestamp']
+
+    # Values of a text column (voter_id, name) as a list of str
+    def texts(self, name):
+        if name not in self._decoded:
+            column, data = self._block(name)
+            if column['kind'] != 'text':
+                raise SnapshotError(f"Column {name} is not a text column")
+            values = data.decode('utf-8').split('\x00') if self.rows else []
+            if len(values) != self.rows:
+                raise SnapshotError(f"Column {name} of {self.path} is damaged")
+            self._decoded[name] = values
+        return self._decoded[name]
+
+    # Rows as dicts of strings, in the shape of storage.votes.log()
+    def log(self):
+        columns = []
+        for name in VOTE_FIELDS:
+            if name in DICT_COLUMNS:
+                codes, values = self.codes(name)
+                columns.append(map(values.__getitem__, codes))
+            elif name in TEXT_COLUMNS:
+                columns.append(self.texts(name))
+            else:
+                columns.append(map(_TimestampCodec().decode, self.timestamps()))
+        for values in zip(*columns):
+            yield dict(zip(VOTE_FIELDS, values))
+
+
+# ========== AGGREGATES ==========
+
+# Votes per (state, constituency) and "candidate (party)", like
+# storage.tally_rows
+def tally(snapshot):
+    states, state_values = snapshot.codes('state')
+    constituencies, constituency_values = snapshot.codes('constituency')
+    candidates, candidate_values = snapshot.codes('candidate_name')
+    parties, party_values = snapshot.codes('party')
+    votes = {}
+    for (s, c, k, p), n in Counter(zip(states, constituencies, candidates, parties)).items():
+        constituency, candidate_name = constituency_values[c], candidate_values[k]
+        if constituency and candidate_name:
+            by_candidate = votes.setdefault((state_values[s], constituency), {})
+            by_candidate[f"{candidate_name} ({party_values[p]})"] = n
+    return votes
+
+
+# Votes per party, most votes first
+def party_totals(snapshot):
+    parties, values = snapshot.codes('party')
+    totals = {}
+    for code, n in Counter(parties).items():
+        totals[values[code]] = totals.get(values[code], 0) + n
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+# Votes per hour ("YYYY-MM-DD HH:00"), in time order; optionally only one
+# constituency's and/or one state's (a constituency name can occur in
+# several states)
+def turnout_by_hour(snapshot, constituency=None, state=None):
+    timestamps = snapshot.timestamps()
+    filters = [(name, value) for name, value in (('constituency', constituency), ('state', state))
+               if value is not None]
+    if filters:
+        wanted = []
+        for name, value in filters:
+            codes, values = snapshot.codes(name)
+            if value not in values:
+                return {}
+            wanted.append((codes, values.index(value)))
+        timestamps = [t for i, t in enumerate(timestamps) if all(codes[i] == code for codes, code in wanted)]
+    hours = Counter(map(floordiv, timestamps, repeat(3600)))
+    hours.pop(NO_TIMESTAMP // 3600, None)
+    codec = _TimestampCodec()
+    return {codec.decode(hour * 3600)[:13] + ':00': n for hour, n in sorted(hours.items())}
+
+
+# ========== COMMAND LINE ==========
+
+def main():
+    parser = argparse.ArgumentParser(description='Columnar vote snapshots')
+    sub = parser.add_subparsers(dest='command', required=True)
+    write = sub.add_parser('write', help='snapshot the votes of a data directory or SQLite database')
+    write.add_argument('snapshot')
+    write.add_argument('--data-dir', default='.', help='directory holding votes.csv')
+    write.add_argument('--db', help='read the votes from this SQLite database instead')
+    write.add_argument('--no-compress', action='store_true')
+    for command, help_text in (('tally', 'votes per constituency and candidate'),
+                               ('turnout', 'votes per hour')):
+        reader = sub.add_parser(command, help=help_text)
+        reader.add_argument('snapshot')
+        if command == 'turnout':
+            reader.add_argument('--constituency')
+            reader.add_argument('--state')
+    export = sub.add_parser('export', help='write the votes back out as CSV')
+    export.add_argument('snapshot')
+    export.add_argument('csv_path')
+    args = parser.parse_args()
+
+    if args.command == 'write':
+        if args.db:
+            rows = SqliteStorage(args.db).votes.log()
+        else:
+            rows = CsvVoteRepository(os.path.join(args.data_dir, 'votes.csv')).log()
+        count = write_snapshot(args.snapshot, rows, compress=not args.no_compress)
+        print(f"Wrote {count} votes to {args.snapshot} ({os.path.getsize(args.snapshot):,} bytes)")
+        return 0
+    snapshot = VoteSnapshot(args.snapshot)
+    if args.command == 'tally':
+        for (state, constituency), candidates in sorted(tally(snapshot).items()):
+            print(f"{constituency} ({state})" if state else constituency)
+            for candidate, n in sorted(candidates.items(), key=lambda item: -item[1]):
+                print(f"  {n:>8}  {candidate}")
+        print(f"Parties: {party_totals(snapshot)}")
+    elif args.command == 'turnout':
+        for hour, n in turnout_by_hour(snapshot, args.constituency, args.state).items():
+            print(f"{hour}  {n:>8}")
+    else:
+        with open(args.csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(VOTE_FIELDS)
+            writer.writerows([row[field] for field in VOTE_FIELDS] for row in snapshot.log())
+        print(f"Wrote {len(snapshot)} votes to {args.csv_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
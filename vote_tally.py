@@ -0,0 +1,202 @@
+"""Running vote counts for the results views.
+
+``VoteTally`` keeps per-constituency, per-candidate and per-party counters
+in memory and only folds in vote rows appended to the store since its last
+refresh, so results cost nothing extra however many votes have been cast.
+The counters are checkpointed to a JSON file together with the store
+position they cover; after a restart only the rows added since the
+checkpoint are read. If the store was cleared or rewritten meanwhile, the
+position no longer matches and the votes are recounted from scratch.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Checkpoints of other formats are ignored and the votes recounted (format 1
+# merged same-named constituencies of different states)
+CHECKPOINT_FORMAT = 2
+
+# Write the checkpoint after this many new votes or this many seconds
+CHECKPOINT_EVERY_VOTES = 1000
+CHECKPOINT_EVERY_SECONDS = 30
+
+
+class VoteTally:
+    def __init__(self, source, checkpoint_path, checkpoint_every=CHECKPOINT_EVERY_VOTES,
+                 checkpoint_interval=CHECKPOINT_EVERY_SECONDS):
+        # source: a votes repository providing read_since(position)
+        self.source = source
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self._lock = threading.Lock()
+        self._reset()
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self._results = None
+        # Bumped whenever the counts change
+        self.version = 0
+
+    def _reset(self):
+        self._position = None
+        # (state, constituency) -> {(candidate_name, party): count}, in order of
+        # first vote. Some constituency names occur in more than one state.
+        self._counts = {}
+        self._parties = {}
+        self._total = 0
+        # Constituencies changed since the last take_changes(), and whether
+        # the counts were rebuilt meanwhile (for the live results feed)
+        self._changed = set()
+        self._rebuilt = True
+
+    def _add(self, state, constituency, candidate_name, party, n=1):
+        seat = (state, constituency)
+        by_candidate = self._counts.setdefault(seat, {})
+        key = (candidate_name, party)
+        by_candidate[key] = by_candidate.get(key, 0) + n
+        self._changed.add(seat)
+        self._parties[party] = self._parties.get(party, 0) + n
+        self._total += n
+
+    # ---- checkpoint ----
+
+    def load(self):
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            logger.warning("Ignoring unreadable tally checkpoint %s", self.checkpoint_path)
+            return False
+        if checkpoint.get('format') != CHECKPOINT_FORMAT:
+            logger.info("Ignoring tally checkpoint %s of an older format; recounting", self.checkpoint_path)
+            return False
+        with self._lock:
+            self._reset()
+            for state, constituency, candidate_name, party, n in checkpoint.get('counts', []):
+                self._add(state, constituency, candidate_name, party, n)
+            self._position = checkpoint.get('position')
+            self._results = None
+            self.version += 1
+        return True
+
+    def _save(self):
+        counts = [[state, constituency, candidate_name, party, n]
+                  for (state, constituency), by_candidate in self._counts.items()
+                  for (candidate_name, party), n in by_candidate.items()]
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tally-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'format': CHECKPOINT_FORMAT, 'position': self._position, 'total': self._total,
+                       'counts': counts}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    # ---- counting ----
+
+    # Fold in votes appended since the last refresh. Returns the number of
+    # new votes counted.
+    def refresh(self):
+        with self._lock:
+            rows, position, reset = self.source.read_since(self._position)
+            if reset and self._position is not None:
+                logger.info("Vote store was rewritten; recounting all votes")
+            if reset:
+                self._reset()
+            counted = 0
+            for row in rows:
+                if row.get('constituency') and row.get('candidate_name'):
+                    self._add(row.get('state', ''), row['constituency'], row['candidate_name'], row.get('party', ''))
+                    counted += 1
+            self._position = position
+            if counted or reset:
+                self._results = None
+                self.version += 1
+                self._unsaved += counted or 1
+            if self._unsaved and (self._unsaved >= self.checkpoint_every or
+                                  time.monotonic() - self._saved_at >= self.checkpoint_interval):
+                self._save()
+            return counted
+
+    # Forget everything (after the store was cleared)
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self._results = None
+            self.version += 1
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+
+    # ---- results ----
+
+    # {(state, constituency): {"candidate (party)": votes}}
+    def votes(self):
+        with self._lock:
+            return {seat: {f"{candidate_name} ({party})": n for (candidate_name, party), n in by_candidate.items()}
+                    for seat, by_candidate in self._counts.items()}
+
+    def _entry(self, seat):
+        state, constituency = seat
+        by_candidate = self._counts[seat]
+        candidates = sorted(({'candidate_name': candidate_name, 'party': party, 'votes': n}
+                             for (candidate_name, party), n in by_candidate.items()),
+                            key=lambda c: -c['votes'])
+        return {
+            'state': state,
+            'constituency': constituency,
+            'total': sum(by_candidate.values()),
+            'leader': candidates[0] if candidates else None,
+            'candidates': candidates,
+        }
+
+    def _document(self, seats):
+        return {
+            'version': self.version,
+            'total_votes': self._total,
+            'parties': dict(sorted(self._parties.items(), key=lambda item: -item[1])),
+            'constituencies': [self._entry(seat) for seat in seats],
+        }
+
+    # Full results document; built once per change and shared until the
+    # next vote, so serving it does not depend on the number of votes
+    def results(self):
+        with self._lock:
+            if self._results is None:
+                self._results = self._document(self._counts)
+            return self._results
+
+    # What changed since the previous call: (version, rebuilt, delta).
+    # rebuilt is True if the counts were recounted or cleared, so only the
+    # full results are meaningful; otherwise delta is a results document
+    # holding just the changed constituencies, or None if nothing changed.
+    def take_changes(self):
+        with self._lock:
+            if self._rebuilt:
+                self._rebuilt = False
+                self._changed.clear()
+                return self.version, True, None
+            if not self._changed:
+                return self.version, False, None
+            delta = self._document([seat for seat in self._counts if seat in self._changed])
+            self._changed.clear()
+            return self.version, False, delta
+
+    def stats(self):
+        with self._lock:
+            return {
+                'total_votes': self._total,
+                'constituencies': len(self._counts),
+                'version': self.version,
+                'unsaved': self._unsaved,
+            }
@@ -0,0 +1,93 @@
+"""In-memory index of recent votes for the 75-hour re-voting rule.
+
+Keeps voter_id -> epoch seconds of the voter's latest vote. It is built from
+the daily votes store once and then only reads rows appended since the last
+refresh (by this or any other worker process), so checking a voter is a
+dictionary lookup instead of a scan of every vote cast so far. Entries older
+than the window are expired, which keeps memory bounded by the number of
+voters who voted in the last 75 hours.
+"""
+import heapq
+import threading
+import time
+
+from storage import daily_vote_time
+
+VOTE_WINDOW_SECONDS = 75 * 3600
+
+
+class VoteWindow:
+    def __init__(self, source, window_seconds=VOTE_WINDOW_SECONDS):
+        # source: a daily votes repository providing read_since(position)
+        self.source = source
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._last_vote = {}
+        self._expiry = []
+        self._position = None
+
+    def _record(self, voter_id, epoch):
+        key = voter_id.upper()
+        if epoch > self._last_vote.get(key, float('-inf')):
+            self._last_vote[key] = epoch
+            heapq.heappush(self._expiry, (epoch, key))
+
+    def _expire(self, now):
+        cutoff = now - self.window_seconds
+        while self._expiry and self._expiry[0][0] <= cutoff:
+            epoch, key = heapq.heappop(self._expiry)
+            # Skip heap entries superseded by a later vote of the same voter
+            if self._last_vote.get(key) == epoch:
+                del self._last_vote[key]
+
+    # Fold in rows appended to the store since the last refresh; the first
+    # call (or a store that was cleared meanwhile) reads everything
+    def refresh(self):
+        with self._lock:
+            rows, position, reset = self.source.read_since(self._position)
+            if reset:
+                self._last_vote = {}
+                self._expiry = []
+            for row in rows:
+                vote_time = daily_vote_time(row)
+                if vote_time is not None and row.get('voter_id'):
+                    self._record(row['voter_id'], int(vote_time.timestamp()))
+            self._position = position
+            self._expire(time.time())
+
+    # (store position, {voter_id: epoch}) for the warm-state snapshot
+    def state(self):
+        with self._lock:
+            return self._position, dict(self._last_vote)
+
+    # Start from a saved state; the next refresh() reads only the rows
+    # added after `position`, or everything if the store was rewritten
+    def restore(self, position, last_vote):
+        with self._lock:
+            self._last_vote = dict(last_vote)
+            self._expiry = [(epoch, key) for key, epoch in self._last_vote.items()]
+            heapq.heapify(self._expiry)
+            self._position = position
+
+    def has_voted(self, voter_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            epoch = self._last_vote.get(voter_id.upper())
+            return epoch is not None and now - epoch < self.window_seconds
+
+    # Record a vote that was just written to the store
+    def record(self, voter_id, epoch=None):
+        epoch = int(time.time()) if epoch is None else int(epoch)
+        with self._lock:
+            self._record(voter_id, epoch)
+
+    # Forget everything (after the store was cleared)
+    def clear(self):
+        with self._lock:
+            self._last_vote = {}
+            self._expiry = []
+            self._position = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._last_vote)
@@ -0,0 +1,272 @@
+"""Process-wide in-memory cache of voters.csv.
+
+The file is parsed once and kept in memory together with a case-insensitive
+voter_id index. Every access compares the file's mtime and size with the
+cached values. Rows appended by another process are then read from where the
+last read stopped (storage.csv_read_since) and added to the cache; any other
+edit (or a file rewritten by hand) triggers a full reload and a new
+``generation``. Rows appended through ``append`` are added to the cache
+directly without re-reading the file.
+"""
+import csv
+import io
+import logging
+import os
+import sys
+import threading
+
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+# Fingerprint images live in the blob store; the row only keeps their hash
+VOTER_FIELDS = ['voter_id', 'name', 'template_base64', 'bmp_hash', 'registration_date']
+
+
+# One page of `voters` (in roll order) matching the filters, starting at list
+# index `cursor`. Returns (voters, next cursor or None after the last page).
+def page_voters(voters, cursor=0, limit=100, voter_id=None, date=None):
+    voter_id = (voter_id or '').strip().upper()
+    page = []
+    for index in range(cursor or 0, len(voters)):
+        voter = voters[index]
+        if voter_id and voter['voter_id'].upper() != voter_id:
+            continue
+        if date and not voter.get('registration_date', '').startswith(date):
+            continue
+        page.append(voter)
+        if len(page) >= limit:
+            return page, index + 1 if index + 1 < len(voters) else None
+    return page, None
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+# Voter dict of a voters.csv row, or None if it has no ID or no usable template
+def voter_from_row(row):
+    voter_id = (row.get('voter_id') or '').strip()
+    template = (row.get('template_base64') or '').strip()
+    if not voter_id or len(template) <= 10:
+        return None
+    return {
+        'voter_id': voter_id,
+        'name': (row.get('name') or '').strip(),
+        'template_base64': template,
+        'bmp_hash': (row.get('bmp_hash') or '').strip(),
+        'registration_date': (row.get('registration_date') or '').strip()
+    }
+
+
+# Parse voters.csv into a list of voter dicts, skipping rows without a usable template
+def read_voters_csv(path):
+    voters = []
+    if os.path.exists(path):
+        original_limit = csv.field_size_limit()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                reader = csv.DictReader(f)
+                if 'bmp_base64' in (reader.fieldnames or []):
+                    # Legacy file with inline images; needs the larger limit until migrated
+                    logger.warning("%s still has inline images; run 'python blob_store.py migrate %s'", path, path)
+                    csv.field_size_limit(min(2**31-1, sys.maxsize))
+                row_count = 0
+                for row in reader:
+                    row_count += 1
+                    try:
+                        voter = voter_from_row(row)
+                        if voter is not None:
+                            voters.append(voter)
+                        else:
+                            logger.warning("Skipped voters row %d: voter_id=%s, template_len=%d",
+                                           row_count, bool((row.get('voter_id') or '').strip()),
+                                           len((row.get('template_base64') or '').strip()))
+                    except Exception as row_error:
+                        logger.warning("Error processing voters row %d: %s", row_count, row_error)
+                        continue
+
+                logger.info("Read %s: %d rows, %d valid voters", path, row_count, len(voters),
+                            extra={'rows': row_count, 'voters': len(voters)})
+
+        except Exception:
+            logger.exception("Error reading voters CSV %s", path)
+        finally:
+            csv.field_size_limit(original_limit)
+    else:
+        logger.warning("Voters CSV %s does not exist", path)
+    return voters
+
+
+class VoterRegistry:
+    """Cached view of a voters CSV file with O(1) lookups."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._signature = None
+        # storage.csv_read_since position of the end of the rows read, or
+        # None if the next change must reload the whole file
+        self._position = None
+        self._voters = []
+        self._by_id = {}
+        # Bumped on every full reload so dependent indexes know to rebuild;
+        # voters read from appended rows keep it (see changes_since)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.appends = 0
+        self.appended_reads = 0
+
+    def _index(self, voter):
+        self._by_id.setdefault(voter['voter_id'].upper(), voter)
+
+    # Replace the cached roll; the first row wins for a repeated voter ID
+    def _install(self, voters):
+        self._voters = voters
+        self._by_id = {voter['voter_id'].upper(): voter for voter in reversed(voters)}
+        self.generation += 1
+
+    def _reload(self, signature):
+        # storage imports this module
+        from storage import csv_end_position
+        position = csv_end_position(self.path)
+        with metrics.timer('csv_parse'):
+            voters = read_voters_csv(self.path)
+        self._install(voters)
+        # A position taken while the file was being written may not match
+        # what was read; the next change then reloads the whole file
+        self._position = position if file_signature(self.path) == signature else None
+
+    # Add the rows appended since the last read; False if the file was
+    # changed in some other way and has to be reloaded
+    def _read_appended(self):
+        from storage import csv_read_since
+        if self._position is None:
+            return False
+        with metrics.timer('csv_parse'):
+            rows, position, reset = csv_read_since(self.path, VOTER_FIELDS, self._position)
+        if reset:
+            return False
+        for voter in map(voter_from_row, rows):
+            if voter is not None:
+                self._voters.append(voter)
+                self._index(voter)
+        self._position = position
+        self.appended_reads += 1
+        return True
+
+    # Pick up changes made to the file since it was last read
+    def _refresh(self):
+        signature = file_signature(self.path)
+        if self._signature is not None and signature == self._signature:
+            self.hits += 1
+            return
+        self.misses += 1
+        if self._signature is None or not self._read_appended():
+            self._reload(signature)
+        self._signature = signature
+
+    def voters(self):
+        with self._lock:
+            self._refresh()
+            return list(self._voters)
+
+    # Pick up outside changes; returns the (possibly bumped) generation
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+            return self.generation
+
+    # Voters added since a caller saw the first `count` voters of
+    # `generation`, as (generation, voters); voters is None if the roll was
+    # reloaded since, so the caller has to rebuild from voters()
+    def changes_since(self, generation, count):
+        with self._lock:
+            self._refresh()
+            if generation != self.generation or count > len(self._voters):
+                return self.generation, None
+            return self.generation, self._voters[count:]
+
+    def get(self, voter_id):
+        with self._lock:
+            self._refresh()
+            return self._by_id.get((voter_id or '').strip().upper())
+
+    def page(self, cursor=0, limit=100, voter_id=None, date=None):
+        with self._lock:
+            self._refresh()
+            return page_voters(self._voters, cursor, limit, voter_id, date)
+
+    # Append voter rows to the file and to the cache.
+    # If the file was changed by someone else since the last read (or while
+    # writing), the cache is left as it is and the next access reads the new
+    # rows, these included, from the file.
+    def extend(self, voters):
+        from storage import csv_end_position
+        rows = [[voter.get(field, '') for field in VOTER_FIELDS] for voter in voters]
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        data = buffer.getvalue()
+        with self._lock:
+            fresh = self._signature is not None and file_signature(self.path) == self._signature
+            with open(self.path, 'a', newline='', encoding='utf-8') as f:
+                f.write(data)
+            self.appends += len(rows)
+            signature = file_signature(self.path)
+            if not fresh or signature is None or signature[1] != self._signature[1] + len(data.encode('utf-8')):
+                return
+            for row in rows:
+                cached = dict(zip(VOTER_FIELDS, (str(v).strip() for v in row)))
+                if cached['voter_id'] and len(cached['template_base64']) > 10:
+                    self._voters.append(cached)
+                    self._index(cached)
+            position = csv_end_position(self.path)
+            self._position = position if position is not None and position[1] == signature[1] else None
+            self._signature = signature
+
+    def append(self, voter):
+        self.extend([voter])
+
+    # (voters, file signature) of the cached roll, or None if nothing is
+    # cached yet; for the warm-state snapshot
+    def cached_state(self):
+        with self._lock:
+            if self._signature is None:
+                return None
+            return list(self._voters), self._signature
+
+    # Install a roll read elsewhere (the warm-state snapshot) as the cached
+    # contents of the file with this signature, read up to `position`
+    def restore(self, voters, signature, position=None):
+        with self._lock:
+            self._install(list(voters))
+            self._signature = signature
+            self._position = position
+
+    # Forget the cached contents (e.g. after the file was rewritten)
+    def invalidate(self):
+        with self._lock:
+            self._signature = None
+
+    # Remove every voter, keeping the header row
+    def clear(self):
+        with self._lock:
+            with open(self.path, 'w', newline='', encoding='utf-8') as f:
+                csv.writer(f).writerow(VOTER_FIELDS)
+            self._signature = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'voters': len(self._voters),
+                'hits': self.hits,
+                'misses': self.misses,
+                'appends': self.appends,
+                'appended_reads': self.appended_reads,
+                'generation': self.generation,
+            }
@@ -0,0 +1,149 @@
+"""Warm-state snapshot, so a restart does not re-read the CSV files.
+
+At shutdown (and after the first warm-up) the in-memory state built from
+the CSV files is written to one file with ``marshal``:
+
+- the voter roll cached by the VoterRegistry, with the position of the end
+  of voters.csv it was read up to
+- the minutiae-triplet TemplateIndex of that roll
+- the 75-hour map of the VoteWindow, with its daily-votes position
+
+The vote counts are not included; VoteTally keeps its own checkpoint.
+
+On startup ``restore`` checks each part against the files before using it.
+voters.csv must still hold exactly the bytes the roll was read from, which
+is checked by inode, offset and the CRC-32 of the bytes before the offset
+(storage.csv_read_since); rows appended since are read and added, anything
+else discards the roll and the index, which are then rebuilt lazily. The
+vote window checks its own position on the next refresh. Snapshots written
+by another Python version are ignored, as marshal data is only readable by
+the version that wrote it.
+"""
+import logging
+import marshal
+import os
+import sys
+import tempfile
+import threading
+
+from storage import csv_end_position, csv_read_since
+from voter_registry import VOTER_FIELDS, file_signature, voter_from_row
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'VMSWARM\x01'
+
+
+class WarmState:
+    def __init__(self, path, registry=None, template_index=None, vote_window=None):
+        # registry: the CSV VoterRegistry (None for the SQLite backend, whose
+        # roll is not kept in memory); template_index is saved with it
+        self.path = path
+        self.registry = registry
+        self.template_index = template_index
+        self.vote_window = vote_window
+        self._lock = threading.Lock()
+        # True when the snapshot was missing or partly out of date, so it
+        # should be written again once the state has been rebuilt
+        self.stale = True
+        self.restored = []
+        self.saves = 0
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    logger.warning("Ignoring unreadable warm state %s", self.path)
+                    return None
+                # One read: marshal.load(f) reads the file a few bytes at a time
+                state = marshal.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError):
+            logger.warning("Ignoring unreadable warm state %s", self.path)
+            return None
+        if not isinstance(state, dict) or state.get('python') != tuple(sys.version_info[:2]):
+            logger.info("Ignoring warm state %s written by another Python version", self.path)
+            return None
+        return state
+
+    # Load what is still valid. Returns True if template_index was restored
+    # in step with the registry.
+    def restore(self):
+        state = self._read()
+        if state is None:
+            return False
+        stale = False
+        index_restored = False
+        if self.registry is not None and state.get('voters') is not None:
+            path = self.registry.path
+            # Taken before reading: if the file changes in between, the
+            # registry sees a different signature and reads on from `position`
+            signature = file_signature(path)
+            rows, position, reset = csv_read_since(path, VOTER_FIELDS, state['voters_position'])
+            if reset:
+                logger.info("%s changed since the warm state was saved; reloading it lazily", path)
+                stale = True
+            else:
+                voters = [dict(zip(VOTER_FIELDS, values)) for values in state['voters']]
+                added = [voter for voter in map(voter_from_row, rows) if voter is not None]
+                self.registry.restore(voters + added, signature, position)
+                self.restored.append('voters')
+                stale = stale or bool(added)
+                index = state.get('template_index')
+                if self.template_index is not None and index is not None and \
+                        {voter_id.upper() for voter_id in index['voter_ids']} == \
+                        {voter['voter_id'].upper() for voter in voters}:
+                    self.template_index.restore(index)
+                    for voter in added:
+                        self.template_index.add(voter['voter_id'], voter['template_base64'])
+                    self.restored.append('template_index')
+                    index_restored = True
+                else:
+                    stale = True
+        window = state.get('vote_window')
+        if self.vote_window is not None and window is not None:
+            self.vote_window.restore(window[0], window[1])
+            self.restored.append('vote_window')
+        self.stale = stale
+        logger.info("Restored %s from %s", ', '.join(self.restored) or 'nothing', self.path)
+        return index_restored
+
+    # Write the current state. index_current says whether template_index
+    # matches the registry's roll; otherwise it is left out.
+    def save(self, index_current=True):
+        state = {'python': tuple(sys.version_info[:2])}
+        if self.registry is not None:
+            cached = self.registry.cached_state()
+            if cached is not None:
+                voters, signature = cached
+                position = csv_end_position(self.registry.path)
+                # Only a roll that is exactly the file's current contents
+                if position is not None and file_signature(self.registry.path) == signature:
+                    state['voters'] = [tuple(voter.get(field, '') for field in VOTER_FIELDS) for voter in voters]
+                    state['voters_position'] = position
+                    if self.template_index is not None and index_current:
+                        state['template_index'] = self.template_index.state()
+        if self.vote_window is not None:
+            state['vote_window'] = self.vote_window.state()
+        with self._lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.warm-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(MAGIC)
+                    f.write(marshal.dumps(state))
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.stale = False
+            self.saves += 1
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'restored': list(self.restored),
+            'stale': self.stale,
+            'saves': self.saves,
+        }